@@ -23,12 +23,27 @@
 // MQTT
 #define MQTT_SERVER "broker.hivemq.com"
 #define MQTT_PORT 1883
-#define MQTT_TOPIC "payments/"
+// Тот же MERCHANT_ID, что в .env сервера: из него строятся все топики
+#define MERCHANT_ID ""
+#define MQTT_TOPIC "payments/" MERCHANT_ID
+// Retained-каталог цен: сервер публикует его при каждом изменении
+#define MQTT_CONFIG_TOPIC "config/" MERCHANT_ID
 
 // Сервер
 #define SERVER_URL "/perfume-api"
 #define DEVICE_ID "perfume_001"
 
+// Персональный топик автомата: сервер шлёт сюда события его заказов
+#define MQTT_DEVICE_TOPIC MQTT_TOPIC "/" DEVICE_ID
+// Цены этого автомата (группа/собственные), если он есть в каталоге:
+// config/<MERCHANT_ID>/<DEVICE_ID>, как их публикует сервер
+#define MQTT_DEVICE_CONFIG_TOPIC MQTT_CONFIG_TOPIC "/" DEVICE_ID
+// Пачки событий телеметрии (дозы, таймауты, отмены, переподключения)
+#define MQTT_TELEMETRY_TOPIC "telemetry/" MERCHANT_ID "/" DEVICE_ID
+// Пачка уходит, когда набралось TELEMETRY_MAX событий или раз в TELEMETRY_INTERVAL мс
+#define TELEMETRY_MAX 20
+#define TELEMETRY_INTERVAL 60000
+
 // ==================== EXTERN ПЕРЕМЕННЫЕ ====================
 extern Servo servo1;
 extern Servo servo2;
@@ -46,6 +61,10 @@ extern const char* ssid;
 extern const char* password;
 extern const char* mqtt_server;
 extern const char* mqtt_topic;
+extern const char* mqtt_device_topic;
+extern const char* mqtt_config_topic;
+extern const char* mqtt_device_config_topic;
+extern const char* mqtt_telemetry_topic;
 
 extern WiFiClient espClient;
 extern PubSubClient client;
@@ -83,8 +102,12 @@ extern const char* NAME_LANVIN;
 extern const char* NAME_DIOR;
 extern const char* NAME_DOLCE;
 
-// Таймер pollPrices
+// Таймер pollPrices: пока каталог не пришёл по MQTT (после каждого
+// подключения) — опрос как раньше, потом HTTP — редкий запасной путь
+#define PRICE_POLL_INTERVAL 30000
+#define PRICE_POLL_FALLBACK 600000
 extern unsigned long lastPoll;
+extern bool pricesPushed;
 extern unsigned long timer1;
 extern unsigned long timer2;
 extern unsigned long timer3;
@@ -108,13 +131,18 @@ void mqtt_callback(char* topic, byte* payload, unsigned int length);
 void mqtt_reconnect();
 void mqtt_loop();
 
-// QR код
+// QR код: версия 9 вмещает checkout URL с ac.order_id (53x53 модуля)
+#define QR_VERSION 9
+#define QR_BITS_MAX 512
 void generateQrToImage(String url);
+bool showQrBitmap(const char* bitsBase64, int size, int rowBytes);
+void renderQrBits();
 void clearQrImage();
 
 // Заказы
 void createOrder(int parfumId, int price);
 void cancelOrder();
+void extendOrder();
 
 // Парфюмы
 void parfum1();
@@ -125,8 +153,14 @@ void dispenseParfum(int num);
 
 // Загрузка цен с сервера
 void pollPrices();
+void applyPrices(JsonDocument &doc);
 void updatePriceLabels();
 void loadFromPrefs();
 void saveToPrefs();
 
+// Телеметрия
+void telemetryEvent(const char* type, int slot, long value = 0);
+void telemetryFlush();
+void telemetryLoop();
+
 #endif
@@ -0,0 +1,255 @@
+import array
+import logging
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy те же запросы считаются циклом по ячейкам — медленнее, но верно
+    np = None
+
+log = logging.getLogger("analytics")
+
+HOUR_MS = 60 * 60 * 1000
+
+# Состояния, которые учитывают сводки, и их поля в ответе
+STATE_FIELDS = ((2, "sales"), (-1, "cancelled"), (-2, "refunds"))
+
+# Измерения группировки /api/stats
+GROUP_FIELDS = ("hour", "device_id", "parfum_id")
+
+# Колонки ячеек: имя и тип элемента
+COLUMNS = (("hour", "i"), ("device", "i"), ("parfum", "q"), ("state", "b"), ("count", "q"), ("amount", "q"))
+
+# Группировка через bincount без сортировки, пока пространство ключей не
+# больше DENSE_RATIO x выбранных ячеек (память ответа — O(ячеек))
+DENSE_RATIO = 4
+STATE_RADIX = 5
+
+
+def sale_events(record):
+    """(время, state) переходов транзакции, которые попадают в сводки"""
+    events = []
+    if record.get('perform_time'):
+        events.append((record['perform_time'], 2))
+    if record.get('state') in (-1, -2) and record.get('cancel_time'):
+        events.append((record['cancel_time'], record['state']))
+    return events
+
+
+def new_events(record, previous=None):
+    """События, появившиеся при переходе previous -> record"""
+    events = sale_events(record)
+    if not previous or not events:
+        return events
+    seen = set(sale_events(previous))
+    return [event for event in events if event not in seen]
+
+
+class SalesRollup:
+    """
+    Инкрементальные сводки продаж: ячейка (час, автомат, parfum_id,
+    state) -> число переходов и сумма в тийинах. state 2 — оплата (по
+    perform_time), -1 и -2 — отмена до и после оплаты (по cancel_time).
+
+    record() вызывается при каждом переходе транзакции и добавляет
+    только новые события; при старте load() строит сводки одним
+    проходом по хранилищу. Ячейки хранятся колонками (массивы NumPy с
+    запасом ёмкости), запрос за любой период — векторные маски и
+    bincount, без обхода словарей.
+
+    parfum_of(record) -> parfum_id транзакции (0 — неизвестен).
+    """
+
+    def __init__(self, parfum_of):
+        self.parfum_of = parfum_of
+        self._lock = Lock()
+        self._cells = {}
+        self._device_codes = {}
+        self._devices = []
+        self._size = 0
+        self._columns = {name: self._empty(typecode, 1024) for name, typecode in COLUMNS}
+
+    def load(self, store):
+        """Сводки по всем транзакциям хранилища, включая архив"""
+        for key, record in store.history():
+            try:
+                self.record(record)
+            except (TypeError, ValueError, OverflowError) as e:
+                # Одна испорченная запись не должна мешать старту сервера
+                log.warning("⚠️ Transaction %s skipped in sales rollup: %s", key, e)
+        return self
+
+    def sync(self):
+        """Подтянуть события других процессов (у общей базы)"""
+
+    def record(self, record, previous=None):
+        for event in self._events(record, previous):
+            self._add(*event)
+
+    def _events(self, record, previous):
+        """(время, device_id, parfum_id, state, тийины) новых событий"""
+        events = new_events(record, previous)
+        if not events:
+            return []
+        device_id = record.get('device_id') or ""
+        parfum_id = self.parfum_of(record)
+        amount = record.get('amount_tiyin') or 0
+        return [(event_time, device_id, parfum_id, state, amount) for event_time, state in events]
+
+    def __len__(self):
+        return self._size
+
+    def _add(self, event_time, device_id, parfum_id, state, amount):
+        hour = event_time // HOUR_MS
+        with self._lock:
+            device = self._device_codes.get(device_id)
+            if device is None:
+                device = self._device_codes[device_id] = len(self._devices)
+                self._devices.append(device_id)
+            key = (hour, device, parfum_id, state)
+            row = self._cells.get(key)
+            columns = self._columns
+            if row is None:
+                row = self._cells[key] = self._size
+                if np is not None:
+                    if row == len(columns["hour"]):
+                        for name, column in columns.items():
+                            grown = np.zeros(len(column) * 2, dtype=column.dtype)
+                            grown[:row] = column
+                            columns[name] = grown
+                    for name, value in zip(("hour", "device", "parfum", "state"), key):
+                        columns[name][row] = value
+                else:
+                    for name, value in zip(("hour", "device", "parfum", "state", "count", "amount"), key + (0, 0)):
+                        columns[name].append(value)
+                self._size += 1
+            columns["count"][row] += 1
+            columns["amount"][row] += amount
+
+    @staticmethod
+    def _empty(typecode, capacity):
+        if np is not None:
+            return np.zeros(capacity, dtype=typecode)
+        return array.array(typecode)
+
+    def query(self, from_time=None, to_time=None, group_by=("device_id", "parfum_id"),
+              device_id=None, parfum_id=None):
+        """
+        Итоги за from_time..to_time (мс, с точностью до часа) по
+        измерениям group_by: sales, cancelled, refunds и revenue_tiyin
+        (оплаты минус возвраты). ValueError — неизвестное измерение.
+        """
+        unknown = set(group_by) - set(GROUP_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown group_by: {', '.join(sorted(unknown))}")
+        self.sync()
+        with self._lock:
+            size = self._size
+            columns = {name: column[:size] for name, column in self._columns.items()}
+            devices = list(self._devices)
+            device = self._device_codes.get(device_id, -1) if device_id is not None else None
+        hours = (None if from_time is None else from_time // HOUR_MS,
+                 None if to_time is None else to_time // HOUR_MS)
+        if np is not None:
+            groups = self._query_numpy(columns, hours, group_by, device, parfum_id)
+        else:
+            groups = self._query_loop(columns, hours, group_by, device, parfum_id)
+
+        rows = []
+        for key, totals in groups:
+            row = {}
+            for field, value in zip(group_by, key):
+                if field == "hour":
+                    value *= HOUR_MS
+                elif field == "device_id":
+                    value = devices[value]
+                row[field] = value
+            for (_, name), count in zip(STATE_FIELDS, totals):
+                row[name] = count
+            row["revenue_tiyin"] = totals[3]
+            row["revenue"] = totals[3] / 100
+            rows.append(row)
+        return rows
+
+    def _query_numpy(self, columns, hours, group_by, device, parfum_id):
+        conditions = []
+        if hours[0] is not None:
+            conditions.append(columns["hour"] >= hours[0])
+        if hours[1] is not None:
+            conditions.append(columns["hour"] <= hours[1])
+        if device is not None:
+            conditions.append(columns["device"] == device)
+        if parfum_id is not None:
+            conditions.append(columns["parfum"] == parfum_id)
+        if conditions:
+            mask = conditions[0]
+            for condition in conditions[1:]:
+                mask &= condition
+            rows = np.flatnonzero(mask)
+            columns = {name: column.take(rows) for name, column in columns.items()}
+        if not len(columns["hour"]):
+            return []
+
+        # Ключ группы — смешанная система счисления по измерениям,
+        # младший разряд — state (-2, -1, 2 -> 0, 1, 4)
+        names = {"hour": "hour", "device_id": "device", "parfum_id": "parfum"}
+        key = np.zeros(len(columns["hour"]), dtype=np.int64)
+        bases = []
+        space = 1
+        for field in group_by:
+            values = columns[names[field]]
+            low = int(values.min())
+            radix = int(values.max()) - low + 1
+            key *= radix
+            key += values
+            key -= low
+            bases.append((low, radix))
+            space *= radix
+        key *= STATE_RADIX
+        key += columns["state"]
+        key += 2
+
+        if space > DENSE_RATIO * len(key) + 1024:
+            # Разреженные группы: номера по порядку вместо ключей
+            groups, inverse = np.unique(key // STATE_RADIX, return_inverse=True)
+            key = inverse * STATE_RADIX + key % STATE_RADIX
+            space = len(groups)
+        else:
+            groups = None
+        counts = np.bincount(key, weights=columns["count"], minlength=space * STATE_RADIX).reshape(space, STATE_RADIX)
+        amounts = np.bincount(key, weights=columns["amount"], minlength=space * STATE_RADIX).reshape(space, STATE_RADIX)
+        present = np.flatnonzero(counts.any(axis=1))
+        counts = counts[present].astype(np.int64)
+        amounts = amounts[present].astype(np.int64)
+        totals = [counts[:, 4], counts[:, 1], counts[:, 0], amounts[:, 4] - amounts[:, 0]]
+
+        rest = groups[present] if groups is not None else present
+        keys = []
+        for low, radix in reversed(bases):
+            keys.append(rest % radix + low)
+            rest = rest // radix
+        keys.reverse()
+        return zip(zip(*(column.tolist() for column in keys)) if keys else [()] * len(present),
+                   zip(*(column.tolist() for column in totals)))
+
+    def _query_loop(self, columns, hours, group_by, device, parfum_id):
+        fields = {"hour": 0, "device_id": 1, "parfum_id": 2}
+        picks = [fields[field] for field in group_by]
+        groups = {}
+        for cell in zip(*(columns[name] for name, _ in COLUMNS)):
+            hour, cell_device, cell_parfum, state, count, amount = cell
+            if (hours[0] is not None and hour < hours[0]) or (hours[1] is not None and hour > hours[1]):
+                continue
+            if (device is not None and cell_device != device) or (parfum_id is not None and cell_parfum != parfum_id):
+                continue
+            totals = groups.setdefault(tuple(cell[i] for i in picks), [0, 0, 0, 0])
+            if state == 2:
+                totals[0] += count
+                totals[3] += amount
+            elif state == -1:
+                totals[1] += count
+            elif state == -2:
+                totals[2] += count
+                totals[3] -= amount
+        return sorted(groups.items())
@@ -1,127 +1,317 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import base64
 import time
 import json
 import os
-import paho.mqtt.client as mqtt
+import socket
 from functools import wraps
-from datetime import datetime
 from threading import Lock
-import random
-import string
-from dotenv import load_dotenv
-
-# Загрузка .env
-load_dotenv()
+import logging
+from dotenv import find_dotenv, load_dotenv
+from analytics import SalesRollup
+from archive import Archive, Archiver
+from auth import AuthVerifier, parse_keys
+from bus import create_bus
+from cache import ResultCache
+from cluster import PrimaryLock
+from logs import setup_logging
+from metrics import registry, timed_lock
+from outbox import MqttOutbox
+from paging import PAGE_LIMIT, PAGE_LIMIT_MAX, compress, decode_cursor, page_body, project
+from prices import PriceCatalog
+from qr import QR_AVAILABLE, packed_qr
+from scheduler import ExpiryScheduler
+from sqlstore import SqliteDatabase, SqliteOrderStore, SqliteOutbox, SqliteSalesRollup, SqliteTransactionStore
+from store import OrderStore, StripedLock, TransactionStore
+from telemetry import TelemetryIngest, summarize
 
 app = Flask(__name__)
 
 # ============ КОНФИГУРАЦИЯ ============
-# Payme credentials
-MERCHANT_ID = os.getenv("MERCHANT_ID", "")
-SECRET_KEY = os.getenv("PAYME_KEY", "")
-TEST_KEY = os.getenv("PAYME_TEST_KEY", "")
-
-# MQTT настройки (как в твоём Node.js)
-MQTT_BROKER = os.getenv("MQTT_BROKER", "broker.hivemq.com")
-MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
-MQTT_PROTOCOL = os.getenv("MQTT_PROTOCOL", "mqtt")
-
-# Режим тестирования
-TEST_MODE = os.getenv("TEST_MODE", "true").lower() == "true"
-DEBUG_ALLOW_ANY = os.getenv("DEBUG_ALLOW_ANY", "0") == "1"
-
-# Файл для хранения транзакций
-PROCESSED_FILE = os.getenv("PROCESSED_FILE", "processed.json")
-
-# Минимальная сумма в сумах
-MIN_AMOUNT_UZS = 100
+def load_config(overrides=None):
+    """
+    Настройки сервера из окружения (.env загружает create_app). Ключи —
+    имена глобальных настроек модуля; overrides подменяют значения
+    (тесты, бенчмарк), неизвестный ключ — ошибка.
+    """
+    config = dict(
+        # Payme credentials (при ротации ключей: PAYME_KEY=новый,старый)
+        MERCHANT_ID=os.getenv("MERCHANT_ID", ""),
+        SECRET_KEY=os.getenv("PAYME_KEY", ""),
+        TEST_KEY=os.getenv("PAYME_TEST_KEY", ""),
+
+        # MQTT настройки (как в твоём Node.js)
+        MQTT_BROKER=os.getenv("MQTT_BROKER", "broker.hivemq.com"),
+        MQTT_PORT=int(os.getenv("MQTT_PORT", "1883")),
+        MQTT_PROTOCOL=os.getenv("MQTT_PROTOCOL", "mqtt"),
+        # Постоянный client id: брокер узнаёт переподключившийся сервер
+        # (и главного воркера, перехватившего роль), а не копит сессии
+        MQTT_CLIENT_ID=os.getenv("MQTT_CLIENT_ID") or f"payme-server-{socket.gethostname()}",
+        MQTT_MAX_INFLIGHT=int(os.getenv("MQTT_MAX_INFLIGHT", "20")),
+        MQTT_ACK_TIMEOUT=int(os.getenv("MQTT_ACK_TIMEOUT", "30")),
+        # Транспорт сообщений: mqtt (брокер) или local (в процессе)
+        MESSAGE_BUS=os.getenv("MESSAGE_BUS", "mqtt"),
+
+        # Режим тестирования
+        TEST_MODE=os.getenv("TEST_MODE", "true").lower() == "true",
+        DEBUG_ALLOW_ANY=os.getenv("DEBUG_ALLOW_ANY", "0") == "1",
+
+        # Файл для хранения транзакций
+        PROCESSED_FILE=os.getenv("PROCESSED_FILE", "processed.json"),
+        PROCESSED_SNAPSHOT_MIN=int(os.getenv("PROCESSED_SNAPSHOT_MIN", "1000")),
+        TRANSACTION_LOCK_STRIPES=int(os.getenv("TRANSACTION_LOCK_STRIPES", "64")),
+
+        # Заказы автоматов и каталог цен
+        ORDERS_FILE=os.getenv("ORDERS_FILE", "orders.json"),
+        ORDERS_SNAPSHOT_MIN=int(os.getenv("ORDERS_SNAPSHOT_MIN", "1000")),
+        PRICES_FILE=os.getenv("PRICES_FILE", "prices.json"),
+
+        # Хранилище: journal (файлы + журнал, один процесс) или sqlite
+        # (WAL, общая база для нескольких воркеров — см. gunicorn.conf.py)
+        STORE_BACKEND=os.getenv("STORE_BACKEND", "journal"),
+        DATABASE_FILE=os.getenv("DATABASE_FILE", "payme.db"),
+        PROCESSED_FSYNC=os.getenv("PROCESSED_FSYNC", "0") == "1",
+
+        # Журнал неотправленных MQTT-сообщений; fsync до ответа Payme
+        # (с sqlite его заменяет PROCESSED_FSYNC)
+        OUTBOX_FILE=os.getenv("OUTBOX_FILE", "outbox.log"),
+        OUTBOX_FSYNC=os.getenv("OUTBOX_FSYNC", "1") == "1",
+
+        # .env, который AuthVerifier перечитывает при ротации ключей
+        ENV_FILE=os.getenv("ENV_FILE") or find_dotenv(),
+
+        # Логирование: LOG_FORMAT=json для сборщика логов, DEBUG можно сэмплировать
+        LOG_LEVEL=os.getenv("LOG_LEVEL", "INFO"),
+        LOG_FORMAT=os.getenv("LOG_FORMAT", "text"),
+        LOG_DEBUG_SAMPLE=float(os.getenv("LOG_DEBUG_SAMPLE", "1.0")),
+
+        # Минимальная сумма в сумах; максимальная — для заказа автомата
+        MIN_AMOUNT_UZS=100,
+        MAX_AMOUNT_UZS=int(os.getenv("MAX_AMOUNT_UZS", "10000000")),
+
+        # Через сколько секунд неоплаченный заказ считается просроченным
+        # (автомат сам сдаётся через 5 минут + 9 секунд обратного отсчёта;
+        # кнопка во время отсчёта снова показывает QR и продлевает заказ
+        # через /api/extend-perfume-order). Истёкший заказ Payme не оплатит
+        ORDER_TTL_SEC=int(os.getenv("ORDER_TTL_SEC", "330")),
+
+        # Payme: транзакция в state 1 отменяется по таймауту через 12 часов
+        TRANSACTION_TIMEOUT_MS=int(os.getenv("TRANSACTION_TIMEOUT_MS", str(12 * 60 * 60 * 1000))),
+
+        # Сколько транзакций GetStatement сериализуется за один chunk ответа
+        STATEMENT_CHUNK_SIZE=int(os.getenv("STATEMENT_CHUNK_SIZE", "500")),
+
+        # Готовые ответы для повторов Payme (0 — без кэша)
+        RESULT_CACHE_SIZE=int(os.getenv("RESULT_CACHE_SIZE", "10000")),
+
+        # Телеметрия автоматов: каталог сегментов и очередь пачек до разбора
+        TELEMETRY_DIR=os.getenv("TELEMETRY_DIR", "telemetry"),
+        TELEMETRY_QUEUE=int(os.getenv("TELEMETRY_QUEUE", "10000")),
+        TELEMETRY_FSYNC=os.getenv("TELEMETRY_FSYNC", "0") == "1",
+
+        # Архив завершённых транзакций и заказов (STORE_BACKEND=journal):
+        # старше ARCHIVE_AFTER_DAYS дней уходят из памяти в сжатые сегменты
+        # (0 — не архивировать)
+        ARCHIVE_DIR=os.getenv("ARCHIVE_DIR", "archive"),
+        ARCHIVE_AFTER_DAYS=float(os.getenv("ARCHIVE_AFTER_DAYS", "30")),
+        ARCHIVE_INTERVAL_SEC=int(os.getenv("ARCHIVE_INTERVAL_SEC", "3600")),
+        ARCHIVE_MIN_RECORDS=int(os.getenv("ARCHIVE_MIN_RECORDS", "1000")),
+    )
+    unknown = set(overrides or ()) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+    config.update(overrides or {})
+    return config
+
+# ============ ЛОГИРОВАНИЕ ============
+# Настраивается в create_app: вывод в фоновом потоке, ключи Payme маскируются
+log = logging.getLogger("payme")
+
+# ============ МЕТРИКИ ============
+# Латентность по endpoint'ам и методам Payme, ожидание блокировок,
+# время записи журналов (store.py) и доставки MQTT (outbox.py) — /metrics
+PAYME_METHODS = (
+    'CheckPerformTransaction', 'CreateTransaction', 'PerformTransaction',
+    'CancelTransaction', 'CheckTransaction', 'GetStatement'
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_seconds", "HTTP request handling time", ["endpoint", "method", "status"])
+PAYME_METHOD_SECONDS = registry.histogram(
+    "payme_method_seconds", "Payme JSON-RPC method handling time", ["method"])
+LOCK_WAIT_SECONDS = registry.histogram(
+    "lock_wait_seconds", "Time spent waiting to acquire a lock", ["lock"])
+MQTT_ENQUEUE_SECONDS = registry.histogram(
+    "mqtt_enqueue_seconds", "publish_mqtt time (outbox journal append)", ["context"])
+TRANSACTION_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("transaction")
+ACCOUNT_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("account")
+ORDER_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("order")
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    # Для GetStatement время — до начала потоковой отдачи тела
+    started = g.pop('started', None)
+    if started is not None and request.url_rule is not None:
+        elapsed = time.perf_counter() - started
+        HTTP_REQUEST_SECONDS.labels(request.url_rule.rule, request.method, response.status_code).observe(elapsed)
+        rpc_method = g.pop('rpc_method', None)
+        if rpc_method:
+            PAYME_METHOD_SECONDS.labels(rpc_method).observe(elapsed)
+    return response
 
 # ============ ХРАНИЛИЩЕ ТРАНЗАКЦИЙ ============
-transactions_lock = Lock()
+# Открываются в create_app (см. open_storage)
+database = None
+transactions = None
+transaction_locks = None
+account_lock = None
+
+# Только один процесс держит MQTT-соединение и отправляет outbox
+primary = None
+
+# Перенос старых завершённых записей в архив (только journal, см. open_storage)
+archiver = None
+
+# Сроки заказов и транзакций: куча в памяти, без периодических проходов.
+# Поток планировщика запускает start_background()
+expiry = ExpiryScheduler()
+
+def open_storage():
+    """Хранилища транзакций и заказов по STORE_BACKEND; снимки читаются сразу"""
+    global database, transactions, transaction_locks, account_lock, order_store, order_locks, primary, archiver
+
+    if STORE_BACKEND == "sqlite":
+        # Несколько процессов: переходы состояний — короткие транзакции
+        # BEGIN IMMEDIATE, атомарные вместе с записью в outbox
+        database = SqliteDatabase(DATABASE_FILE, fsync=PROCESSED_FSYNC)
+        transaction_locks = database.write_lock
+        account_lock = database.write_lock
+        transactions = SqliteTransactionStore(database).load()
+        order_store = SqliteOrderStore(database).load()
+        order_locks = database.write_lock
+        primary = PrimaryLock(DATABASE_FILE + ".primary")
+        return
+
+    # Переходы состояний одной транзакции сериализуются по её id,
+    # разные транзакции обрабатываются параллельно
+    transaction_locks = StripedLock(TRANSACTION_LOCK_STRIPES)
+    # Короткая секция для уникальности pending-транзакции на account
+    account_lock = Lock()
+
+    # Состояние в памяти, изменения дописываются в журнал PROCESSED_FILE.log
+    # Завершённые записи старше ARCHIVE_AFTER_DAYS — в сегментах ARCHIVE_DIR
+    transactions = TransactionStore(
+        PROCESSED_FILE,
+        snapshot_min=PROCESSED_SNAPSHOT_MIN,
+        fsync=PROCESSED_FSYNC,
+        archive=Archive(os.path.join(ARCHIVE_DIR, "transactions")).load()
+    ).load()
+
+    # Заказы в памяти с индексами по device_id и status, изменения — в журнал
+    order_store = OrderStore(
+        ORDERS_FILE,
+        snapshot_min=ORDERS_SNAPSHOT_MIN,
+        fsync=PROCESSED_FSYNC,
+        archive=Archive(os.path.join(ARCHIVE_DIR, "orders")).load()
+    ).load()
+    order_locks = StripedLock()
+    if ARCHIVE_AFTER_DAYS > 0:
+        archiver = Archiver([transactions, order_store], int(ARCHIVE_AFTER_DAYS * 86400000),
+                            ARCHIVE_INTERVAL_SEC, ARCHIVE_MIN_RECORDS)
 
-def load_transactions():
-    """Загрузка транзакций из файла"""
-    try:
-        if os.path.exists(PROCESSED_FILE):
-            with open(PROCESSED_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки транзакций: {e}")
-    return {}
+# ============ MQTT SETUP (как в твоём Node.js) ============
+# MESSAGE_BUS=local — pub/sub внутри процесса, без брокера
+# (бенчмарки, нагрузочные тесты, симуляторы автоматов).
+# Шина создаётся в create_app, подключается в start_background()
+message_bus = None
+mqtt_outbox = None
+mqtt_url = ""
+mqtt_connected = False
 
-def save_transactions(data):
-    """Сохранение транзакций в файл"""
-    try:
-        with open(PROCESSED_FILE, 'w') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения транзакций: {e}")
+def open_bus():
+    """Шина и outbox без подключения: неотправленное восстанавливается из хранилища"""
+    global message_bus, mqtt_outbox, mqtt_url
 
-# ============ MQTT SETUP (как в твоём Node.js) ============
-client_id = 'payme-server-' + ''.join(random.choices(string.hexdigits[:16], k=8))
-mqtt_url = f"{MQTT_PROTOCOL}://{MQTT_BROKER}"
+    message_bus = create_bus(
+        MESSAGE_BUS,
+        broker=MQTT_BROKER, port=MQTT_PORT, client_id=MQTT_CLIENT_ID, protocol=MQTT_PROTOCOL
+    )
+    mqtt_url = message_bus.url
 
-print(f"🔗 Connecting to MQTT: {mqtt_url}")
+    outbox_options = dict(max_inflight=MQTT_MAX_INFLIGHT, ack_timeout=MQTT_ACK_TIMEOUT)
+    if database is not None:
+        # Очередь в базе: пишут все воркеры, отправляет главный
+        mqtt_outbox = SqliteOutbox(message_bus, database, **outbox_options).load()
+    else:
+        mqtt_outbox = MqttOutbox(message_bus, OUTBOX_FILE, fsync=OUTBOX_FSYNC, **outbox_options).load()
 
-mqtt_client = mqtt.Client(client_id=client_id)
-mqtt_connected = False
+    message_bus.on_connect = on_connect
+    message_bus.on_disconnect = on_disconnect
+    message_bus.on_message = on_message
+    message_bus.on_publish = mqtt_outbox.on_publish
+    message_bus.subscribe(f"telemetry/{MERCHANT_ID}/+", on_telemetry, qos=0)
 
-def on_connect(client, userdata, flags, rc):
+def on_connect():
     global mqtt_connected
-    if rc == 0:
-        mqtt_connected = True
-        print(f"✅ MQTT connected to {mqtt_url}")
-        print(f"📡 MQTT topics:", {
-            "payments": f"payments/{MERCHANT_ID}",
-            "control": f"control/{MERCHANT_ID}",
-            "config": f"config/{MERCHANT_ID}"
-        })
-    else:
-        mqtt_connected = False
-        print(f"❌ MQTT connection failed with code {rc}")
+    mqtt_connected = True
+    mqtt_outbox.on_connect()
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect():
     global mqtt_connected
     mqtt_connected = False
-    print("🔒 MQTT connection closed")
+    mqtt_outbox.on_disconnect()
 
-def on_message(client, userdata, msg):
-    print(f"📨 MQTT message received: {msg.topic} -> {msg.payload.decode()}")
+def on_message(topic, payload):
+    log.info("📨 MQTT message received: %s", topic, extra={"payload": payload.decode(errors='replace')})
 
-mqtt_client.on_connect = on_connect
-mqtt_client.on_disconnect = on_disconnect
-mqtt_client.on_message = on_message
-
-# Подключение к MQTT
-try:
-    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    mqtt_client.loop_start()
-except Exception as e:
-    print(f"❌ MQTT initial connection error: {e}")
+def on_telemetry(topic, payload):
+    # Сетевой поток paho: только в очередь, разбор — в потоке телеметрии
+    telemetry.submit(payload, device_id=topic.rsplit('/', 1)[-1])
 
 # ============ MQTT PUBLISH (как в твоём Node.js) ============
-def publish_mqtt(topic, payload, context="unknown"):
-    """Отправка сообщения через MQTT (логика из твоего Node.js)"""
-    print(f"\n📡 MQTT [{context}]: Attempting to publish to {topic}")
-    print(f"📡 MQTT [{context}]: Payload:", payload)
-    print(f"📡 MQTT [{context}]: Connected: {mqtt_connected}")
-
-    if not mqtt_connected:
-        print(f"❌ MQTT [{context}]: Not connected, cannot publish to {topic}")
-        return False
-
-    message = json.dumps(payload, ensure_ascii=False)
-
-    result = mqtt_client.publish(topic, message, qos=1)
-
-    if result.rc == 0:
-        print(f"✅ MQTT [{context}]: Successfully published to {topic}")
-        print(f"✅ MQTT [{context}]: Message: {message}")
-        return True
+def publish_mqtt(topic, payload, context="unknown", key=None, retain=False):
+    """
+    Постановка сообщения в MQTT outbox. Сообщение сохраняется на диск
+    сразу, отправка и повторы — в фоновом потоке (см. MqttOutbox).
+    key — ключ дедупликации, например "<transaction_id>:confirmed".
+    """
+    with MQTT_ENQUEUE_SECONDS.labels(context).time():
+        queued = mqtt_outbox.enqueue(topic, payload, key=key, retain=retain)
+    if queued:
+        log.debug("📡 MQTT queued", extra={"context": context, "topic": topic})
     else:
-        print(f"❌ MQTT [{context}]: Publish error to {topic}: rc={result.rc}")
-        return False
+        log.debug("↩️ MQTT duplicate skipped", extra={"context": context, "key": key})
+    return queued
+
+def payments_topic(device_id=None):
+    """Топик событий оплаты: персональный для автомата, общий — если автомат неизвестен"""
+    if device_id:
+        return f"payments/{MERCHANT_ID}/{device_id}"
+    return f"payments/{MERCHANT_ID}"
+
+def resolve_order(account):
+    """Заказ автомата по ac.order_id из account (None для старых QR)"""
+    order_id = (account or {}).get('order_id')
+    if order_id is None:
+        return None
+    return order_store.get(str(order_id))
+
+def order_error(account):
+    """
+    Почему заказ из account нельзя оплатить: не найден или уже не ждёт
+    оплаты (истёк, отменён, оплачен). None — можно (или account без order_id)
+    """
+    if 'order_id' not in account:
+        return None
+    order = resolve_order(account)
+    if order is None:
+        return "Order not found"
+    if order.get('status') != 'pending':
+        return f"Order is {order.get('status')}"
+    return None
 
 # ============ JSON-RPC HELPERS ============
 def jsonrpc_success(req_id, result):
@@ -133,6 +323,49 @@ def jsonrpc_error(req_id, code, message, data=None):
         error["data"] = data
     return {"jsonrpc": "2.0", "id": req_id, "error": error}
 
+def jsonrpc_stream(req_id, key, items, chunk_size=None):
+    """
+    Потоковый JSON-RPC ответ {"result": {key: [...]}}: элементы items
+    сериализуются пачками по chunk_size (по умолчанию STATEMENT_CHUNK_SIZE),
+    весь список в памяти не строится.
+    """
+    chunk_size = chunk_size or STATEMENT_CHUNK_SIZE
+
+    def generate():
+        yield f'{{"jsonrpc":"2.0","id":{json.dumps(req_id)},"result":{{"{key}":['
+        chunk = []
+        first = True
+        for item in items:
+            chunk.append(json.dumps(item, ensure_ascii=False))
+            if len(chunk) >= chunk_size:
+                yield ('' if first else ',') + ','.join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+        yield ']}}'
+    return Response(generate(), mimetype='application/json')
+
+# Повторы Payme по тому же id получают ответ из кэша (создаётся в create_app)
+RESULT_CACHE_METHODS = ('CheckTransaction', 'CreateTransaction', 'PerformTransaction', 'CancelTransaction')
+result_cache = None
+
+def jsonrpc_result_body(req_id, body):
+    """JSON-RPC ответ с уже сериализованным result"""
+    return Response(f'{{"jsonrpc":"2.0","id":{json.dumps(req_id)},"result":{body}}}',
+                    mimetype='application/json')
+
+def cached_success(req_id, method, transaction_id, state, result):
+    """Успешный ответ; повтор метода для той же версии записи возьмёт его из result_cache"""
+    return jsonrpc_result_body(req_id, result_cache.put((method, transaction_id, state), result))
+
+def cached_result(method, transaction_id):
+    """Готовый result для текущей версии (state) транзакции или None"""
+    state = transactions.state(transaction_id)
+    if state is None:
+        return None
+    return result_cache.get((method, transaction_id, state))
+
 # ============ КОДЫ ОШИБОК PAYME ============
 class PaymeError:
     INVALID_AMOUNT = -31001
@@ -146,7 +379,53 @@ class PaymeError:
     UNAUTHORIZED = -32504
     SYSTEM_ERROR = -32400
 
+# Причина отмены Payme: транзакция не выполнена вовремя
+CANCEL_REASON_TIMEOUT = 4
+
+def cancel_transaction_record(transaction_id, rec, cancel_state, reason, context):
+    """
+    Отмена транзакции: новая версия записи + событие cancelled для автомата.
+    Вызывается под transaction_locks.lock(transaction_id).
+    """
+    cancel_time = int(time.time() * 1000)
+    previous = rec
+    rec = dict(rec)
+    rec['status'] = "cancelled"
+    rec['cancel_time'] = cancel_time
+    rec['state'] = cancel_state
+    rec['reason'] = reason
+    transactions.put(transaction_id, rec)
+
+    # MQTT для отмены
+    topic = payments_topic(rec.get('device_id'))
+    payload = {
+        "status": "cancelled",
+        "amount": rec.get('amount'),
+        "amount_tiyin": rec.get('amount_tiyin'),
+        "currency": "UZS",
+        "transaction_id": transaction_id,
+        "order_id": rec.get('order_id'),
+        "reason": reason,
+        "time": cancel_time
+    }
+    publish_mqtt(topic, payload, context, key=f"{transaction_id}:cancelled")
+    record_sale(transaction_id, rec, previous)
+    return rec
+
+def expire_transaction(transaction_id):
+    """Отмена транзакции, не выполненной за TRANSACTION_TIMEOUT_MS"""
+    with timed_lock(transaction_locks.lock(transaction_id), TRANSACTION_LOCK_WAIT):
+        rec = transactions.get(transaction_id)
+        if rec is None or rec.get('state') != 1:
+            return
+        cancel_transaction_record(transaction_id, rec, -1, CANCEL_REASON_TIMEOUT, "ExpireTransaction")
+        log.info("⏰ Transaction expired", extra={"transaction_id": transaction_id})
+
 # ============ AUTH MIDDLEWARE (как в твоём Node.js) ============
+# Заголовки активных ключей собраны один раз (в create_app); правка .env
+# подхватывается сама
+auth_verifier = None
+
 def check_auth(f):
     """Проверка авторизации от Payme (логика из твоего Node.js)"""
     @wraps(f)
@@ -159,50 +438,14 @@ def check_auth(f):
             ""
         )
 
-        print("===== AUTH DEBUG =====")
-        print(f"Raw authorization header: {candidate[:50]}..." if len(candidate) > 50 else f"Raw authorization header: {candidate}")
-
-        # Handle Basic Auth (Payme format)
-        if candidate.lower().startswith("basic "):
-            try:
-                base64_credentials = candidate[6:]
-                credentials = base64.b64decode(base64_credentials).decode('utf-8')
-                print(f"Decoded Basic Auth: {credentials[:20]}..." if len(credentials) > 20 else f"Decoded Basic Auth: {credentials}")
-
-                parts = credentials.split(':')
-                if len(parts) >= 2:
-                    candidate = parts[1]
-                    print(f"Extracted password/key: {candidate[:10]}..." if candidate else "empty")
-            except Exception as e:
-                print(f"Failed to decode Basic Auth: {e}")
-                candidate = ""
-        # Handle Bearer token
-        elif candidate.lower().startswith("bearer "):
-            candidate = candidate[7:]
-
-        candidate = candidate.strip()
-
-        # Query param fallback for debug
-        if not candidate and request.args.get('key'):
-            candidate = request.args.get('key', '').strip()
-
         # Debug bypass
         if DEBUG_ALLOW_ANY:
-            print("DEBUG_ALLOW_ANY=1 — авторизация пропущена (temporary).")
+            log.warning("DEBUG_ALLOW_ANY=1 — авторизация пропущена (temporary).")
             return f(*args, **kwargs)
 
-        # Get expected key
-        expected_key = TEST_KEY if TEST_MODE else SECRET_KEY
-
-        # Extract key from "Payme:KEY" format if needed
-        if ':' in expected_key:
-            expected_key = expected_key.split(':')[1]
-
-        print(f"Final candidate token: {candidate[:20]}..." if len(candidate) > 20 else f"Final candidate token: {candidate}")
-        print(f"Expected key: {expected_key[:20]}..." if len(expected_key) > 20 else f"Expected key: {expected_key}")
-
-        if not candidate or candidate != expected_key:
-            print("❌ Auth failed: token mismatch or missing.")
+        # Query param fallback for debug
+        if not auth_verifier.verify(candidate, request.args.get('key')):
+            log.warning("❌ Auth failed: token mismatch or missing.")
             return jsonify(jsonrpc_error(
                 request.json.get('id') if request.json else None,
                 PaymeError.UNAUTHORIZED,
@@ -210,7 +453,6 @@ def check_auth(f):
                 {"ru": "Недостаточно привилегий", "uz": "Yetarli imtiyozlar yo'q"}
             ))
 
-        print("✅ Auth successful!")
         return f(*args, **kwargs)
     return decorated
 
@@ -226,7 +468,8 @@ def payme_webhook():
     method = body.get('method')
     params = body.get('params', {})
 
-    print(f"\n▶️ Payme API call: {method} (ID: {req_id})")
+    log.debug("▶️ Payme API call", extra={"method": method, "req_id": req_id})
+    g.rpc_method = method if method in PAYME_METHODS else "unknown"
 
     if not method:
         return jsonify(jsonrpc_error(req_id, -32600, "Invalid request (no method)"))
@@ -249,44 +492,99 @@ def payme_webhook():
         amount_tiyin = None
 
     try:
-        with transactions_lock:
-            processed = load_transactions()
-
-            # === CheckPerformTransaction ===
-            if method == 'CheckPerformTransaction':
-                if amount_tiyin is None:
-                    return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing amount"))
-
-                amount_sum = amount_tiyin / 100
-                print(f"🔍 CheckPerformTransaction: amount={amount_sum} UZS ({amount_tiyin} tiyin), account={params.get('account')}")
-
-                if amount_sum < MIN_AMOUNT_UZS:
-                    return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_AMOUNT, f"Minimum amount is {MIN_AMOUNT_UZS} UZS."))
-
-                # Валидация account
-                if not params.get('account') or not isinstance(params.get('account'), dict):
-                    return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_ACCOUNT, "Invalid account parameters"))
-
-                # Items для чека
-                items = [{
-                    "title": "Оплата товаров/услуг",
-                    "price": amount_tiyin,
-                    "count": 1,
-                    "code": "007",
-                    "package_code": "12345678901234",
-                    "vat_percent": 15
-                }]
-
-                return jsonify(jsonrpc_success(req_id, {
-                    "allow": True,
-                    "detail": {
-                        "receipt_type": 0,
-                        "items": items
+        # Чтение идёт без блокировок: записи в хранилище неизменяемы,
+        # индексы публикуются атомарно (см. TransactionStore)
+
+        # Повтор уже выполненной операции — готовый ответ без блокировки
+        # и сериализации (CreateTransaction — только с допустимой суммой)
+        if transaction_id and method in RESULT_CACHE_METHODS and (
+                method != 'CreateTransaction' or
+                (amount_tiyin is not None and amount_tiyin / 100 >= MIN_AMOUNT_UZS)):
+            body = cached_result(method, transaction_id)
+            if body is not None:
+                return jsonrpc_result_body(req_id, body)
+
+        # === CheckPerformTransaction ===
+        if method == 'CheckPerformTransaction':
+            if amount_tiyin is None:
+                return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing amount"))
+
+            amount_sum = amount_tiyin / 100
+            log.debug("🔍 CheckPerformTransaction", extra={"amount_tiyin": amount_tiyin, "account": params.get('account')})
+
+            if amount_sum < MIN_AMOUNT_UZS:
+                return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_AMOUNT, f"Minimum amount is {MIN_AMOUNT_UZS} UZS."))
+
+            # Валидация account
+            if not params.get('account') or not isinstance(params.get('account'), dict):
+                return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_ACCOUNT, "Invalid account parameters"))
+
+            error = order_error(params['account'])
+            if error:
+                return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_ACCOUNT, error))
+
+            # Items для чека
+            items = [{
+                "title": "Оплата товаров/услуг",
+                "price": amount_tiyin,
+                "count": 1,
+                "code": "007",
+                "package_code": "12345678901234",
+                "vat_percent": 15
+            }]
+
+            return jsonify(jsonrpc_success(req_id, {
+                "allow": True,
+                "detail": {
+                    "receipt_type": 0,
+                    "items": items
+                }
+            }))
+
+        # === CheckTransaction ===
+        if method == 'CheckTransaction':
+            if not transaction_id:
+                return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing transaction id"))
+
+            t = transactions.get(transaction_id)
+            if t is None:
+                return jsonify(jsonrpc_error(req_id, PaymeError.TRANSACTION_NOT_FOUND, "Transaction not found."))
+
+            return cached_success(req_id, method, transaction_id, t.get('state'), {
+                "create_time": t.get('create_time'),
+                "perform_time": t.get('perform_time', 0),
+                "cancel_time": t.get('cancel_time', 0),
+                "transaction": transaction_id,
+                "state": t.get('state'),
+                "reason": t.get('reason')
+            })
+
+        # === GetStatement ===
+        if method == 'GetStatement':
+            from_time = params.get('from', 0)
+            to_time = params.get('to', int(time.time() * 1000))
+
+            def statement_items(found):
+                for tid, tx in found:
+                    yield {
+                        "id": tid,
+                        "time": tx.get('create_time'),
+                        "amount": tx.get('amount_tiyin', int(tx.get('amount', 0) * 100)),
+                        "account": tx.get('account', {}),
+                        "create_time": tx.get('create_time'),
+                        "perform_time": tx.get('perform_time', 0),
+                        "cancel_time": tx.get('cancel_time', 0),
+                        "transaction": tid,
+                        "state": tx.get('state'),
+                        "reason": tx.get('reason')
                     }
-                }))
 
+            found = transactions.range_by_create_time(from_time, to_time)
+            return jsonrpc_stream(req_id, "transactions", statement_items(found))
+
+        with timed_lock(transaction_locks.lock(transaction_id), TRANSACTION_LOCK_WAIT):
             # === CreateTransaction ===
-            elif method == 'CreateTransaction':
+            if method == 'CreateTransaction':
                 if not transaction_id or amount_tiyin is None:
                     return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing transaction id or amount"))
 
@@ -296,37 +594,44 @@ def payme_webhook():
                     return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_AMOUNT, f"Invalid amount: minimum is {MIN_AMOUNT_UZS} UZS"))
 
                 # Если транзакция с таким ID уже существует - вернуть её данные (идемпотентность)
-                if transaction_id in processed:
-                    tr = processed[transaction_id]
-                    return jsonify(jsonrpc_success(req_id, {
+                tr = transactions.get(transaction_id)
+                if tr is not None:
+                    return cached_success(req_id, method, transaction_id, tr['state'], {
                         "create_time": tr['create_time'],
                         "transaction": transaction_id,
                         "state": tr['state']
-                    }))
+                    })
 
                 account = params.get('account', {})
-
-                # Проверка: есть ли pending транзакция для этого аккаунта (ДРУГАЯ транзакция)
-                for tid, tx in processed.items():
-                    if tx.get('state') == 1 and tx.get('account') == account:
+                error = order_error(account)
+                if error:
+                    return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_ACCOUNT, error))
+                order = resolve_order(account) or {}
+
+                with timed_lock(account_lock, ACCOUNT_LOCK_WAIT):
+                    # Проверка: есть ли pending транзакция для этого аккаунта (ДРУГАЯ транзакция)
+                    if transactions.pending_for_account(account):
                         # Уже есть ожидающая транзакция для этого аккаунта
                         return jsonify(jsonrpc_error(req_id, PaymeError.ACCOUNT_PENDING, "Account has pending transaction"))
 
-                # Создаём новую транзакцию
-                create_time = int(time.time() * 1000)
-                processed[transaction_id] = {
-                    "status": "created",
-                    "state": 1,
-                    "amount": amount_sum,
-                    "amount_tiyin": amount_tiyin,
-                    "create_time": create_time,
-                    "account": account,
-                    "payme_raw": params
-                }
-                save_transactions(processed)
+                    # Создаём новую транзакцию
+                    create_time = int(time.time() * 1000)
+                    transactions.put(transaction_id, {
+                        "status": "created",
+                        "state": 1,
+                        "amount": amount_sum,
+                        "amount_tiyin": amount_tiyin,
+                        "create_time": create_time,
+                        "account": account,
+                        "order_id": account.get('order_id'),
+                        "device_id": order.get('device_id'),
+                        "parfum_id": order.get('parfum_id'),
+                        "payme_raw": params
+                    })
+                expiry.schedule("transaction", transaction_id, create_time + TRANSACTION_TIMEOUT_MS)
 
                 # MQTT publish
-                topic = f"payments/{MERCHANT_ID}"
+                topic = payments_topic(order.get('device_id'))
                 payload = {
                     "status": "created",
                     "transaction_id": transaction_id,
@@ -335,95 +640,98 @@ def payme_webhook():
                     "account": account,
                     "time": create_time
                 }
-                publish_mqtt(topic, payload, "CreateTransaction")
+                publish_mqtt(topic, payload, "CreateTransaction", key=f"{transaction_id}:created")
 
-                return jsonify(jsonrpc_success(req_id, {
+                return cached_success(req_id, method, transaction_id, 1, {
                     "create_time": create_time,
                     "transaction": transaction_id,
                     "state": 1
-                }))
+                })
 
             # === PerformTransaction ===
             elif method == 'PerformTransaction':
                 if not transaction_id:
                     return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing transaction id"))
 
-                if transaction_id not in processed:
+                record = transactions.get(transaction_id)
+                if record is None:
                     return jsonify(jsonrpc_error(req_id, PaymeError.TRANSACTION_NOT_FOUND, "Transaction not found."))
 
-                record = processed[transaction_id]
-
                 if record.get('state') == 2:
                     # Уже выполнена
-                    return jsonify(jsonrpc_success(req_id, {
+                    return cached_success(req_id, method, transaction_id, 2, {
                         "perform_time": record['perform_time'],
                         "transaction": transaction_id,
                         "state": 2,
                         "receivers": None
-                    }))
+                    })
 
                 if record.get('state') != 1:
                     return jsonify(jsonrpc_error(req_id, PaymeError.CANT_PERFORM, "Cannot perform transaction in current state."))
 
-                # Выполняем транзакцию
+                # Таймаут мог истечь раньше, чем до записи дошёл планировщик
                 perform_time = int(time.time() * 1000)
+                if perform_time - record.get('create_time', perform_time) > TRANSACTION_TIMEOUT_MS:
+                    cancel_transaction_record(transaction_id, record, -1, CANCEL_REASON_TIMEOUT, "PerformTransaction")
+                    return jsonify(jsonrpc_error(req_id, PaymeError.CANT_PERFORM, "Transaction timed out."))
+
+                # Выполняем транзакцию
+                previous = record
+                record = dict(record)
                 record['status'] = "performed"
                 record['perform_time'] = perform_time
                 record['state'] = 2
-                processed[transaction_id] = record
-                save_transactions(processed)
+                transactions.put(transaction_id, record)
+                mark_order_paid(record.get('order_id'), transaction_id)
 
-                print(f"""
-╔══════════════════════════════════════════════════════╗
-║           💰 ОПЛАТА УСПЕШНО ПРОШЛА! 💰              ║
-╠══════════════════════════════════════════════════════╣
-║  Сумма: {record['amount']:,.0f} сум
-║  ID транзакции: {transaction_id}
-║  Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-╚══════════════════════════════════════════════════════╝
-""")
 
                 # >>> MQTT - АКТИВАЦИЯ АВТОМАТА <<<
-                topic = f"payments/{MERCHANT_ID}"
+                # Только автомат, создавший заказ (общий топик — для старых QR без order_id)
+                topic = payments_topic(record.get('device_id'))
                 payload = {
                     "status": "confirmed",
                     "amount": record['amount'],
                     "amount_tiyin": record['amount_tiyin'],
                     "currency": "UZS",
                     "transaction_id": transaction_id,
+                    "order_id": record.get('order_id'),
                     "account": record.get('account', {}),
                     "time": perform_time
                 }
-                publish_mqtt(topic, payload, "PerformTransaction")
+                publish_mqtt(topic, payload, "PerformTransaction", key=f"{transaction_id}:confirmed")
+                record_sale(transaction_id, record, previous)
 
-                print(f"✅ Transaction performed: {transaction_id}")
+                log.info("💰 Transaction performed", extra={
+                    "transaction_id": transaction_id,
+                    "amount": record['amount'],
+                    "order_id": record.get('order_id')
+                })
 
-                return jsonify(jsonrpc_success(req_id, {
+                return cached_success(req_id, method, transaction_id, 2, {
                     "perform_time": perform_time,
                     "transaction": transaction_id,
                     "state": 2,
                     "receivers": None
-                }))
+                })
 
             # === CancelTransaction ===
             elif method == 'CancelTransaction':
                 if not transaction_id:
                     return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing transaction id"))
 
-                if transaction_id not in processed:
+                rec = transactions.get(transaction_id)
+                if rec is None:
                     return jsonify(jsonrpc_error(req_id, PaymeError.TRANSACTION_NOT_FOUND, "Transaction not found."))
 
-                rec = processed[transaction_id]
-
                 # Идемпотентность: если уже отменена
                 if rec.get('state') in [-1, -2]:
-                    print(f"↩️ Idempotent CancelTransaction: {transaction_id} (already canceled)")
-                    return jsonify(jsonrpc_success(req_id, {
+                    log.debug("↩️ Idempotent CancelTransaction", extra={"transaction_id": transaction_id})
+                    return cached_success(req_id, method, transaction_id, rec['state'], {
                         "cancel_time": rec['cancel_time'],
                         "transaction": transaction_id,
                         "state": rec['state'],
                         "receivers": None
-                    }))
+                    })
 
                 # Определяем state для отмены
                 if rec.get('state') == 1:
@@ -433,87 +741,54 @@ def payme_webhook():
                 else:
                     return jsonify(jsonrpc_error(req_id, PaymeError.CANT_PERFORM, "Cannot cancel transaction in current state."))
 
-                cancel_time = int(time.time() * 1000)
-                rec['status'] = "cancelled"
-                rec['cancel_time'] = cancel_time
-                rec['state'] = cancel_state
-                rec['reason'] = params.get('reason')
-                processed[transaction_id] = rec
-                save_transactions(processed)
+                rec = cancel_transaction_record(transaction_id, rec, cancel_state, params.get('reason'), "CancelTransaction")
 
-                # MQTT для отмены
-                topic = f"payments/{MERCHANT_ID}"
-                payload = {
-                    "status": "cancelled",
-                    "amount": rec.get('amount'),
-                    "amount_tiyin": rec.get('amount_tiyin'),
-                    "currency": "UZS",
+                log.info("❌ Transaction cancelled", extra={
                     "transaction_id": transaction_id,
                     "reason": rec.get('reason'),
-                    "time": cancel_time
-                }
-                publish_mqtt(topic, payload, "CancelTransaction")
-
-                print(f"❌ Transaction cancelled: {transaction_id}, reason: {rec.get('reason')}, state: {cancel_state}")
+                    "state": cancel_state
+                })
 
-                return jsonify(jsonrpc_success(req_id, {
-                    "cancel_time": cancel_time,
+                return cached_success(req_id, method, transaction_id, cancel_state, {
+                    "cancel_time": rec['cancel_time'],
                     "transaction": transaction_id,
                     "state": cancel_state,
                     "receivers": None
-                }))
-
-            # === CheckTransaction ===
-            elif method == 'CheckTransaction':
-                if not transaction_id:
-                    return jsonify(jsonrpc_error(req_id, PaymeError.INVALID_PARAMS, "Missing transaction id"))
-
-                if transaction_id not in processed:
-                    return jsonify(jsonrpc_error(req_id, PaymeError.TRANSACTION_NOT_FOUND, "Transaction not found."))
-
-                t = processed[transaction_id]
-
-                return jsonify(jsonrpc_success(req_id, {
-                    "create_time": t.get('create_time'),
-                    "perform_time": t.get('perform_time', 0),
-                    "cancel_time": t.get('cancel_time', 0),
-                    "transaction": transaction_id,
-                    "state": t.get('state'),
-                    "reason": t.get('reason')
-                }))
-
-            # === GetStatement ===
-            elif method == 'GetStatement':
-                from_time = params.get('from', 0)
-                to_time = params.get('to', int(time.time() * 1000))
-
-                transactions_list = []
-                for tid, tx in processed.items():
-                    if from_time <= tx.get('create_time', 0) <= to_time:
-                        transactions_list.append({
-                            "id": tid,
-                            "time": tx.get('create_time'),
-                            "amount": tx.get('amount_tiyin', int(tx.get('amount', 0) * 100)),
-                            "account": tx.get('account', {}),
-                            "create_time": tx.get('create_time'),
-                            "perform_time": tx.get('perform_time', 0),
-                            "cancel_time": tx.get('cancel_time', 0),
-                            "transaction": tid,
-                            "state": tx.get('state'),
-                            "reason": tx.get('reason')
-                        })
-
-                return jsonify(jsonrpc_success(req_id, {"transactions": transactions_list}))
+                })
 
             else:
                 return jsonify(jsonrpc_error(req_id, PaymeError.METHOD_NOT_FOUND, f"Method not found: {method}"))
 
     except Exception as e:
-        print(f"💥 Error processing {method}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("💥 Error processing %s", method)
         return jsonify(jsonrpc_error(req_id, PaymeError.SYSTEM_ERROR, "System error"))
 
+# ============ СПИСКИ ПОСТРАНИЧНО ============
+def page_request(filter_types):
+    """
+    Параметры страницы из query: limit, cursor, from/to (мс), fields и
+    фильтры filter_types (имя -> тип значения). ValueError — неверный ввод.
+    """
+    args = request.args
+    options = dict(
+        after=decode_cursor(args['cursor']) if args.get('cursor') else None,
+        limit=max(1, min(int(args.get('limit', PAGE_LIMIT)), PAGE_LIMIT_MAX)),
+        from_time=int(args['from']) if args.get('from') else None,
+        to_time=int(args['to']) if args.get('to') else None,
+        filters={name: cast(args[name]) for name, cast in filter_types.items() if args.get(name)}
+    )
+    fields = [field for field in args.get('fields', '').split(',') if field]
+    return options, fields
+
+def page_response(key, items, next_position):
+    """Страница JSON; большие ответы — gzip, если клиент его принимает"""
+    body, encoding = compress(page_body(key, items, next_position), request.accept_encodings['gzip'] > 0)
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
 # ============ DEBUG/TEST ENDPOINTS ============
 
 @app.route('/test-mqtt', methods=['POST'])
@@ -530,11 +805,7 @@ def test_mqtt():
         "test": True
     }
 
-    print(f"\n🧪 TEST MQTT: Starting MQTT test")
-    print(f"🧪 TEST MQTT: Topic: {topic}")
-    print(f"🧪 TEST MQTT: Payload: {test_payload}")
-    print(f"🧪 TEST MQTT: MQTT connected: {mqtt_connected}")
-    print(f"🧪 TEST MQTT: Broker: {mqtt_url}")
+    log.info("🧪 TEST MQTT", extra={"topic": topic, "connected": mqtt_connected, "broker": mqtt_url})
 
     if not mqtt_connected:
         return jsonify({
@@ -596,12 +867,15 @@ def test_full_payment():
 
 @app.route('/debug-transactions', methods=['GET'])
 def debug_transactions():
-    """Просмотр транзакций"""
-    processed = load_transactions()
-    return jsonify({
-        "count": len(processed),
-        "transactions": processed
-    })
+    """Просмотр транзакций: страницы как у /api/orders, фильтры state, status, device_id"""
+    try:
+        options, fields = page_request({"state": int, "status": str, "device_id": str})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    found, next_position = transactions.page(**options)
+    items = [project({"id": tid, **record}, fields) for tid, record in found]
+    return page_response("transactions", items, next_position)
 
 @app.route('/debug-mqtt', methods=['GET'])
 def debug_mqtt():
@@ -612,6 +886,7 @@ def debug_mqtt():
         "url": mqtt_url,
         "topics": {
             "payments": f"payments/{MERCHANT_ID}",
+            "device": f"payments/{MERCHANT_ID}/<device_id>",
             "control": f"control/{MERCHANT_ID}",
             "config": f"config/{MERCHANT_ID}"
         },
@@ -624,6 +899,9 @@ def health():
     return jsonify({
         "ok": True,
         "mqtt": mqtt_connected,
+        "primary": primary is None or primary.held,
+        "mqtt_queue_depth": mqtt_outbox.status()["queue_depth"],
+        "expiry": expiry.status(),
         "env_merchant": bool(MERCHANT_ID),
         "timestamp": int(time.time() * 1000)
     })
@@ -637,12 +915,19 @@ def mqtt_status():
         "url": mqtt_url,
         "topics": {
             "payments": f"payments/{MERCHANT_ID}",
+            "device": f"payments/{MERCHANT_ID}/<device_id>",
             "control": f"control/{MERCHANT_ID}",
             "config": f"config/{MERCHANT_ID}"
         },
+        "outbox": mqtt_outbox.status(),
         "merchantId": MERCHANT_ID
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/test', methods=['GET'])
 def test():
     """Простой тест"""
@@ -657,25 +942,50 @@ def test():
 # Вставь этот код ПЕРЕД строкой "if __name__ == '__main__':"
 
 # ============ ЗАКАЗЫ ДЛЯ АВТОМАТА ДУХОВ ============
-ORDERS_FILE = "orders.json"
-
-def load_orders():
-    """Загрузка заказов из файла"""
-    try:
-        if os.path.exists(ORDERS_FILE):
-            with open(ORDERS_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"⚠️ Ошибка загрузки заказов: {e}")
-    return {}
-
-def save_orders(data):
-    """Сохранение заказов в файл"""
-    try:
-        with open(ORDERS_FILE, 'w') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения заказов: {e}")
+# Открываются вместе с транзакциями (open_storage)
+order_store = None
+order_locks = None
+
+def mark_order_paid(order_id, transaction_id):
+    """Заказ оплачен: больше не истекает по ORDER_TTL_SEC"""
+    if order_id is None:
+        return
+    with timed_lock(order_locks.lock(order_id), ORDER_LOCK_WAIT):
+        order = order_store.get(str(order_id))
+        if order is None or order.get('status') == 'paid':
+            return
+        order = dict(order)
+        order['status'] = 'paid'
+        order['transaction_id'] = transaction_id
+        order_store.put(order['order_id'], order)
+
+def order_deadline(order):
+    """Когда истекает неоплаченный заказ (мс): ORDER_TTL_SEC от создания или от продления"""
+    return order.get('expires_at') or order.get('created_at', 0) + ORDER_TTL_SEC * 1000
+
+def expire_order(order_id):
+    """Неоплаченный заказ старше ORDER_TTL_SEC -> expired + cancelled на автомат"""
+    with timed_lock(order_locks.lock(order_id), ORDER_LOCK_WAIT):
+        order = order_store.get(order_id)
+        if order is None or order.get('status') != 'pending':
+            return
+        if int(time.time() * 1000) < order_deadline(order):
+            # Заказ продлён — сработает срок, поставленный при продлении
+            return
+        order = dict(order)
+        order['status'] = 'expired'
+        order['expired_at'] = int(time.time() * 1000)
+        order_store.put(order_id, order)
+
+    topic = payments_topic(order.get('device_id'))
+    mqtt_payload = {
+        "status": "cancelled",
+        "order_id": order_id,
+        "reason": "expired",
+        "time": order['expired_at']
+    }
+    publish_mqtt(topic, mqtt_payload, "ExpireOrder", key=f"{order_id}:cancelled")
+    log.info("⏰ Order expired", extra={"order_id": order_id})
 
 @app.route('/api/create-perfume-order', methods=['POST'])
 def create_perfume_order():
@@ -689,28 +999,33 @@ def create_perfume_order():
         parfum_id = data.get('parfum_id', 1)
         amount = data.get('amount', 5000)  # сумма в сумах
 
-        # Генерируем уникальный ID заказа
-        order_id = f"parfum_{int(time.time())}_{parfum_id}"
+        # parfum_id — слот автомата из каталога цен, сумма — целые сумы:
+        # оба попадают в сводки продаж (целые колонки) и в транзакцию
+        slots = len(price_catalog.view(device_id)[0].get('prices') or ())
+        if type(parfum_id) is not int or not 1 <= parfum_id <= slots:
+            return jsonify({"success": False, "error": f"parfum_id must be an integer 1..{slots}"}), 400
+        if type(amount) is not int or not MIN_AMOUNT_UZS <= amount <= MAX_AMOUNT_UZS:
+            return jsonify({
+                "success": False,
+                "error": f"amount must be an integer {MIN_AMOUNT_UZS}..{MAX_AMOUNT_UZS}"
+            }), 400
+
+        # Генерируем уникальный ID заказа (упорядочен по времени)
+        order_id = order_store.new_id()
         amount_tiyin = amount * 100
 
-        print(f"\n📦 Creating perfume order:")
-        print(f"   Device: {device_id}")
-        print(f"   Parfum: {parfum_id}")
-        print(f"   Amount: {amount} сум")
-
         # Генерируем Payme checkout URL
         # Формат: m=MERCHANT_ID;ac.order_id=ORDER_ID;a=AMOUNT_TIYIN
-        params = f"m={MERCHANT_ID};ac.StreetAroma=Aroma;a={amount_tiyin}"
+        # order_id в account связывает транзакцию Payme с автоматом
+        params = f"m={MERCHANT_ID};ac.StreetAroma=Aroma;ac.order_id={order_id};a={amount_tiyin}"
         encoded_params = base64.b64encode(params.encode()).decode()
 
         # URL для QR кода
         qr_url = f"https://checkout.paycom.uz/{encoded_params}"
 
-        print(f"   QR URL: {qr_url}")
-
         # Сохраняем заказ
-        orders = load_orders()
-        orders[order_id] = {
+        created_at = int(time.time() * 1000)
+        order = {
             "order_id": order_id,
             "device_id": device_id,
             "parfum_id": parfum_id,
@@ -718,12 +1033,13 @@ def create_perfume_order():
             "amount_tiyin": amount_tiyin,
             "qr_url": qr_url,
             "status": "pending",
-            "created_at": int(time.time() * 1000)
+            "created_at": created_at
         }
-        save_orders(orders)
+        order_store.put(order_id, order)
+        expiry.schedule("order", order_id, order_deadline(order))
 
         # Отправляем MQTT на ESP32 с QR URL
-        topic = f"payments/{MERCHANT_ID}"
+        topic = payments_topic(device_id)
         mqtt_payload = {
             "status": "created",
             "order_id": order_id,
@@ -734,28 +1050,69 @@ def create_perfume_order():
             "time": int(time.time() * 1000)
         }
 
-        publish_mqtt(topic, mqtt_payload, "CreatePerfumeOrder")
+        publish_mqtt(topic, mqtt_payload, "CreatePerfumeOrder", key=f"{order_id}:created")
 
-        print(f"✅ Order created: {order_id}")
+        log.info("📦 Order created", extra={
+            "order_id": order_id,
+            "device_id": device_id,
+            "parfum_id": parfum_id,
+            "amount": amount
+        })
 
-        return jsonify({
+        response = {
             "success": True,
             "order_id": order_id,
             "parfum_id": parfum_id,
             "amount": amount,
             "qr_url": qr_url
-        })
+        }
+
+        # Готовая QR-матрица: автомату не нужно кодировать QR самому
+        if data.get('qr_bitmap'):
+            try:
+                qr = packed_qr(qr_url)
+            except Exception as e:
+                log.warning("⚠️ QR encoding failed: %s", e)
+                qr = None
+            if qr:
+                response["qr"] = qr
+
+        return jsonify(response)
 
     except Exception as e:
-        print(f"❌ Error creating order: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error creating order")
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
 
+@app.route('/api/extend-perfume-order', methods=['POST'])
+def extend_perfume_order():
+    """
+    Автомат снова показал QR заказа (кнопка во время обратного отсчёта):
+    окно оплаты на автомате началось заново, срок заказа — тоже
+    """
+    data = request.json or {}
+    order_id = data.get('order_id')
+
+    if not order_id:
+        return jsonify({"success": False, "error": "Missing order_id"}), 400
+
+    with timed_lock(order_locks.lock(order_id), ORDER_LOCK_WAIT):
+        order = order_store.get(order_id)
+        if order is None:
+            return jsonify({"success": False, "error": "Order not found"}), 404
+        if order.get('status') != 'pending':
+            return jsonify({"success": False, "error": f"Order is {order.get('status')}"}), 409
+        order = dict(order)
+        order['expires_at'] = int(time.time() * 1000) + ORDER_TTL_SEC * 1000
+        order_store.put(order_id, order)
+    expiry.schedule("order", order_id, order['expires_at'])
+
+    log.debug("⏳ Order extended", extra={"order_id": order_id})
+    return jsonify({"success": True, "order_id": order_id, "expires_at": order['expires_at']})
+
 @app.route('/api/cancel-perfume-order', methods=['POST'])
 def cancel_perfume_order():
     """Отмена заказа"""
@@ -766,93 +1123,305 @@ def cancel_perfume_order():
         if not order_id:
             return jsonify({"success": False, "error": "Missing order_id"}), 400
 
-        orders = load_orders()
+        with timed_lock(order_locks.lock(order_id), ORDER_LOCK_WAIT):
+            order = order_store.get(order_id)
 
-        if order_id in orders:
-            orders[order_id]['status'] = 'cancelled'
-            save_orders(orders)
+            if order is not None:
+                order = dict(order)
+                order['status'] = 'cancelled'
+                order_store.put(order_id, order)
 
-            # MQTT уведомление
-            topic = f"payments/{MERCHANT_ID}"
-            mqtt_payload = {
-                "status": "cancelled",
-                "order_id": order_id,
-                "time": int(time.time() * 1000)
-            }
-            publish_mqtt(topic, mqtt_payload, "CancelPerfumeOrder")
+                # MQTT уведомление
+                topic = payments_topic(order.get('device_id'))
+                mqtt_payload = {
+                    "status": "cancelled",
+                    "order_id": order_id,
+                    "time": int(time.time() * 1000)
+                }
+                publish_mqtt(topic, mqtt_payload, "CancelPerfumeOrder", key=f"{order_id}:cancelled")
 
-            print(f"❌ Order cancelled: {order_id}")
+                log.info("❌ Order cancelled", extra={"order_id": order_id})
 
-            return jsonify({"success": True, "order_id": order_id})
-        else:
-            return jsonify({"success": False, "error": "Order not found"}), 404
+                return jsonify({"success": True, "order_id": order_id})
+            else:
+                return jsonify({"success": False, "error": "Order not found"}), 404
 
     except Exception as e:
-        print(f"❌ Error cancelling order: {e}")
+        log.exception("❌ Error cancelling order")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
-    """Получение списка заказов"""
-    orders = load_orders()
-    return jsonify({
-        "count": len(orders),
-        "orders": orders
-    })
-def set_prices():
-    """Установка цен парфюмов (админ)"""
+    """
+    Список заказов по времени создания, страницами по limit (не больше
+    PAGE_LIMIT_MAX). Фильтры: device_id, status, parfum_id, from/to (мс);
+    fields=order_id,status — только эти поля. Следующая страница —
+    ?cursor=<next_cursor> с теми же фильтрами.
+    """
     try:
-        data = request.json or {}
-        prices = data.get('prices', [])
-
-        # Тут можно сохранить в файл
-        print(f"📝 Prices updated: {prices}")
+        options, fields = page_request({"device_id": str, "status": str, "parfum_id": int})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-        return jsonify({"success": True, "prices": prices})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+    found, next_position = order_store.page(**options)
+    return page_response("orders", [project(order, fields) for _, order in found], next_position)
 # ============ ЦЕНЫ ПАРФЮМОВ ============
-PRICES_FILE = "prices.json"
-
-def load_prices():
-    try:
-        if os.path.exists(PRICES_FILE):
-            with open(PRICES_FILE, 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {
-        "prices": [5000, 6000, 7000, 8000],
-        "names": ["Tom Ford", "Lanvin", "Dior", "Dolce Gabbana"]
-    }
+# Каталог в памяти (create_app): файл перечитывается только при смене mtime
+price_catalog = None
 
-def save_prices(data):
-    with open(PRICES_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def publish_prices(context="SetPrices", devices=(), dedupe=True):
+    """
+    Retained-публикация каталога в config/{MERCHANT_ID}: автомат получает
+    актуальные цены сразу после (пере)подключения, без HTTP-опроса.
+    Автоматы devices получают своё представление в
+    config/{MERCHANT_ID}/{device_id} (база с "shared": true — автомат
+    убран из каталога и снова следует общему топику).
+    dedupe=False — без ключа по ETag: outbox помнит ключи между
+    рестартами и иначе отбросил бы повтор того же каталога.
+    """
+    data, body, etag = price_catalog.current()
+    publish_mqtt(f"config/{MERCHANT_ID}", data, context,
+                 key=f"prices:{etag}" if dedupe else None, retain=True)
+    for device_id in devices:
+        data, body, etag = price_catalog.view(device_id)
+        publish_mqtt(f"config/{MERCHANT_ID}/{device_id}", data, context,
+                     key=f"prices:{device_id}:{etag}" if dedupe else None, retain=True)
 
 @app.route('/api/prices', methods=['GET'])
 def get_prices():
-    """ESP32 получает цены"""
-    return jsonify(load_prices())
+    """ESP32 получает цены своего автомата (?device_id=); 304, если ETag не изменился"""
+    data, body, etag = price_catalog.view(request.args.get('device_id'))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/prices', methods=['POST'])
 def set_prices():
-    """Админ меняет цены"""
+    """
+    Админ меняет цены: prices/names — база, groups/devices —
+    {имя: {group, prices, names} или null для удаления}
+    """
     data = request.json or {}
-    prices = load_prices()
+    try:
+        prices, devices = price_catalog.update(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    log.info("📝 Prices updated", extra={"version": prices.get('version'), "devices": len(devices)})
+    publish_prices(devices=devices)
+
+    return jsonify({"success": True, "prices": prices})
 
-    if 'prices' in data:
-        prices['prices'] = data['prices']
-    if 'names' in data:
-        prices['names'] = data['names']
+# ============ СВОДКИ ПРОДАЖ ============
+# Час x автомат x parfum_id x state, обновляются при Perform/Cancel (create_app)
+sales = None
 
-    save_prices(prices)
-    print(f"📝 Prices updated: {prices}")
+# Больше — не слот автомата; в сводках такие записи идут как parfum_id 0
+PARFUM_ID_MAX = 2 ** 31 - 1
+
+def record_sale(transaction_id, record, previous=None):
+    """
+    Переход транзакции в сводки — после записи и публикации: сбой сводок
+    только логируется и не ломает Perform/Cancel
+    """
+    try:
+        sales.record(record, previous)
+    except Exception:
+        log.exception("❌ Sales rollup failed", extra={"transaction_id": transaction_id})
+
+def parfum_of(record):
+    """parfum_id транзакции; у записей до его появления — из заказа"""
+    parfum_id = record.get('parfum_id')
+    if parfum_id is None and record.get('order_id') is not None:
+        order = order_store.get(str(record['order_id']))
+        parfum_id = order.get('parfum_id') if order else None
+    try:
+        parfum_id = int(parfum_id or 0)
+    except (TypeError, ValueError):
+        return 0
+    # Заказы до проверки parfum_id могли принести что угодно
+    return parfum_id if 0 <= parfum_id <= PARFUM_ID_MAX else 0
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """
+    Продажи за from..to (мс, с точностью до часа): sales, cancelled,
+    refunds и revenue по group_by=hour,device_id,parfum_id (по умолчанию
+    device_id,parfum_id). Фильтры: device_id, parfum_id.
+    """
+    args = request.args
+    try:
+        stats = sales.query(
+            from_time=int(args['from']) if args.get('from') else None,
+            to_time=int(args['to']) if args.get('to') else None,
+            group_by=[field for field in args.get('group_by', 'device_id,parfum_id').split(',') if field],
+            device_id=args.get('device_id'),
+            parfum_id=int(args['parfum_id']) if args.get('parfum_id') else None
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, "count": len(stats), "stats": stats})
+
+# ============ ТЕЛЕМЕТРИЯ АВТОМАТОВ ============
+# Пачки событий (дозы, таймауты, отмены, переподключения) из
+# telemetry/{MERCHANT_ID}/<device_id> и POST /api/telemetry (create_app)
+telemetry = None
+
+@app.route('/api/telemetry', methods=['POST'])
+def post_telemetry():
+    """
+    Пачка событий или список пачек одним запросом (?device_id= — для
+    пачек без device_id). Тело не разбирается в потоке запроса: 202 —
+    принято в очередь, 503 — очередь переполнена, повторить позже.
+    """
+    if not telemetry.submit(request.get_data(), device_id=request.args.get('device_id')):
+        return jsonify({"success": False, "error": "Telemetry queue is full"}), 503
+    return jsonify({"success": True}), 202
+
+@app.route('/api/telemetry', methods=['GET'])
+def get_telemetry():
+    """
+    Сводка событий за from..to (мс) по (device_id, тип, slot): count,
+    value_sum, last_time. ?device_id= — один автомат.
+    """
+    args = request.args
+    try:
+        from_time = int(args['from']) if args.get('from') else None
+        to_time = int(args['to']) if args.get('to') else None
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    summary = summarize(TELEMETRY_DIR, from_time, to_time, args.get('device_id'))
+    return jsonify({"success": True, "count": len(summary), "events": summary})
+
+# ============ ФОНОВЫЕ ЗАДАЧИ ============
+expiry.register("order", expire_order)
+expiry.register("transaction", expire_transaction)
+
+_background_lock = Lock()
+_background_pid = None
+
+def schedule_pending():
+    """
+    Сроки переживают рестарт: берём только pending-записи из индексов.
+    Вызывает start_background() в каждом процессе после fork — с sqlite
+    это делает каждый воркер (обработчики идемпотентны), и сроки, которые
+    упавший воркер держал только в памяти, подхватит перезапущенный
+    """
+    for order_id in list(order_store.ids_by_status('pending')):
+        expiry.schedule("order", order_id, order_deadline(order_store.get(order_id)))
+    for transaction_id in transactions.pending_ids():
+        expiry.schedule("transaction", transaction_id,
+                        transactions.get(transaction_id).get('create_time', 0) + TRANSACTION_TIMEOUT_MS)
+
+def start_primary():
+    """MQTT и отправка outbox — только в главном процессе"""
+    # Сетевой поток paho сам переподключается при обрывах
+    message_bus.start()
+    mqtt_outbox.start()
+    # Брокер мог потерять retained-сообщение — обновляем при старте
+    publish_prices("Startup", price_catalog.device_ids(), dedupe=False)
+
+def start_background():
+    """
+    Потоки процесса: планировщик сроков, приём телеметрии, выбор главного
+    воркера, MQTT и outbox. Один раз на процесс — после fork (preload_app)
+    воркер запускает свои потоки заново. Приложение, которое импортировали
+    как app:app без create_app(), создаётся здесь с настройками из окружения.
+    """
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        create_app()
+        _background_pid = os.getpid()
+        schedule_pending()
+        expiry.start()
+        # HTTP-пачки принимает любой воркер, MQTT — только главный
+        telemetry.start()
+        if archiver is not None:
+            archiver.start()
+        if primary is not None:
+            primary.watch(start_primary)
+        else:
+            start_primary()
+
+@app.before_request
+def ensure_background():
+    # Воркер, которого не запустили явно (post_fork), стартует на первом
+    # запросе; `flask run` и `gunicorn app:app` заодно создают приложение
+    if _background_pid != os.getpid():
+        start_background()
+
+# Размеры очередей и хранилищ — считаются в момент scrape /metrics
+registry.gauge("mqtt_outbox_messages", "MQTT outbox messages by stage",
+               lambda: {(stage,): mqtt_outbox.status()[stage] for stage in ("queue_depth", "inflight", "undelivered")},
+               ["stage"])
+registry.gauge("store_records", "Records held in memory by store",
+               lambda: {("transactions",): len(transactions), ("orders",): len(order_store)}, ["store"])
+registry.gauge("expiry_scheduled", "Deadlines waiting in the expiry scheduler",
+               lambda: expiry.status()["scheduled"])
+registry.gauge("telemetry_queue_depth", "Telemetry batches waiting to be decoded",
+               lambda: telemetry.status()["queue_depth"])
+
+# ============ ФАБРИКА ПРИЛОЖЕНИЯ ============
+def create_app(config=None):
+    """
+    Настройки (.env, окружение, config), хранилища и прогретые кэши — без
+    сети и без потоков, поэтому создание занимает доли секунды и безопасно
+    до fork. Соединения и фоновые потоки запускает start_background():
+    явно (__main__, post_fork в gunicorn.conf.py) или на первом запросе.
+    Повторный вызов возвращает уже созданное приложение.
+    """
+    global auth_verifier, price_catalog, result_cache, sales, telemetry
+    if transactions is not None:
+        return app
+
+    load_dotenv()
+    # Настройки — глобальные имена модуля, как их читают обработчики
+    settings = load_config(config)
+    globals().update(settings)
+
+    auth_verifier = AuthVerifier(ENV_FILE, base={
+        "PAYME_KEY": SECRET_KEY,
+        "PAYME_TEST_KEY": TEST_KEY,
+        "TEST_MODE": "true" if TEST_MODE else "false"
+    })
+    # Вывод идёт в фоновом потоке, ключи Payme маскируются в любом сообщении —
+    # и заданные при старте, и пришедшие ротацией через .env
+    setup_logging(
+        LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE,
+        secrets=[key for _, key in parse_keys(SECRET_KEY) + parse_keys(TEST_KEY)],
+        secrets_source=auth_verifier.secrets
+    )
+    if not QR_AVAILABLE:
+        log.warning("⚠️ qrcode is not installed: orders are returned without a QR bitmap, "
+                    "machines encode the QR themselves (pip install qrcode)")
+
+    open_storage()
+    open_bus()
+    price_catalog = PriceCatalog(PRICES_FILE)
+    result_cache = ResultCache(RESULT_CACHE_SIZE)
+    if database is not None:
+        sales = SqliteSalesRollup(database, parfum_of).load(transactions)
+    else:
+        sales = SalesRollup(parfum_of).load(transactions)
+    # Файлы сегментов открывает start_background(): у каждого воркера свои
+    telemetry = TelemetryIngest(TELEMETRY_DIR, TELEMETRY_QUEUE, TELEMETRY_FSYNC)
+    if database is not None:
+        # Соединение SQLite не должно достаться воркерам после fork
+        database.close()
+    return app
 
-    return jsonify({"success": True, "prices": prices})
 # ============ STARTUP ============
 if __name__ == '__main__':
+    create_app()
+    # С debug=True модуль исполняет и наблюдающий процесс reloader'а:
+    # соединения и потоки — только в процессе, который обслуживает запросы
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background()
     print(f"""
 ╔══════════════════════════════════════════════════════╗
 ║     🚀 Payme Webhook Server запущен 🚀              ║
@@ -861,7 +1430,7 @@ if __name__ == '__main__':
 ║  Mode: {"TEST" if TEST_MODE else "PRODUCTION"}
 ║  Merchant ID: {MERCHANT_ID}
 ║  MQTT Broker: {mqtt_url}
-║  MQTT Topic: payments/{MERCHANT_ID}
+║  MQTT Topic: payments/{MERCHANT_ID}/<device_id>
 ╠══════════════════════════════════════════════════════╣
 ║  Debug endpoints:
 ║    - GET  /health
@@ -0,0 +1,328 @@
+import array
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from threading import Lock, Thread
+
+from metrics import registry
+
+log = logging.getLogger("archive")
+
+ARCHIVE_RECORDS = registry.counter(
+    "archive_records", "Records moved from memory to archive segments", ["store"])
+ARCHIVE_SECONDS = registry.histogram(
+    "archive_seconds", "Archive run time (segment write, eviction, merge)", ["store"])
+
+# Записей в одном сжатом блоке: точечное чтение распаковывает только блок
+BLOCK_ROWS = 64
+ZLIB_LEVEL = 6
+
+# Сколько распакованных блоков сегмента держать в памяти
+BLOCK_CACHE = 64
+
+# Концевик сегмента: magic, строк, строк в блоке, смещения таблицы блоков,
+# времён, порядка id, смещений ключей и самих ключей
+FOOTER = struct.Struct("<4sIIQQQQQ")
+SEGMENT_MAGIC = b"ARC1"
+
+
+def _array_bytes(typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def write_segment(path, entries):
+    """
+    Неизменяемый сегмент из entries — (время, id, запись), отсортированных
+    по (время, id). Записи лежат сжатыми блоками по BLOCK_ROWS; рядом —
+    несжатые индексы для mmap: время каждой строки, строки в порядке id
+    и сами id. Файл пишется во временный и переименовывается после fsync.
+    """
+    tmp_path = path + ".tmp"
+    keys = [key.encode('utf-8') for _, key, _ in entries]
+    with open(tmp_path, 'wb') as f:
+        offsets = [0]
+        for start in range(0, len(entries), BLOCK_ROWS):
+            block = [record for _, _, record in entries[start:start + BLOCK_ROWS]]
+            f.write(zlib.compress(json.dumps(block, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+                                  ZLIB_LEVEL))
+            offsets.append(f.tell())
+
+        blocks_at = f.tell()
+        f.write(_array_bytes('Q', offsets))
+        times_at = f.tell()
+        f.write(_array_bytes('q', [entry_time for entry_time, _, _ in entries]))
+        order_at = f.tell()
+        f.write(_array_bytes('I', sorted(range(len(keys)), key=keys.__getitem__)))
+        key_offsets_at = f.tell()
+        key_offsets = [0]
+        for key in keys:
+            key_offsets.append(key_offsets[-1] + len(key))
+        f.write(_array_bytes('I', key_offsets))
+        keys_at = f.tell()
+        f.write(b''.join(keys))
+        f.write(FOOTER.pack(SEGMENT_MAGIC, len(entries), BLOCK_ROWS,
+                            blocks_at, times_at, order_at, key_offsets_at, keys_at))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment:
+    """
+    Сегмент архива, отображённый в память: индексы читаются прямо из
+    mmap (бинарный поиск по времени и по id без загрузки в память),
+    распаковывается только нужный блок записей.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = int(os.path.basename(path)[4:10])
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.rows, self.block_rows, blocks_at, times_at,
+         order_at, key_offsets_at, keys_at) = FOOTER.unpack_from(self._mmap, len(self._mmap) - FOOTER.size)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"Not an archive segment: {path}")
+        view = memoryview(self._mmap)
+        self._blocks = view[blocks_at:times_at].cast('Q')
+        self.times = view[times_at:order_at].cast('q')
+        self._order = view[order_at:key_offsets_at].cast('I')
+        self._key_offsets = view[key_offsets_at:keys_at].cast('I')
+        self._keys_at = keys_at
+        self.block = lru_cache(maxsize=BLOCK_CACHE)(self._read_block)
+
+    def key(self, row):
+        offsets = self._key_offsets
+        return self._mmap[self._keys_at + offsets[row]:self._keys_at + offsets[row + 1]].decode('utf-8')
+
+    def find(self, key):
+        """Строка с данным id или -1"""
+        wanted = key.encode('utf-8')
+        order, offsets, keys_at, data = self._order, self._key_offsets, self._keys_at, self._mmap
+        lo, hi = 0, self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = order[mid]
+            found = data[keys_at + offsets[row]:keys_at + offsets[row + 1]]
+            if found < wanted:
+                lo = mid + 1
+            elif found > wanted:
+                hi = mid
+            else:
+                return row
+        return -1
+
+    def record(self, row):
+        return self.block(row // self.block_rows)[row % self.block_rows]
+
+    def get(self, key):
+        row = self.find(key)
+        return self.record(row) if row >= 0 else None
+
+    def scan(self, after=None, from_time=None, to_time=None):
+        """((время, id), запись) по возрастанию (время, id) в диапазоне"""
+        times = self.times
+        lo = bisect_left(times, from_time) if from_time is not None else 0
+        if after is not None:
+            lo = max(lo, bisect_left(times, after[0]))
+        hi = bisect_right(times, to_time) if to_time is not None else self.rows
+        for row in range(lo, hi):
+            position = (times[row], self.key(row))
+            if after is not None and position <= tuple(after):
+                continue
+            yield position, self.record(row)
+
+    def close(self):
+        self.block.cache_clear()
+        for view in (self._blocks, self.times, self._order, self._key_offsets):
+            view.release()
+        self._mmap.close()
+
+    def _read_block(self, index):
+        blocks = self._blocks
+        return json.loads(zlib.decompress(self._mmap[blocks[index]:blocks[index + 1]]))
+
+
+class Archive:
+    """
+    Архив одного хранилища: каталог неизменяемых сегментов seg-NNNNNN.arc.
+
+    Одна и та же запись может лежать в нескольких сегментах (например,
+    возврат оплаты, заархивированной раньше) — побеждает сегмент с большим
+    номером. Список сегментов подменяется целиком, чтение идёт без
+    блокировок.
+
+    Соседние сегменты сливаются попарно по правилу стека timsort: от
+    старых к новым размеры убывают быстрее чисел Фибоначчи (A > B + C,
+    B > C). Сегментов O(log N), каждая строка переписывается O(log N)
+    раз, и цена добавления не зависит от размера всего архива. Результат
+    слияния занимает номер более нового сегмента пары, поэтому порядок
+    версий не меняется.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._segments = []
+        self._write_lock = Lock()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                # Сегмент, не дописанный до аварии
+                os.remove(path)
+            elif name.startswith("seg-") and name.endswith(".arc"):
+                segments.append(Segment(path))
+        self._segments = segments
+        if segments:
+            log.info("📦 Archive %s: %d segment(s), %d record(s)", self.directory, len(segments), len(self))
+        return self
+
+    def __len__(self):
+        return sum(segment.rows for segment in self._segments)
+
+    def segments(self):
+        return len(self._segments)
+
+    def get(self, key):
+        for segment in reversed(self._segments):
+            record = segment.get(key)
+            if record is not None:
+                return record
+        return None
+
+    def __contains__(self, key):
+        return any(segment.find(key) >= 0 for segment in self._segments)
+
+    def scan(self, after=None, from_time=None, to_time=None):
+        """((время, id), запись) по возрастанию по всем сегментам, без повторов"""
+        yield from self._scan(self._segments, after, from_time, to_time)
+
+    def _scan(self, segments, after=None, from_time=None, to_time=None):
+        if len(segments) == 1:
+            yield from segments[0].scan(after, from_time, to_time)
+            return
+        streams = [self._versions(segment, after, from_time, to_time) for segment in segments]
+        previous = None
+        for position, _, record in heapq.merge(*streams):
+            # Версии одной записи соседствуют: первой идёт новейшая
+            if position != previous:
+                previous = position
+                yield position, record
+
+    @staticmethod
+    def _versions(segment, after, from_time, to_time):
+        for position, record in segment.scan(after, from_time, to_time):
+            yield position, -segment.seq, record
+
+    def add(self, entries):
+        """Новый сегмент из (время, id, запись), отсортированных по (время, id)"""
+        with self._write_lock:
+            segment = self._write(entries)
+            self._segments = self._segments + [segment]
+            self._collapse()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+    def _write(self, entries):
+        seq = self._segments[-1].seq + 1 if self._segments else 1
+        path = os.path.join(self.directory, f"seg-{seq:06d}.arc")
+        write_segment(path, entries)
+        return Segment(path)
+
+    def _collapse(self):
+        """Слияния, пока вершина стека сегментов нарушает инварианты (под _write_lock)"""
+        while len(self._segments) > 1:
+            rows = [segment.rows for segment in self._segments]
+            n = len(rows) - 2
+            if n > 0 and rows[n - 1] <= rows[n] + rows[n + 1]:
+                if rows[n - 1] < rows[n + 1]:
+                    n -= 1
+            elif rows[n] > rows[n + 1]:
+                break
+            self._merge(n)
+
+    def _merge(self, n):
+        """
+        Слияние сегментов n и n + 1: результат атомарно заменяет файл
+        более нового, файл старого удаляется после подмены списка
+        """
+        segments = self._segments
+        older, newer = segments[n], segments[n + 1]
+        write_segment(newer.path, [(position[0], position[1], record)
+                                   for position, record in self._scan([older, newer])])
+        self._segments = segments[:n] + [Segment(newer.path)] + segments[n + 2:]
+        # Открытые читатели держат отображение, файл исчезнет после них
+        os.remove(older.path)
+        log.info("📦 Archive %s: merged %s and %s (%d rows)", self.directory,
+                 os.path.basename(older.path), os.path.basename(newer.path), older.rows + newer.rows)
+
+
+class Archiver:
+    """
+    Фоновый перенос старых завершённых записей из памяти в архив.
+
+    Раз в interval секунд для каждого хранилища: записи, для которых
+    store.archivable(record, cutoff) (завершены и не менялись дольше
+    max_age), пишутся новым сегментом; после fsync сегмента хранилище
+    убирает их из памяти и снимка (evict). Меньше min_records записей
+    ждут следующего прохода, чтобы не плодить мелкие сегменты.
+    """
+
+    def __init__(self, stores, max_age_ms, interval=3600, min_records=1000):
+        self.stores = stores
+        self.max_age_ms = max_age_ms
+        self.interval = interval
+        self.min_records = min_records
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="archiver", daemon=True)
+            self._thread.start()
+        return self
+
+    def run_once(self, now_ms=None, min_records=None):
+        """Один проход; возвращает {имя хранилища: перенесено записей}"""
+        cutoff = (now_ms if now_ms is not None else int(time.time() * 1000)) - self.max_age_ms
+        min_records = self.min_records if min_records is None else min_records
+        moved = {}
+        for store in self.stores:
+            candidates = [(key, record) for key, record in store.items() if store.archivable(record, cutoff)]
+            if not candidates or len(candidates) < min_records:
+                continue
+            with ARCHIVE_SECONDS.labels(store.name).time():
+                entries = sorted((store._record_time(record), key, record) for key, record in candidates)
+                store.archive.add(entries)
+                moved[store.name] = store.evict(candidates)
+            ARCHIVE_RECORDS.labels(store.name).inc(moved[store.name])
+            log.info("📦 %s archived: %d", store.name, moved[store.name])
+        return moved
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("💥 Archive run failed")
@@ -0,0 +1,168 @@
+import base64
+import hmac
+import logging
+import os
+import time
+from threading import Lock
+
+from dotenv import dotenv_values
+
+log = logging.getLogger("auth")
+
+# Логин, с которым Payme присылает Basic-авторизацию
+PAYME_LOGIN = "Paycom"
+
+# Как часто (сек) проверять mtime .env
+STAT_INTERVAL = 1.0
+
+
+def parse_keys(value):
+    """
+    Ключи из значения PAYME_KEY / PAYME_TEST_KEY. На время ротации через
+    запятую перечисляются несколько ключей: "новый,старый". Формат
+    "Payme:KEY" сохраняется — префикс до ':' считается логином.
+    Возвращает список пар (login | None, key).
+    """
+    keys = []
+    for item in (value or "").split(','):
+        item = item.strip()
+        if not item:
+            continue
+        login, sep, key = item.partition(':')
+        if sep:
+            keys.append((login, key))
+        else:
+            keys.append((None, item))
+    return keys
+
+
+class AuthVerifier:
+    """
+    Проверка авторизации Payme без разбора заголовка в типичном случае.
+
+    Для каждого активного ключа заранее собраны полные значения заголовка
+    "Basic base64(login:key)", и обычный запрос Payme проверяется
+    сравнением за постоянное время с этим небольшим набором. Остальные
+    формы (другой логин, Bearer, голый ключ, ?key=) разбираются как раньше
+    и сравниваются с ключами тоже через hmac.compare_digest.
+
+    Ключи берутся из окружения (base — поверх него, например настройки
+    create_app): при старте окружение важнее .env, как у load_dotenv.
+    Правка .env замечается по mtime (stat не чаще раза в STAT_INTERVAL):
+    значения, изменённые в файле после старта, ложатся поверх окружения,
+    и набор ключей подменяется целиком.
+    """
+
+    def __init__(self, env_file=".env", base=None):
+        self.env_file = env_file
+        self.base = dict(base or {})
+        self._lock = Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self._current = ((), (), False)   # (headers, keys, test_mode)
+        # .env на момент старта: устаревший файл не перекрывает окружение
+        self._startup_values = self._read_file() or {}
+        self._reload()
+
+    # ============ ПРОВЕРКА ============
+    def verify(self, candidate, query_key=None):
+        """True, если значение заголовка (или ?key=) содержит активный ключ"""
+        headers, keys, _ = self.current()
+        candidate = (candidate or "").encode()
+
+        matched = False
+        for header in headers:
+            matched |= hmac.compare_digest(candidate, header)
+        if matched:
+            return True
+
+        key = self._extract_key(candidate)
+        if not key and query_key:
+            key = query_key.strip().encode()
+        if not key:
+            return False
+
+        for expected in keys:
+            matched |= hmac.compare_digest(key, expected)
+        return matched
+
+    def current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= STAT_INTERVAL:
+            self._checked_at = now
+            if self._file_mtime() != self._mtime:
+                with self._lock:
+                    if self._file_mtime() != self._mtime:
+                        self._reload()
+        return self._current
+
+    @property
+    def test_mode(self):
+        return self.current()[2]
+
+    def secrets(self):
+        """Активные ключи — для маскировки в логах"""
+        return [key.decode() for key in self.current()[1]]
+
+    def status(self):
+        headers, keys, test_mode = self.current()
+        return {"mode": "TEST" if test_mode else "PRODUCTION", "active_keys": len(keys)}
+
+    # ============ ВНУТРЕННЕЕ ============
+    @staticmethod
+    def _extract_key(candidate):
+        lowered = candidate[:7].lower()
+        if lowered.startswith(b"basic "):
+            try:
+                credentials = base64.b64decode(candidate[6:].strip())
+            except ValueError:
+                return b""
+            parts = credentials.split(b':')
+            return parts[1].strip() if len(parts) >= 2 else b""
+        if lowered.startswith(b"bearer "):
+            return candidate[7:].strip()
+        return candidate.strip()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.env_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file(self):
+        """Значения .env; None — файла нет или он не читается"""
+        if self._file_mtime() is None:
+            return None
+        try:
+            return {k: v for k, v in dotenv_values(self.env_file).items() if v is not None}
+        except Exception as e:
+            log.warning("⚠️ Ошибка чтения %s: %s", self.env_file, e)
+            return None
+
+    def _reload(self):
+        mtime = self._file_mtime()
+        env = dict(os.environ, **self.base)
+        if mtime is not None:
+            values = self._read_file()
+            if values is None and self._current[0]:
+                return
+            # Ротация через .env: применяется то, что поменяли после старта
+            startup = self._startup_values
+            env.update({k: v for k, v in (values or {}).items() if startup.get(k) != v})
+
+        test_mode = env.get("TEST_MODE", "true").lower() == "true"
+        pairs = parse_keys(env.get("PAYME_TEST_KEY" if test_mode else "PAYME_KEY", ""))
+
+        headers = []
+        keys = []
+        for login, key in pairs:
+            keys.append(key.encode())
+            for name in {PAYME_LOGIN, login or PAYME_LOGIN}:
+                token = base64.b64encode(f"{name}:{key}".encode()).decode()
+                headers.append(f"Basic {token}".encode())
+
+        previous = self._current[1]
+        self._mtime = mtime
+        self._current = (tuple(headers), tuple(keys), test_mode)
+        if previous and previous != self._current[1]:
+            log.info("🔑 Payme keys reloaded", extra={"active_keys": len(keys)})
@@ -0,0 +1,347 @@
+"""
+Офлайн-бенчмарк Payme webhook.
+
+Гоняет реалистичные последовательности JSON-RPC через Flask test client:
+CheckPerform → Create → Perform → CheckTransaction (повторы Payme),
+Create → Cancel (+ повтор Cancel) и GetStatement по большим окнам.
+Хранилище заранее заполняется историей заданного размера, MQTT
+идёт через LocalBus (MESSAGE_BUS=local), который сразу подтверждает доставку.
+В конце — проверка согласованности (не больше одной pending-транзакции
+на account, журнал проигрывается в то же состояние).
+
+Запуск (из server/):
+    python bench.py --history 100000 --sequences 2000 --threads 8
+    python bench.py --history 1000000 --statements 20 --json
+
+Сравнивать имеет смысл прогоны на одной машине с одинаковыми параметрами.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BENCH_KEY = "bench-key"
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+# ============ ПОДГОТОВКА ============
+def history(size, now_ms):
+    """size завершённых транзакций за последние 30 дней: (id, запись)"""
+    rng = random.Random(size)
+    states = (2, 2, 2, -1, -2)
+    for i in range(size):
+        create_time = now_ms - 30 * DAY_MS + (30 * DAY_MS * i) // max(size, 1)
+        state = rng.choice(states)
+        amount = rng.choice((5000, 6000, 7000, 8000))
+        tx = {
+            "status": {2: "performed", -1: "cancelled", -2: "cancelled"}[state],
+            "state": state,
+            "amount": amount,
+            "amount_tiyin": amount * 100,
+            "create_time": create_time,
+            "account": {"StreetAroma": "Aroma", "order_id": f"hist_{i:08d}"},
+            "order_id": f"hist_{i:08d}",
+            "device_id": f"dev{i % 50}",
+        }
+        if state == 2:
+            tx["perform_time"] = create_time + 5000
+        else:
+            tx["cancel_time"] = create_time + 5000
+            tx["reason"] = 3
+        yield f"hist_{i:08d}", tx
+
+
+def write_history(path, size, now_ms):
+    """Снимок файлового хранилища (STORE_BACKEND=journal)"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i, (tid, tx) in enumerate(history(size, now_ms)):
+            f.write(('' if i == 0 else ',') + json.dumps(tid) + ':' + json.dumps(tx, separators=(',', ':')))
+        f.write('}')
+
+
+def write_history_sqlite(path, size, now_ms):
+    """Та же история в базе SQLite (STORE_BACKEND=sqlite), одной транзакцией"""
+    from sqlstore import SqliteDatabase, SqliteTransactionStore
+
+    store = SqliteTransactionStore(SqliteDatabase(path))
+    with store.db.write_lock:
+        for tid, tx in history(size, now_ms):
+            store.put(tid, tx)
+
+
+def load_app(workdir, size, fsync, backend):
+    """create_app с хранилищами в workdir; возвращает (модуль, секунды загрузки)"""
+    processed = os.path.join(workdir, "processed.json")
+    database = os.path.join(workdir, "payme.db")
+    if backend == "sqlite":
+        write_history_sqlite(database, size, int(time.time() * 1000))
+    else:
+        write_history(processed, size, int(time.time() * 1000))
+    os.chdir(workdir)
+
+    started = time.perf_counter()
+    import app as module
+    module.create_app(dict(
+        STORE_BACKEND=backend,
+        DATABASE_FILE=database,
+        PROCESSED_FILE=processed,
+        ORDERS_FILE=os.path.join(workdir, "orders.json"),
+        OUTBOX_FILE=os.path.join(workdir, "outbox.log"),
+        PRICES_FILE=os.path.join(workdir, "prices.json"),
+        TELEMETRY_DIR=os.path.join(workdir, "telemetry"),
+        ARCHIVE_DIR=os.path.join(workdir, "archive"),
+        PROCESSED_FSYNC=fsync,
+        SECRET_KEY=BENCH_KEY,
+        TEST_KEY="",
+        TEST_MODE=False,
+        DEBUG_ALLOW_ANY=False,
+        ENV_FILE=os.path.join(workdir, ".env"),
+        MESSAGE_BUS="local",
+        LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"),
+    ))
+    load_seconds = time.perf_counter() - started
+    module.start_background()
+    return module, load_seconds
+
+
+# ============ КЛИЕНТ ============
+class Recorder:
+    """Латентности по методу, общие для всех потоков"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, error_code=None):
+        with self._lock:
+            self.samples[name].append(seconds)
+            if error_code is not None:
+                self.errors[(name, error_code)] += 1
+
+
+class Client:
+    def __init__(self, flask_app, recorder):
+        self.http = flask_app.test_client()
+        self.recorder = recorder
+        token = base64.b64encode(f"Paycom:{BENCH_KEY}".encode()).decode()
+        self.headers = {"Authorization": f"Basic {token}"}
+        self._id = 0
+
+    def rpc(self, method, **params):
+        self._id += 1
+        started = time.perf_counter()
+        response = self.http.post('/payme', json={"id": self._id, "method": method, "params": params},
+                                  headers=self.headers)
+        body = response.get_data()
+        elapsed = time.perf_counter() - started
+        result = json.loads(body)
+        error = result.get("error")
+        self.recorder.add(method, elapsed, error["code"] if error else None)
+        return result
+
+
+# ============ СЦЕНАРИИ ============
+def payment_sequence(client, tid, account, amount_tiyin, check_retries):
+    client.rpc("CheckPerformTransaction", amount=amount_tiyin, account=account)
+    client.rpc("CreateTransaction", id=tid, time=int(time.time() * 1000), amount=amount_tiyin, account=account)
+    client.rpc("CreateTransaction", id=tid, time=int(time.time() * 1000), amount=amount_tiyin, account=account)
+    client.rpc("PerformTransaction", id=tid)
+    for _ in range(check_retries):
+        client.rpc("CheckTransaction", id=tid)
+
+
+def cancel_sequence(client, tid, account, amount_tiyin):
+    client.rpc("CreateTransaction", id=tid, time=int(time.time() * 1000), amount=amount_tiyin, account=account)
+    client.rpc("CancelTransaction", id=tid, reason=3)
+    client.rpc("CancelTransaction", id=tid, reason=3)
+    client.rpc("CheckTransaction", id=tid)
+
+
+def run_sequences(flask_app, recorder, sequences, threads, cancel_ratio, check_retries):
+    """Платежи в threads потоках; каждый поток — свой test client"""
+    def worker(index):
+        client = Client(flask_app, recorder)
+        rng = random.Random(index)
+        for n in range(index, sequences, threads):
+            tid = f"bench_{index}_{n}"
+            account = {"StreetAroma": "Aroma", "bench": str(n)}
+            amount_tiyin = rng.choice((500000, 600000, 700000, 800000))
+            if rng.random() < cancel_ratio:
+                cancel_sequence(client, tid, account, amount_tiyin)
+            else:
+                payment_sequence(client, tid, account, amount_tiyin, check_retries)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - started
+
+
+def run_contention(flask_app, recorder, threads, rounds):
+    """Все потоки бьют в небольшой набор id и account — проверка блокировок"""
+    def worker(index):
+        client = Client(flask_app, recorder)
+        rng = random.Random(1000 + index)
+        methods = ("CreateTransaction", "PerformTransaction", "CancelTransaction", "CheckTransaction")
+        for _ in range(rounds):
+            tid = f"hot_{rng.randint(0, 80)}"
+            account = {"hot": str(rng.randint(0, 5))}
+            client.rpc(rng.choice(methods), id=tid, time=0, amount=500000, account=account, reason=1)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - started
+
+
+def run_statements(flask_app, recorder, calls, window_days):
+    client = Client(flask_app, recorder)
+    now_ms = int(time.time() * 1000)
+    rng = random.Random(7)
+    started = time.perf_counter()
+    for _ in range(calls):
+        to_time = now_ms - rng.randint(0, max(0, 30 - window_days)) * DAY_MS
+        client.rpc("GetStatement", **{"from": to_time - window_days * DAY_MS, "to": to_time})
+    return time.perf_counter() - started
+
+
+# ============ ПРОВЕРКА И ОТЧЁТ ============
+def check_consistency(module):
+    """Состояния валидны, pending не больше одной на account, журнал проигрывается"""
+    from store import TransactionStore, account_key
+
+    live = module.transactions.to_dict()
+    pending = defaultdict(list)
+    for tid, tx in live.items():
+        assert tx["state"] in (1, 2, -1, -2), (tid, tx["state"])
+        if tx["state"] == 1:
+            pending[account_key(tx.get("account", {}))].append(tid)
+    duplicated = {k: v for k, v in pending.items() if len(v) > 1}
+    assert not duplicated, f"several pending transactions per account: {duplicated}"
+
+    if module.database is not None:
+        # В sqlite состояние и так читается из базы, проигрывать нечего
+        return len(live)
+    module.transactions.close()
+    replayed = TransactionStore(module.transactions.path).load().to_dict()
+    assert replayed == live, "journal replay differs from the in-memory state"
+    return len(live)
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, int(round(p / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def summarize(recorder):
+    report = {}
+    for name, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        report[name] = {
+            "count": len(samples),
+            "p50_ms": round(percentile(samples, 50) * 1000, 3),
+            "p90_ms": round(percentile(samples, 90) * 1000, 3),
+            "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            "max_ms": round(samples[-1] * 1000, 3),
+            "errors": {str(code): n for (method, code), n in recorder.errors.items() if method == name},
+        }
+    return report
+
+
+def print_report(result):
+    print(f"\nHistory: {result['history']} transactions ({result['store']}), loaded in {result['load_seconds']:.2f}s")
+    for phase, info in result["phases"].items():
+        print(f"{phase:<12} {info['requests']:>8} req  {info['seconds']:>8.2f}s  {info['rps']:>10.0f} req/s")
+    print(f"\n{'method':<26}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}  errors")
+    for name, row in result["methods"].items():
+        print(f"{name:<26}{row['count']:>8}{row['p50_ms']:>10.3f}{row['p90_ms']:>10.3f}"
+              f"{row['p99_ms']:>10.3f}{row['max_ms']:>10.3f}  {row['errors'] or ''}")
+    print(f"\nMQTT published: {result['mqtt_published']}, consistency: {result['consistency']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Payme webhook offline benchmark")
+    parser.add_argument("--history", type=int, default=10000, help="transactions preloaded into the store")
+    parser.add_argument("--sequences", type=int, default=2000, help="payment/cancel sequences")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--cancel-ratio", type=float, default=0.2)
+    parser.add_argument("--check-retries", type=int, default=2, help="CheckTransaction calls after Perform")
+    parser.add_argument("--contention-rounds", type=int, default=150, help="per thread, 0 to skip")
+    parser.add_argument("--statements", type=int, default=10, help="GetStatement calls")
+    parser.add_argument("--statement-days", type=int, default=7, help="GetStatement window")
+    parser.add_argument("--store", choices=("journal", "sqlite"), default="journal", help="STORE_BACKEND")
+    parser.add_argument("--fsync", action="store_true", help="fsync every journal append / synchronous=FULL")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="payme-bench-")
+    try:
+        module, load_seconds = load_app(workdir, args.history, args.fsync, args.store)
+        flask_app = module.app
+        recorder = Recorder()
+        phases = {}
+
+        def phase(name, seconds, before):
+            requests = sum(len(s) for s in recorder.samples.values()) - before
+            phases[name] = {"requests": requests, "seconds": round(seconds, 3),
+                            "rps": round(requests / seconds, 1) if seconds else 0}
+
+        def total():
+            return sum(len(s) for s in recorder.samples.values())
+
+        before = total()
+        phase("sequences", run_sequences(flask_app, recorder, args.sequences, args.threads,
+                                         args.cancel_ratio, args.check_retries), before)
+        if args.contention_rounds:
+            before = total()
+            phase("contention", run_contention(flask_app, recorder, args.threads, args.contention_rounds), before)
+        if args.statements:
+            before = total()
+            phase("statements", run_statements(flask_app, recorder, args.statements, args.statement_days), before)
+
+        # Outbox дописывает подтверждения в фоне — даём ему догнать очередь
+        deadline = time.time() + 10
+        while module.mqtt_outbox.status()["undelivered"] and time.time() < deadline:
+            time.sleep(0.05)
+
+        result = {
+            "history": args.history,
+            "store": args.store,
+            "load_seconds": round(load_seconds, 3),
+            "phases": phases,
+            "methods": summarize(recorder),
+            "mqtt_published": module.message_bus.published,
+            "consistency": f"ok ({check_consistency(module)} transactions)",
+        }
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_report(result)
+    finally:
+        if args.keep:
+            print(f"Data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import itertools
+import logging
+from collections import deque
+from threading import Lock
+
+log = logging.getLogger("bus")
+
+
+class PublishResult:
+    """То же, что возвращает paho publish(): rc (0 — принято) и mid"""
+    __slots__ = ("rc", "mid")
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+class MessageBus:
+    """
+    Транспорт для MqttOutbox и подписок сервера.
+
+    publish(topic, payload, qos, retain) -> PublishResult; подтверждение
+    доставки приходит в on_publish(mid) — возможно раньше, чем publish()
+    вернётся. Сервер выставляет on_connect / on_disconnect / on_publish /
+    on_message(topic, payload) до start().
+    """
+    name = "bus"
+    url = ""
+
+    def __init__(self):
+        self.connected = False
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+        self._subscriptions = {}
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        raise NotImplementedError
+
+    def subscribe(self, topic_filter, handler=None, qos=1):
+        """handler(topic, payload) для topic_filter, иначе общий on_message"""
+        self._subscriptions[topic_filter] = (handler, qos)
+
+    def _set_connected(self, connected):
+        self.connected = connected
+        callback = self.on_connect if connected else self.on_disconnect
+        if callback:
+            callback()
+
+    def _dispatch(self, topic, payload):
+        """Доставка подписчикам; возвращает число совпавших подписок"""
+        matched = 0
+        for topic_filter, (handler, _) in list(self._subscriptions.items()):
+            if topic_matches(topic_filter, topic):
+                matched += 1
+                handler = handler or self.on_message
+                if handler:
+                    handler(topic, payload)
+        return matched
+
+
+def topic_matches(topic_filter, topic):
+    """Сопоставление топика с MQTT-фильтром (+ и #)"""
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class PahoBus(MessageBus):
+    """MQTT-брокер через paho; сетевой поток paho сам переподключается"""
+    name = "mqtt"
+
+    def __init__(self, broker, port, client_id, protocol="mqtt", keepalive=60):
+        super().__init__()
+        import paho.mqtt.client as mqtt
+
+        self.broker = broker
+        self.port = port
+        self.keepalive = keepalive
+        self.url = f"{protocol}://{broker}"
+        self.client = mqtt.Client(client_id=client_id)
+        self.client.on_connect = self._paho_connect
+        self.client.on_disconnect = self._paho_disconnect
+        self.client.on_publish = self._paho_publish
+        self.client.on_message = self._paho_message
+
+    def start(self):
+        log.info("🔗 Connecting to MQTT: %s", self.url)
+        try:
+            self.client.connect_async(self.broker, self.port, self.keepalive)
+            self.client.loop_start()
+        except Exception as e:
+            log.error("❌ MQTT initial connection error: %s", e)
+        return self
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        result = self.client.publish(topic, payload, qos=qos, retain=retain)
+        return PublishResult(result.rc, result.mid)
+
+    def subscribe(self, topic_filter, handler=None, qos=1):
+        super().subscribe(topic_filter, handler, qos)
+        if self.connected:
+            self.client.subscribe(topic_filter, qos)
+
+    def _paho_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            log.error("❌ MQTT connection failed with code %s", rc)
+            return
+        log.info("✅ MQTT connected to %s", self.url)
+        # Подписки восстанавливаются на каждом подключении
+        for topic_filter, (_, qos) in list(self._subscriptions.items()):
+            client.subscribe(topic_filter, qos)
+        self._set_connected(True)
+
+    def _paho_disconnect(self, client, userdata, rc):
+        log.warning("🔒 MQTT connection closed")
+        self._set_connected(False)
+
+    def _paho_publish(self, client, userdata, mid):
+        if self.on_publish:
+            self.on_publish(mid)
+
+    def _paho_message(self, client, userdata, msg):
+        if not self._dispatch(msg.topic, msg.payload) and self.on_message:
+            self.on_message(msg.topic, msg.payload)
+
+
+class LocalBus(MessageBus):
+    """
+    Pub/sub внутри процесса: публикация доставляется локальным
+    подписчикам синхронно и сразу подтверждается. Retained-сообщения
+    хранятся и отдаются новым подписчикам, последние capture сообщений
+    доступны в messages — для бенчмарков, нагрузочных тестов и
+    симуляторов автоматов без брокера.
+    """
+    name = "local"
+    url = "local://"
+
+    def __init__(self, capture=10000):
+        super().__init__()
+        self.messages = deque(maxlen=capture)
+        self.retained = {}
+        self.published = 0
+        self._mid = itertools.count(1)
+        self._lock = Lock()
+
+    def start(self):
+        self._set_connected(True)
+        return self
+
+    def stop(self):
+        self._set_connected(False)
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self._lock:
+            mid = next(self._mid)
+            self.published += 1
+            self.messages.append((topic, payload, retain))
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+        self._dispatch(topic, payload)
+        if self.on_publish:
+            self.on_publish(mid)
+        return PublishResult(0, mid)
+
+    def subscribe(self, topic_filter, handler=None, qos=1):
+        super().subscribe(topic_filter, handler, qos)
+        with self._lock:
+            retained = [(t, p) for t, p in self.retained.items() if topic_matches(topic_filter, t)]
+        handler = handler or self.on_message
+        for topic, payload in retained:
+            if handler:
+                handler(topic, payload)
+
+
+def create_bus(kind, **mqtt_options):
+    """Транспорт по имени: "mqtt" (paho) или "local" (в процессе)"""
+    if kind == "local":
+        return LocalBus()
+    if kind == "mqtt":
+        return PahoBus(**mqtt_options)
+    raise ValueError(f"Unknown message bus: {kind}")
@@ -0,0 +1,54 @@
+import json
+from collections import OrderedDict
+from threading import Lock
+
+from metrics import registry
+
+RESULT_CACHE_LOOKUPS = registry.counter(
+    "payme_result_cache_lookups", "Result cache lookups for Payme retries", ["result"])
+
+# Сколько готовых ответов держать в памяти
+RESULT_CACHE_SIZE = 10000
+
+
+class ResultCache:
+    """
+    LRU сериализованных JSON-RPC result для повторных запросов Payme.
+
+    Ключ — (метод, id транзакции, версия записи). Версия — state:
+    каждый state транзакция проходит не больше одного раза, поэтому после
+    смены состояния старые ключи больше не совпадают — и для изменений
+    из других воркеров через общую базу. Устаревшие ответы вытесняет
+    LRU. Повтор уже выполненной операции — поиск в словаре и запись
+    готовых байт, без блокировки транзакции и без json.dumps.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = RESULT_CACHE_LOOKUPS.labels("hit")
+        self._misses = RESULT_CACHE_LOOKUPS.labels("miss")
+
+    def get(self, key):
+        """Тело result (str) или None"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+        (self._hits if body is not None else self._misses).inc()
+        return body
+
+    def put(self, key, result):
+        """Сериализует result, запоминает и возвращает тело"""
+        body = json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = body
+                self._entries.move_to_end(key)
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return body
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,60 @@
+import fcntl
+import logging
+import os
+from threading import Event, Thread
+
+log = logging.getLogger("cluster")
+
+# Как часто (сек) резервный воркер пробует стать главным
+TAKEOVER_INTERVAL = 5.0
+
+
+class PrimaryLock:
+    """
+    Выбор главного воркера: flock на lock-файле. Главный держит
+    MQTT-соединение и отправляет outbox; остальные только пишут в базу.
+    Блокировку снимает ОС при смерти процесса, и следующий воркер
+    перехватывает роль в пределах TAKEOVER_INTERVAL.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.held = False
+        self._fd = None
+        self._stop = Event()
+
+    def try_acquire(self):
+        if self.held:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        self.held = True
+        return True
+
+    def watch(self, on_acquired):
+        """on_acquired() — один раз, когда этот процесс станет главным"""
+        if self.try_acquire():
+            self._promoted(on_acquired)
+        else:
+            Thread(target=self._wait, args=(on_acquired,), name="primary-watch", daemon=True).start()
+        return self
+
+    def _wait(self, on_acquired):
+        while not self._stop.wait(TAKEOVER_INTERVAL):
+            if self.try_acquire():
+                self._promoted(on_acquired)
+                return
+
+    def _promoted(self, on_acquired):
+        log.info("👑 Worker %d is primary (MQTT, outbox)", os.getpid())
+        on_acquired()
+
+    def stop(self):
+        self._stop.set()
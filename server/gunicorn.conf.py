@@ -0,0 +1,36 @@
+"""
+Production-запуск: несколько воркеров на всех ядрах, общая база SQLite (WAL).
+
+    pip install gunicorn
+    cd server && gunicorn -c gunicorn.conf.py
+
+Приложение создаёт фабрика create_app() — по умолчанию один раз в
+мастере (preload_app), воркеры получают готовые хранилища и кэши через
+fork. Соединения и потоки каждый воркер открывает сам после fork.
+Один из воркеров становится главным (MQTT-соединение и отправка outbox),
+остальные только пишут в базу; при его падении роль перехватывает другой.
+"""
+import multiprocessing
+import os
+
+# Файловый журнал рассчитан на один процесс
+os.environ.setdefault("STORE_BACKEND", "sqlite")
+
+wsgi_app = "app:create_app()"
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3002')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = 30
+graceful_timeout = 10
+
+if workers > 1 and os.environ["STORE_BACKEND"] != "sqlite":
+    raise SystemExit("STORE_BACKEND=sqlite is required for more than one worker")
+
+
+def post_worker_init(worker):
+    """Планировщик и выбор главного — сразу, не дожидаясь первого запроса"""
+    import app
+    app.start_background()
@@ -0,0 +1,168 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# Атрибуты LogRecord, которые не считаются полями события
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+REDACTED = "***"
+
+_listener = None
+_settings = None
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Неблокирующий handler: в потоке запроса запись только кладётся в
+    очередь, форматирование и вывод — в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        # Стандартный QueueHandler форматирует сообщение здесь, в потоке
+        # запроса; оставляем это listener'у. Исключение превращаем в текст
+        # сразу, чтобы не держать кадры стека до вывода.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Переполнение очереди не должно тормозить webhook
+            pass
+
+
+class DebugSampler(logging.Filter):
+    """Пропускает только долю rate DEBUG-записей, остальные уровни — все"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class SecretsFilter(logging.Filter):
+    """
+    Маскирует известные секреты в сообщении и полях записи: secrets —
+    заданные при старте, source() — текущие (ключи, подменённые ротацией
+    в .env, маскируются с первой записи после перечитывания)
+    """
+
+    def __init__(self, secrets, source=None):
+        super().__init__()
+        self.secrets = [s for s in secrets if s and len(s) >= 4]
+        self.source = source
+
+    def _current(self):
+        if self.source is None:
+            return self.secrets
+        return self.secrets + [s for s in self.source() if s and len(s) >= 4 and s not in self.secrets]
+
+    @staticmethod
+    def _redact(value, secrets):
+        if isinstance(value, str):
+            for secret in secrets:
+                if secret in value:
+                    value = value.replace(secret, REDACTED)
+        return value
+
+    def filter(self, record):
+        secrets = self._current()
+        if secrets:
+            record.msg = self._redact(record.getMessage(), secrets)
+            record.args = None
+            for key, value in vars(record).items():
+                if key not in _RESERVED:
+                    setattr(record, key, self._redact(value, secrets))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на событие: ts, level, logger, msg + поля из extra"""
+
+    def format(self, record):
+        event = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                event[key] = value
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Читаемый формат для консоли: поля из extra дописываются как key=value"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-5s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{key}={value}" for key, value in vars(record).items() if key not in _RESERVED]
+        return line + (" " + " ".join(fields) if fields else "")
+
+
+def setup_logging(level="INFO", fmt="text", debug_sample=1.0, secrets=(), queue_size=10000, secrets_source=None):
+    """
+    Настройка логирования сервера: корневой logger пишет через очередь,
+    вывод в stderr делает фоновый QueueListener. Секреты (secrets и
+    текущие из secrets_source()) маскируются всегда, DEBUG можно
+    сэмплировать долей debug_sample.
+    """
+    global _listener, _settings
+    stop_logging()
+    _settings = (level, fmt, debug_sample, tuple(secrets), queue_size, secrets_source)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    output.addFilter(SecretsFilter(secrets, secrets_source))
+
+    handler = AsyncQueueHandler(log_queue)
+    handler.addFilter(DebugSampler(debug_sample))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает listener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork():
+    """
+    Поток listener'а в дочерний процесс не переходит (preload_app в
+    gunicorn): без него очередь только заполнялась бы. Настраиваем заново.
+    """
+    global _listener
+    if _settings is not None:
+        _listener = None
+        setup_logging(*_settings)
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,204 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+# Границы бакетов (сек): Payme ждёт ответ единицы секунд, интересна
+# в основном область миллисекунд
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        """Серия с конкретными значениями меток (создаётся один раз)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items(), key=lambda item: item[0]):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, names, values):
+        return [f"{name}_total{_label_text(names, values)} {self.value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "count", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, names, values):
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        lines = []
+        cumulative = 0
+        bucket_names = names + ("le",)
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_label_text(bucket_names, values + (repr(bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{_label_text(bucket_names, values + ('+Inf',))} {count}")
+        lines.append(f"{name}_sum{_label_text(names, values)} {total!r}")
+        lines.append(f"{name}_count{_label_text(names, values)} {count}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Gauge:
+    """Значение считается при scrape: fn() -> число или {(метки): число}"""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label_names = tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        if isinstance(value, dict):
+            for values, v in sorted(value.items()):
+                lines.append(f"{self.name}{_label_text(self.label_names, values)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    """
+    Метрики процесса в памяти. Запись — инкремент под коротким lock'ом
+    серии; текст для scrape собирается только по запросу /metrics.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, labels=()):
+        with self._lock:
+            # Gauge перерегистрируется: fn может ссылаться на новый объект
+            self._metrics[name] = Gauge(name, help, fn, labels)
+            return self._metrics[name]
+
+    def render(self):
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+@contextmanager
+def timed_lock(lock, histogram):
+    """Захват lock с записью времени ожидания в histogram (серию)"""
+    start = time.perf_counter()
+    with lock:
+        histogram.observe(time.perf_counter() - start)
+        yield
@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+
+from metrics import registry
+
+log = logging.getLogger("outbox")
+
+MQTT_DELIVERY_SECONDS = registry.histogram(
+    "mqtt_delivery_seconds", "Time from enqueue to broker PUBACK",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+
+# Сколько ключей доставленных сообщений помнить для дедупликации
+DELIVERED_KEYS_MAX = 10000
+
+
+class MqttOutbox:
+    """
+    Надёжная очередь исходящих MQTT-сообщений (outbox).
+
+    enqueue() дописывает сообщение в журнал до ответа webhook'а и сразу
+    возвращается. Фоновый поток отправляет сообщения с QoS 1, держа не
+    больше max_inflight неподтверждённых через bus (см. bus.py). PUBACK (on_publish) пишет в
+    журнал отметку ack. Неподтверждённые сообщения возвращаются в
+    очередь при переподключении (on_connect) и по таймауту ack, а после
+    рестарта процесса восстанавливаются из журнала. Сообщения с
+    одинаковым key (например "<transaction_id>:confirmed") не дублируются.
+
+    С fsync enqueue() возвращается только после fsync журнала: один fsync
+    подтверждает все строки, записанные к его началу (group commit), так
+    что параллельные запросы не ждут fsync друг друга по очереди. Отметки
+    ack не синхронизируются — потерянная отметка даёт лишь повторную
+    отправку.
+    """
+
+    # Пауза простоя (сек) между проверками очереди
+    poll_interval = 1
+
+    def __init__(self, bus, path, max_inflight=20, ack_timeout=30, fsync=True):
+        self.bus = bus
+        self.path = path
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self.fsync = fsync
+        self.connected = False
+
+        self._cond = Condition()
+        self._queue = deque()          # key, ожидающие отправки
+        self._messages = {}            # key -> сообщение (не подтверждено)
+        self._inflight = {}            # mid -> (key, время отправки)
+        self._early_acks = set()       # mid, подтверждённые раньше записи в _inflight
+        self._delivered = OrderedDict()
+        self._acks_in_log = 0
+        self._seq = 0
+        self._log = None
+        self._worker = None
+        # Group commit: номер последней записанной строки add и последней синхронизированной
+        self._sync_lock = Lock()
+        self._written = 0
+        self._synced = 0
+
+        self.stats = {
+            "enqueued": 0,
+            "published": 0,
+            "acked": 0,
+            "retried": 0,
+            "duplicates": 0,
+            "latency_ms_last": 0,
+            "latency_ms_max": 0,
+            "latency_ms_sum": 0,
+        }
+
+    # ============ ЖУРНАЛ ============
+    def load(self):
+        """Восстановление неподтверждённых сообщений из журнала"""
+        messages = {}
+        acks = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('op') == 'add':
+                        messages[entry['key']] = entry
+                    elif entry.get('op') == 'ack':
+                        messages.pop(entry['key'], None)
+                        acks += 1
+
+        self._messages = messages
+        self._queue = deque(sorted(messages, key=lambda k: messages[k]['t']))
+        self._acks_in_log = acks
+        self._log = open(self.path, 'a', encoding='utf-8')
+        if messages:
+            log.info("📬 MQTT outbox: %d undelivered message(s) restored", len(messages))
+        return self
+
+    def _write(self, entry):
+        self._log.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._log.flush()
+
+    def _compact(self):
+        """Переписать журнал только с неподтверждёнными сообщениями (под _cond)"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._messages.values():
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._log.close()
+        self._log = open(self.path, 'a', encoding='utf-8')
+        self._acks_in_log = 0
+
+    # ============ API ============
+    def enqueue(self, topic, payload, key=None, qos=1, retain=False):
+        """Сохранить сообщение в outbox. False — дубликат по key."""
+        with self._cond:
+            if key is None:
+                self._seq += 1
+                key = f"auto:{time.time_ns()}:{self._seq}"
+            elif key in self._messages or key in self._delivered:
+                self.stats["duplicates"] += 1
+                return False
+
+            entry = {
+                "op": "add",
+                "key": key,
+                "topic": topic,
+                "payload": payload,
+                "qos": qos,
+                "retain": retain,
+                "t": time.time()
+            }
+            self._write(entry)
+            self._written += 1
+            written = self._written
+            self._messages[key] = entry
+            self._queue.append(key)
+            self.stats["enqueued"] += 1
+            self._cond.notify()
+        if self.fsync:
+            self._sync(written)
+        return True
+
+    def _sync(self, written):
+        """fsync журнала, пока строка номер written не на диске (group commit)"""
+        with self._sync_lock:
+            if self._synced >= written:
+                # Её уже подтвердил fsync другого запроса
+                return
+            with self._cond:
+                target = self._written
+                # Свой дескриптор: компакция может подменить журнал во время
+                # fsync (снимок она синхронизирует сама)
+                fd = os.dup(self._log.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._synced = target
+
+    def start(self):
+        if self._worker is None:
+            self._worker = Thread(target=self._run, name="mqtt-outbox", daemon=True)
+            self._worker.start()
+        return self
+
+    def status(self):
+        with self._cond:
+            acked = self.stats["acked"]
+            return dict(
+                self.stats,
+                queue_depth=len(self._queue),
+                inflight=len(self._inflight),
+                undelivered=len(self._messages),
+                latency_ms_avg=round(self.stats["latency_ms_sum"] / acked, 1) if acked else 0,
+            )
+
+    # ============ MQTT CALLBACKS ============
+    def on_connect(self):
+        """Переподключение: всё неподтверждённое отправляется заново"""
+        with self._cond:
+            self.connected = True
+            self._early_acks.clear()
+            self._requeue(list(self._inflight))
+            self._cond.notify()
+
+    def on_disconnect(self):
+        with self._cond:
+            self.connected = False
+
+    def on_publish(self, mid):
+        """PUBACK от брокера (из сетевого потока paho или из LocalBus.publish)"""
+        with self._cond:
+            if mid in self._inflight:
+                self._ack(mid)
+            else:
+                self._early_acks.add(mid)
+            self._cond.notify()
+
+    # ============ ВНУТРЕННЕЕ ============
+    def _ack(self, mid):
+        key, _ = self._inflight.pop(mid)
+        entry = self._messages.pop(key, None)
+        if entry is None:
+            return
+        self._write({"op": "ack", "key": key})
+        self._acks_in_log += 1
+
+        self._delivered[key] = True
+        if len(self._delivered) > DELIVERED_KEYS_MAX:
+            self._delivered.popitem(last=False)
+
+        latency_ms = int((time.time() - entry['t']) * 1000)
+        MQTT_DELIVERY_SECONDS.observe(latency_ms / 1000)
+        self.stats["acked"] += 1
+        self.stats["latency_ms_last"] = latency_ms
+        self.stats["latency_ms_sum"] += latency_ms
+        self.stats["latency_ms_max"] = max(self.stats["latency_ms_max"], latency_ms)
+
+        if self._acks_in_log > 1000 and self._acks_in_log > len(self._messages):
+            self._compact()
+
+    def _requeue(self, mids):
+        """Вернуть сообщения из inflight в начало очереди (под _cond)"""
+        # Самые старые должны оказаться в начале очереди
+        for mid in sorted(mids, key=lambda m: self._inflight[m][1], reverse=True):
+            key, _ = self._inflight.pop(mid)
+            if key in self._messages:
+                self._queue.appendleft(key)
+                self.stats["retried"] += 1
+
+    def _poll(self):
+        """Подкачка сообщений из внешнего хранилища (см. SqliteOutbox)"""
+
+    def _run(self):
+        while True:
+            self._poll()
+            with self._cond:
+                now = time.time()
+                expired = [mid for mid, (_, sent_at) in self._inflight.items()
+                           if now - sent_at > self.ack_timeout]
+                self._requeue(expired)
+
+                if not (self.connected and self._queue and len(self._inflight) < self.max_inflight):
+                    self._cond.wait(timeout=self.poll_interval)
+                    continue
+
+                key = self._queue.popleft()
+                entry = self._messages.get(key)
+                if entry is None:
+                    continue
+
+            # publish() вызывается без _cond: paho зовёт on_publish под своим
+            # мьютексом, LocalBus — прямо внутри publish(); взаимная
+            # блокировка здесь недопустима
+            message = json.dumps(entry['payload'], ensure_ascii=False)
+            result = self.bus.publish(entry['topic'], message, qos=entry['qos'], retain=entry['retain'])
+
+            with self._cond:
+                if result.rc != 0:
+                    # Разрыв соединения придёт в on_disconnect, здесь только пауза
+                    log.error("❌ MQTT outbox: publish error to %s: rc=%s", entry['topic'], result.rc)
+                    self._queue.appendleft(key)
+                    self._cond.wait(timeout=1)
+                    continue
+
+                self.stats["published"] += 1
+                self._inflight[result.mid] = (key, time.time())
+                if result.mid in self._early_acks:
+                    self._early_acks.discard(result.mid)
+                    self._ack(result.mid)
@@ -0,0 +1,54 @@
+import base64
+import gzip
+import json
+
+# Размер страницы по умолчанию и предельный: страница собирается в
+# памяти целиком, так что память на ответ ограничена PAGE_LIMIT_MAX
+PAGE_LIMIT = 100
+PAGE_LIMIT_MAX = 1000
+
+# Ответы меньше этого не сжимаются: выигрыш меньше накладных расходов
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+
+
+def encode_cursor(position):
+    """Непрозрачный курсор из позиции (время создания, id)"""
+    raw = json.dumps(list(position), ensure_ascii=False, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    """Позиция (время, id) из курсора; ValueError, если курсор испорчен"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if (not isinstance(position, list) or len(position) != 2
+            or not isinstance(position[0], int) or isinstance(position[0], bool)
+            or not isinstance(position[1], str)):
+        raise ValueError("Invalid cursor")
+    return tuple(position)
+
+
+def project(record, fields):
+    """Только запрошенные поля записи (fields=None — все)"""
+    if not fields:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+def page_body(key, items, next_position):
+    """Тело страницы: {"count", key: [...], "next_cursor"}"""
+    return json.dumps({
+        "count": len(items),
+        key: items,
+        "next_cursor": encode_cursor(next_position) if next_position is not None else None
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compress(body, accept_gzip):
+    """(тело, Content-Encoding или None): gzip для больших ответов, если клиент его принимает"""
+    if accept_gzip and len(body) >= GZIP_MIN_BYTES:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import time
+import zlib
+from threading import Lock
+
+log = logging.getLogger("prices")
+
+DEFAULT_PRICES = {
+    "prices": [5000, 6000, 7000, 8000],
+    "names": ["Tom Ford", "Lanvin", "Dior", "Dolce Gabbana"]
+}
+
+# Поля по слотам автомата, которые группа или автомат могут переопределить
+SLOT_FIELDS = ("prices", "names")
+
+# Как часто (сек) проверять mtime файла цен
+STAT_INTERVAL = 1.0
+
+
+def overlay(values, overrides):
+    """Слоты overrides поверх values; None в overrides — слот не меняется"""
+    if not isinstance(overrides, list):
+        return values
+    merged = list(values)
+    for i, value in enumerate(overrides):
+        if value is None:
+            continue
+        if i < len(merged):
+            merged[i] = value
+        else:
+            merged.append(value)
+    return merged
+
+
+class PriceCatalog:
+    """
+    Каталог цен в памяти с заранее сериализованными ответами.
+
+    В prices.json база (prices, names), группы автоматов "groups"
+    {имя: {prices, names}} и автоматы "devices" {device_id: {group,
+    prices, names}}. Поля группы и автомата накладываются на базу по
+    слотам (None — слот наследуется). Представления — (data, body, etag)
+    базы, каждой группы и каждого автомата с собственными полями —
+    строятся при изменении, а не на запросе: view(device_id) — два-три
+    поиска в словаре. Правка группы пересчитывает только её и её
+    автоматы с собственными полями; правка базы — всё.
+
+    set_prices увеличивает version, ручная правка prices.json
+    замечается по mtime (stat не чаще раза в STAT_INTERVAL).
+    GET /api/prices отдаёт готовые байты или 304 без тела, если ETag совпал.
+    """
+
+    def __init__(self, path, default=DEFAULT_PRICES):
+        self.path = path
+        self.default = default
+        self._lock = Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self._data = None
+        # (база, группы, автоматы, группа автомата, автоматы группы) —
+        # подменяется целиком, читатели не видят пересчёт наполовину
+        self._views = None
+        self._reload()
+
+    # ============ ЧТЕНИЕ ============
+    def current(self):
+        """(data, body, etag) базового каталога"""
+        return self.view()
+
+    def view(self, device_id=None):
+        """(data, body, etag) для автомата; неизвестный автомат получает базу"""
+        now = time.monotonic()
+        if now - self._checked_at >= STAT_INTERVAL:
+            self._checked_at = now
+            if self._file_mtime() != self._mtime:
+                with self._lock:
+                    if self._file_mtime() != self._mtime:
+                        self._reload()
+        base, groups, devices, device_group, _ = self._views
+        if device_id:
+            view = devices.get(device_id) or groups.get(device_group.get(device_id))
+            if view is not None:
+                return view
+        return base
+
+    def data(self):
+        """Весь каталог: база, группы и автоматы"""
+        self.view()
+        return self._data
+
+    def device_ids(self):
+        """Автоматы, у которых есть запись в каталоге"""
+        return list(self._data.get('devices', {}))
+
+    # ============ ЗАПИСЬ ============
+    def update(self, changes):
+        """
+        Правка админа: prices/names меняют базу, groups/devices —
+        {имя: поля или None для удаления}. Возвращает (каталог, id
+        автоматов, чьё представление изменилось).
+        """
+        for section in ('groups', 'devices'):
+            entries = changes.get(section) or {}
+            if not isinstance(entries, dict) or not all(
+                    entry is None or isinstance(entry, dict) for entry in entries.values()):
+                raise ValueError(f"{section} must map names to objects or null")
+
+        with self._lock:
+            data = dict(self._data)
+            base_changed = False
+            for field in SLOT_FIELDS:
+                if field in changes:
+                    data[field] = changes[field]
+                    base_changed = True
+            for section in ('groups', 'devices'):
+                entries = dict(data[section])
+                for name, entry in (changes.get(section) or {}).items():
+                    if entry is None:
+                        entries.pop(name, None)
+                    else:
+                        entries[name] = entry
+                data[section] = entries
+            data['version'] = data.get('version', 0) + 1
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+            self._mtime = self._file_mtime()
+
+            if base_changed:
+                devices = set(self._data['devices']) | set(data['devices'])
+                self._publish(data)
+            else:
+                devices = self._publish_changes(data, set(changes.get('groups') or ()),
+                                                set(changes.get('devices') or ()))
+            return data, sorted(devices)
+
+    # ============ ВНУТРЕННЕЕ ============
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload(self):
+        data = dict(self.default)
+        mtime = self._file_mtime()
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except Exception as e:
+                log.warning("⚠️ Ошибка загрузки цен: %s", e)
+                if self._views is not None:
+                    return
+        data.setdefault('version', 0)
+        data['groups'] = data.get('groups') or {}
+        data['devices'] = data.get('devices') or {}
+        self._mtime = mtime
+        self._publish(data)
+
+    def _view(self, data, layers=(), **labels):
+        """Представление: база, поверх неё layers (группа, автомат) по слотам"""
+        view = dict(labels, version=data['version'])
+        for field in SLOT_FIELDS:
+            values = data.get(field, [])
+            for layer in layers:
+                if layer:
+                    values = overlay(values, layer.get(field))
+            view[field] = values
+        body = json.dumps(view, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # crc32 в ETag ловит ручные правки файла без смены version
+        etag = f"{data['version']}-{zlib.crc32(body):08x}"
+        return (view, body, etag)
+
+    def _device_view(self, data, device_id, entry):
+        """Своё представление — только у автомата с собственными полями"""
+        if not any(field in entry for field in SLOT_FIELDS):
+            return None
+        group_name = entry.get('group')
+        group = data['groups'].get(group_name)
+        return self._view(data, (group, entry), device_id=device_id, group=group_name if group else None)
+
+    def _publish(self, data):
+        """Полный пересчёт: при загрузке и при изменении базы"""
+        base = self._view(data, shared=True)
+        groups = {name: self._view(data, (group,), group=name) for name, group in data['groups'].items()}
+        devices = {}
+        device_group = {}
+        members = {}
+        for device_id, entry in data['devices'].items():
+            view = self._device_view(data, device_id, entry)
+            if view is not None:
+                devices[device_id] = view
+            if entry.get('group') is not None:
+                device_group[device_id] = entry['group']
+                members.setdefault(entry['group'], set()).add(device_id)
+        self._data = data
+        self._views = (base, groups, devices, device_group, members)
+
+    def _publish_changes(self, data, group_names, device_ids):
+        """
+        Пересчёт только изменённых групп и автоматов (база та же).
+        Возвращает id автоматов, чьё представление изменилось.
+        """
+        base, groups, devices, device_group, members = self._views
+        groups = dict(groups)
+        devices = dict(devices)
+        device_group = dict(device_group)
+        members = dict(members)
+        affected = set(device_ids)
+
+        for device_id in device_ids:
+            old_group = device_group.pop(device_id, None)
+            if old_group is not None:
+                members[old_group] = members[old_group] - {device_id}
+            entry = data['devices'].get(device_id)
+            if entry is None:
+                devices.pop(device_id, None)
+                continue
+            if entry.get('group') is not None:
+                device_group[device_id] = entry['group']
+                members[entry['group']] = members.get(entry['group'], set()) | {device_id}
+
+        for name in group_names:
+            group = data['groups'].get(name)
+            if group is None:
+                groups.pop(name, None)
+            else:
+                groups[name] = self._view(data, (group,), group=name)
+            affected |= members.get(name, set())
+
+        for device_id in affected:
+            entry = data['devices'].get(device_id)
+            view = self._device_view(data, device_id, entry) if entry is not None else None
+            if view is None:
+                devices.pop(device_id, None)
+            else:
+                devices[device_id] = view
+
+        self._data = data
+        self._views = (base, groups, devices, device_group, members)
+        return affected
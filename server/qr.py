@@ -0,0 +1,57 @@
+import base64
+
+try:
+    import qrcode
+    from qrcode.constants import ERROR_CORRECT_M
+except ImportError:
+    # Без библиотеки автомат кодирует QR сам (медленнее) — create_app
+    # предупреждает об этом при старте
+    qrcode = None
+
+QR_AVAILABLE = qrcode is not None
+
+# Те же параметры, что в прошивке (generateQrToImage): версия 9 (53x53)
+# вмещает checkout URL с ac.order_id, уровень коррекции M
+QR_VERSION = 9
+QR_ECC = "M"
+# Фиксированная маска: без перебора 8 масок кодирование в ~6 раз быстрее,
+# любая маска даёт корректный, читаемый QR
+QR_MASK_PATTERN = 0
+
+
+def packed_qr(text):
+    """
+    QR-матрица для text, упакованная по 1 биту на модуль: строки сверху
+    вниз, внутри строки старший бит — левый модуль, 1 — тёмный модуль,
+    каждая строка выровнена по байту. Автомат рисует её в LVGL без
+    собственного кодирования. None, если библиотека qrcode не установлена.
+    """
+    if qrcode is None:
+        return None
+
+    qr = qrcode.QRCode(
+        version=QR_VERSION,
+        error_correction=ERROR_CORRECT_M,
+        border=0,
+        mask_pattern=QR_MASK_PATTERN
+    )
+    qr.add_data(text)
+    qr.make(fit=False)
+    matrix = qr.get_matrix()
+
+    size = len(matrix)
+    row_bytes = (size + 7) // 8
+    packed = bytearray(row_bytes * size)
+    for y, row in enumerate(matrix):
+        base = y * row_bytes
+        for x, dark in enumerate(row):
+            if dark:
+                packed[base + (x >> 3)] |= 0x80 >> (x & 7)
+
+    return {
+        "version": QR_VERSION,
+        "ecc": QR_ECC,
+        "size": size,
+        "row_bytes": row_bytes,
+        "bits": base64.b64encode(bytes(packed)).decode()
+    }
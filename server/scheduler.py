@@ -0,0 +1,71 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Thread
+
+log = logging.getLogger("scheduler")
+
+
+class ExpiryScheduler:
+    """
+    Фоновый планировщик истечения сроков на куче (heap).
+
+    schedule() кладёт (deadline_ms, kind, key) за O(log n), поток спит до
+    ближайшего срока и вызывает обработчик kind с key. Отменять задания
+    не нужно: обработчик сам проверяет актуальное состояние записи
+    (заказ уже оплачен, транзакция уже выполнена — ничего не делает).
+    Периодических полных проходов по хранилищу нет.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._handlers = {}
+        self._cond = Condition()
+        self._worker = None
+        self.fired = 0
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def schedule(self, kind, key, deadline_ms):
+        with self._cond:
+            seq = next(self._seq)
+            heapq.heappush(self._heap, (deadline_ms, seq, kind, key))
+            # Будим поток, только если срок стал ближайшим
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = Thread(target=self._run, name="expiry-scheduler", daemon=True)
+            self._worker.start()
+        return self
+
+    def status(self):
+        with self._cond:
+            return {
+                "scheduled": len(self._heap),
+                "next_deadline": self._heap[0][0] if self._heap else None,
+                "fired": self.fired
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now_ms = int(time.time() * 1000)
+                while not self._heap or self._heap[0][0] > now_ms:
+                    timeout = (self._heap[0][0] - now_ms) / 1000 if self._heap else None
+                    self._cond.wait(timeout=timeout)
+                    now_ms = int(time.time() * 1000)
+                _, _, kind, key = heapq.heappop(self._heap)
+                self.fired += 1
+
+            handler = self._handlers.get(kind)
+            if handler is None:
+                continue
+            try:
+                handler(key)
+            except Exception:
+                log.exception("💥 Expiry handler %s failed for %s", kind, key)
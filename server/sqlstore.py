@@ -0,0 +1,438 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from threading import Lock
+
+from analytics import SalesRollup
+from outbox import DELIVERED_KEYS_MAX, MqttOutbox
+from store import STORE_WRITE_SECONDS, OrderIds, account_key
+
+log = logging.getLogger("sqlstore")
+
+# Сколько ждать блокировку записи, занятую другим процессом (мс)
+BUSY_TIMEOUT_MS = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    state INTEGER,
+    account_key TEXT,
+    create_time INTEGER,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_pending ON transactions(account_key) WHERE state = 1;
+CREATE INDEX IF NOT EXISTS transactions_created ON transactions(create_time, id);
+
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    device_id TEXT,
+    status TEXT,
+    created_at INTEGER,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_device ON orders(device_id);
+CREATE INDEX IF NOT EXISTS orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS orders_created ON orders(created_at, id);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    qos INTEGER NOT NULL,
+    retain INTEGER NOT NULL,
+    created REAL NOT NULL,
+    acked INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_unacked ON outbox(seq) WHERE acked = 0;
+
+CREATE TABLE IF NOT EXISTS sales (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    time INTEGER NOT NULL,
+    device_id TEXT NOT NULL,
+    parfum_id INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    amount INTEGER NOT NULL
+);
+"""
+
+
+class SqliteDatabase:
+    """
+    Общая для процессов база SQLite в режиме WAL.
+
+    У каждого потока своё соединение (и свой кэш подготовленных
+    выражений sqlite3); после fork соединения открываются заново.
+    Чтение не блокируется записью. Запись — короткие транзакции
+    BEGIN IMMEDIATE через write_lock.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._local = threading.local()
+        self.write_lock = SqliteWriteLock(self)
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # isolation_level=None: границы транзакций задаёт только write_lock
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=64)
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            conn.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Закрыть соединение текущего потока (например, перед fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+class SqliteWriteLock:
+    """
+    Блокировка записи для всех процессов: внешний вход открывает
+    BEGIN IMMEDIATE, выход — COMMIT (или ROLLBACK при исключении).
+    Повторный вход в том же потоке не открывает новую транзакцию, так
+    что вложенные секции (account_lock внутри блокировки транзакции)
+    попадают в одну атомарную запись. Внутри процесса потоки
+    ждут на обычном Lock, а не в busy-цикле SQLite.
+
+    lock(key) повторяет интерфейс StripedLock.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._mutex = Lock()
+        self._local = threading.local()
+
+    def lock(self, key=None):
+        return self
+
+    def __enter__(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._mutex.acquire()
+            try:
+                self.db.connection().execute("BEGIN IMMEDIATE")
+            except Exception:
+                self._mutex.release()
+                raise
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            try:
+                self.db.connection().execute("ROLLBACK" if exc_type else "COMMIT")
+            finally:
+                self._mutex.release()
+        return False
+
+
+class SqliteStore:
+    """Записи в таблице table: id + JSON записи + индексируемые колонки"""
+
+    name = "Records"
+    table = None
+    columns = ()
+    # Колонка со временем создания: порядок page()
+    time_column = None
+
+    def __init__(self, db):
+        self.db = db
+        self._write_seconds = STORE_WRITE_SECONDS.labels(self.name)
+        names = ("id",) + self.columns + ("record",)
+        updates = ", ".join(f"{name}=excluded.{name}" for name in names[1:])
+        self._upsert = (f"INSERT INTO {self.table} ({', '.join(names)}) "
+                        f"VALUES ({', '.join('?' * len(names))}) "
+                        f"ON CONFLICT(id) DO UPDATE SET {updates}")
+
+    def load(self):
+        log.info("📂 %s loaded: %d (sqlite %s)", self.name, len(self), self.db.path)
+        return self
+
+    def close(self):
+        pass
+
+    def compact(self):
+        pass
+
+    def get(self, key):
+        row = self.db.connection().execute(
+            f"SELECT record FROM {self.table} WHERE id = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __contains__(self, key):
+        return self.db.connection().execute(
+            f"SELECT 1 FROM {self.table} WHERE id = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def items(self):
+        rows = self.db.connection().execute(f"SELECT id, record FROM {self.table}")
+        return [(key, json.loads(record)) for key, record in rows]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    # Таблица не переписывается целиком, архив ей не нужен
+    history = items
+
+    def page(self, after=None, limit=100, from_time=None, to_time=None, filters=None):
+        """
+        То же, что JournalStore.page: фильтры по колонкам таблицы идут
+        в WHERE, по остальным полям — проверкой уже прочитанной записи.
+        """
+        column = self.time_column
+        where = []
+        params = []
+        if after is not None:
+            where.append(f"({column}, id) > (?, ?)")
+            params.extend(after)
+        if from_time is not None:
+            where.append(f"{column} >= ?")
+            params.append(from_time)
+        if to_time is not None:
+            where.append(f"{column} <= ?")
+            params.append(to_time)
+        rest = []
+        for field, value in (filters or {}).items():
+            if field in self.columns:
+                where.append(f"{field} = ?")
+                params.append(value)
+            else:
+                rest.append((field, value))
+        sql = f"SELECT id, {column}, record FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {column}, id"
+        if not rest:
+            sql += f" LIMIT {int(limit)}"
+
+        found = []
+        rows = self.db.connection().execute(sql, params)
+        try:
+            for key, time_value, record in rows:
+                record = json.loads(record)
+                if all(record.get(field) == value for field, value in rest):
+                    found.append((key, record))
+                    if len(found) == limit:
+                        return found, (time_value, key)
+        finally:
+            rows.close()
+        return found, None
+
+    def put(self, key, record):
+        """Сохранение записи; под write_lock — в составе его транзакции"""
+        values = (key,) + self._columns(record) + (
+            json.dumps(record, ensure_ascii=False, separators=(',', ':')),)
+        with self.db.write_lock:
+            started = time.perf_counter()
+            self.db.connection().execute(self._upsert, values)
+            self._write_seconds.observe(time.perf_counter() - started)
+
+    def _columns(self, record):
+        return ()
+
+    def _ids(self, sql, params=()):
+        return [row[0] for row in self.db.connection().execute(sql, params)]
+
+
+class SqliteTransactionStore(SqliteStore):
+    """TransactionStore поверх SQLite: pending и create_time — индексы таблицы"""
+
+    name = "Transactions"
+    table = "transactions"
+    columns = ("state", "account_key", "create_time")
+    time_column = "create_time"
+
+    def _columns(self, record):
+        return (record.get('state'), account_key(record.get('account')), record.get('create_time') or 0)
+
+    def pending_for_account(self, account):
+        return self._ids("SELECT id FROM transactions WHERE account_key = ? AND state = 1",
+                         (account_key(account),))
+
+    def pending_ids(self):
+        return self._ids("SELECT id FROM transactions WHERE state = 1")
+
+    def state(self, transaction_id):
+        row = self.db.connection().execute(
+            "SELECT state FROM transactions WHERE id = ?", (transaction_id,)).fetchone()
+        return row[0] if row else None
+
+    def range_by_create_time(self, from_time, to_time):
+        rows = self.db.connection().execute(
+            "SELECT id, record FROM transactions WHERE create_time BETWEEN ? AND ? "
+            "ORDER BY create_time, id", (from_time, to_time))
+        return [(tid, json.loads(record)) for tid, record in rows]
+
+
+class SqliteOrderStore(SqliteStore):
+    """OrderStore поверх SQLite: индексы device_id и status в таблице"""
+
+    name = "Orders"
+    table = "orders"
+    columns = ("device_id", "status", "created_at")
+    time_column = "created_at"
+
+    def __init__(self, db):
+        super().__init__(db)
+        # Тот же генератор id, что у OrderStore: уникален между процессами
+        self._order_ids = OrderIds()
+
+    def new_id(self, prefix="parfum"):
+        return self._order_ids.new(prefix)
+
+    def _columns(self, record):
+        return (record.get('device_id'), record.get('status'), record.get('created_at') or 0)
+
+    def ids_by_device(self, device_id):
+        return self._ids("SELECT id FROM orders WHERE device_id = ?", (device_id,))
+
+    def ids_by_status(self, status):
+        return self._ids("SELECT id FROM orders WHERE status = ?", (status,))
+
+
+class SqliteOutbox(MqttOutbox):
+    """
+    MqttOutbox с очередью в таблице outbox вместо файла журнала.
+
+    enqueue() из любого процесса — INSERT OR IGNORE (дубликат по key
+    отсекает UNIQUE); под write_lock сообщение фиксируется атомарно
+    вместе с изменением транзакции. Отправляет только процесс, который
+    вызвал start(): его поток забирает новые строки по возрастанию seq,
+    ack'и записываются пачками вне блокировок.
+    """
+
+    # Как часто (сек) забирать сообщения других процессов
+    poll_interval = 0.05
+
+    def __init__(self, bus, db, max_inflight=20, ack_timeout=30):
+        super().__init__(bus, db.path, max_inflight, ack_timeout)
+        self.db = db
+        self._last_seq = 0
+        self._acked_keys = []
+        self._prune = False
+
+    def load(self):
+        return self
+
+    def enqueue(self, topic, payload, key=None, qos=1, retain=False):
+        if key is None:
+            with self._cond:
+                self._seq += 1
+                key = f"auto:{os.getpid()}:{time.time_ns()}:{self._seq}"
+        with self.db.write_lock:
+            inserted = self.db.connection().execute(
+                "INSERT OR IGNORE INTO outbox (key, topic, payload, qos, retain, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, topic, json.dumps(payload, ensure_ascii=False), qos, int(retain), time.time())
+            ).rowcount
+        with self._cond:
+            if not inserted:
+                self.stats["duplicates"] += 1
+                return False
+            self.stats["enqueued"] += 1
+            self._cond.notify()
+        return True
+
+    def status(self):
+        status = super().status()
+        status["undelivered"] = self.db.connection().execute(
+            "SELECT COUNT(*) FROM outbox WHERE acked = 0").fetchone()[0]
+        return status
+
+    def _write(self, entry):
+        # Вызывается из _ack под _cond — запись в базу откладываем до _poll
+        if entry.get('op') == 'ack':
+            self._acked_keys.append(entry['key'])
+
+    def _compact(self):
+        self._acks_in_log = 0
+        self._prune = True
+
+    def _poll(self):
+        conn = self.db.connection()
+        with self._cond:
+            acked, self._acked_keys = self._acked_keys, []
+            prune, self._prune = self._prune, False
+        if acked:
+            with self.db.write_lock:
+                conn.executemany("UPDATE outbox SET acked = 1 WHERE key = ?", [(key,) for key in acked])
+        if prune:
+            # Доставленные ключи храним для дедупликации, но не бесконечно
+            with self.db.write_lock:
+                conn.execute("DELETE FROM outbox WHERE acked = 1 AND seq < "
+                             "(SELECT seq FROM outbox WHERE acked = 1 ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                             (DELIVERED_KEYS_MAX,))
+
+        # Транзакции записи в SQLite строго последовательны, поэтому seq
+        # фиксируются по возрастанию и новые строки всегда выше _last_seq
+        rows = conn.execute(
+            "SELECT seq, key, topic, payload, qos, retain, created FROM outbox "
+            "WHERE acked = 0 AND seq > ? ORDER BY seq LIMIT 500", (self._last_seq,)).fetchall()
+        if not rows:
+            return
+        with self._cond:
+            for seq, key, topic, payload, qos, retain, created in rows:
+                self._last_seq = seq
+                if key in self._messages:
+                    continue
+                self._messages[key] = {
+                    "op": "add", "key": key, "topic": topic, "payload": json.loads(payload),
+                    "qos": qos, "retain": bool(retain), "t": created
+                }
+                self._queue.append(key)
+
+
+class SqliteSalesRollup(SalesRollup):
+    """
+    SalesRollup для нескольких процессов: события переходов — строки
+    sales, которые воркер пишет после записи и публикации самой
+    транзакции Payme. Каждый процесс перед запросом дочитывает новые
+    строки по seq (как SqliteOutbox) в свои колонки.
+    """
+
+    def __init__(self, db, parfum_of):
+        super().__init__(parfum_of)
+        self.db = db
+        self._last_seq = 0
+        self._sync_lock = Lock()
+
+    def load(self, store):
+        # База, заполненная до появления сводок: события строятся один раз
+        with self.db.write_lock:
+            if self.db.connection().execute("SELECT 1 FROM sales LIMIT 1").fetchone() is None:
+                super().load(store)
+        self.sync()
+        return self
+
+    def record(self, record, previous=None):
+        events = self._events(record, previous)
+        if events:
+            with self.db.write_lock:
+                self.db.connection().executemany(
+                    "INSERT INTO sales (time, device_id, parfum_id, state, amount) VALUES (?, ?, ?, ?, ?)", events)
+
+    def sync(self):
+        with self._sync_lock:
+            rows = self.db.connection().execute(
+                "SELECT seq, time, device_id, parfum_id, state, amount FROM sales WHERE seq > ? ORDER BY seq",
+                (self._last_seq,))
+            for seq, *event in rows:
+                self._add(*event)
+                self._last_seq = seq
@@ -0,0 +1,546 @@
+import heapq
+import json
+import logging
+import os
+import secrets
+import time
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+from threading import Lock, Thread
+
+from metrics import registry
+
+log = logging.getLogger("store")
+
+STORE_WRITE_SECONDS = registry.histogram(
+    "store_write_seconds", "Journal append (write+flush[+fsync]) time", ["store"])
+STORE_COMPACT_SECONDS = registry.histogram(
+    "store_compact_seconds", "Snapshot write and log truncation time", ["store"])
+
+# Минимальное число записей в журнале перед компакцией
+SNAPSHOT_MIN_RECORDS = 1000
+
+# Число полос в StripedLock
+LOCK_STRIPES = 64
+
+# page() с фильтром по индексированному полю идёт по id из индекса, если
+# их не больше 1/INDEX_FILTER_RATIO записей; иначе совпадения часты и
+# проход по _by_time дешевле сортировки кандидатов
+INDEX_FILTER_RATIO = 8
+
+
+_time = itemgetter(0)
+
+
+def account_key(account):
+    """Канонический ключ account: одинаковые dict дают одинаковую строку"""
+    return json.dumps(account or {}, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+class StripedLock:
+    """
+    Набор блокировок, выбираемых по хэшу ключа: операции над одной
+    транзакцией идут строго по очереди, над разными — параллельно.
+    """
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._locks = [Lock() for _ in range(stripes)]
+
+    def lock(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class OrderIds:
+    """
+    Уникальные сортируемые id заказов: миллисекунды (12 hex) + счётчик
+    внутри одной миллисекунды (3 hex) + 40 случайных бит против совпадений
+    между процессами. Общий для OrderStore и SqliteOrderStore.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._last_ms = 0
+        self._seq = 0
+
+    def new(self, prefix="parfum"):
+        with self._lock:
+            ms = int(time.time() * 1000)
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                self._seq += 1
+                if self._seq > 0xfff:
+                    ms += 1
+                    self._seq = 0
+            else:
+                self._seq = 0
+            self._last_ms = ms
+            return f"{prefix}_{ms:012x}{self._seq:03x}{secrets.token_hex(5)}"
+
+
+class JournalStore:
+    """
+    Словарь записей в памяти + append-only журнал на диске.
+
+    Снимок (snapshot) лежит в path в формате {id: record}, каждое изменение
+    дописывается одной строкой в журнал path + ".log". При старте снимок
+    читается и журнал проигрывается поверх него. Когда журнал становится
+    длиннее самого снимка, делается компакция: под блокировкой журнал
+    только откладывается в path + ".log.old" (новые строки идут в пустой)
+    и копируется словарь, а снимок пишет и fsync'ает фоновый поток, после
+    чего отложенный журнал удаляется. Так запись стоит O(1) и не ждёт
+    снимка, а проигрывание журнала при старте не длиннее размера истории.
+
+    Чтение (get) идёт без блокировок: записи после put() не изменяются
+    (писатель всегда кладёт новый dict). Подклассы держат вторичные
+    индексы через _rebuild_indexes() и _index().
+
+    Если задан time_field, ведётся индекс _by_time: пары (время
+    создания, id), отсортированные целиком — по ним идут диапазоны и
+    постраничное чтение (page). Индекс публикуется атомарно, чтобы
+    читать его без блокировок: дописывание в конец видно читателю
+    целиком, вставка не по порядку делает копию и подменяет ссылку.
+
+    С archive (см. archive.Archiver) старые завершённые записи уходят из
+    памяти и снимка в неизменяемые сегменты: get(), page() и history()
+    ищут и там, запись в памяти заслоняет свою архивную версию.
+    """
+
+    name = "Records"
+    # Поле записи со временем создания (мс) для индекса _by_time
+    time_field = None
+
+    def __init__(self, path, snapshot_min=SNAPSHOT_MIN_RECORDS, fsync=False, archive=None):
+        self.path = path
+        self.log_path = path + ".log"
+        self.old_log_path = path + ".log.old"
+        self.snapshot_min = snapshot_min
+        self.fsync = fsync
+        self.archive = archive
+        self._data = {}
+        self._by_time = []
+        self._log = None
+        self._log_records = 0
+        self._write_lock = Lock()
+        self._compactor = None
+        # Компакция идёт (или не удалась — тогда до рестарта): не откладывать журнал снова
+        self._compacting = False
+        self._write_seconds = STORE_WRITE_SECONDS.labels(self.name)
+        self._compact_seconds = STORE_COMPACT_SECONDS.labels(self.name)
+
+    # ============ ЗАГРУЗКА ============
+    def load(self):
+        """Чтение снимка и проигрывание журнала"""
+        data = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except Exception as e:
+                log.warning("⚠️ Ошибка загрузки снимка %s: %s", self.path, e)
+
+        # Журнал, отложенный незаконченной компакцией, старше текущего;
+        # его записи уже могут быть в снимке — проигрывание идемпотентно
+        replayed = self._replay(self.old_log_path, data) + self._replay(self.log_path, data)
+
+        self._data = data
+        self._rebuild_indexes()
+        self._compacting = False
+        if os.path.exists(self.old_log_path):
+            # Компакция не закончилась до аварии: доводим её до старта
+            self._write_snapshot(data)
+            os.remove(self.old_log_path)
+            self._log = open(self.log_path, 'w', encoding='utf-8')
+            self._log_records = 0
+        else:
+            self._log_records = replayed
+            self._log = open(self.log_path, 'a', encoding='utf-8')
+        log.info("📂 %s loaded: %d (replayed %d log records)", self.name, len(data), replayed)
+        return self
+
+    def _replay(self, path, data):
+        """Проигрывание журнала path поверх data; число применённых строк"""
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        good_size = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Оборванная последняя строка после аварийного завершения
+                    log.warning("⚠️ Отброшен незавершённый хвост журнала: %r", line[:80])
+                    break
+                good_size += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning("⚠️ Пропущена повреждённая запись журнала: %r", line[:80])
+                    continue
+                if entry['tx'] is None:
+                    # Запись перенесена в архив
+                    data.pop(entry['id'], None)
+                else:
+                    data[entry['id']] = entry['tx']
+                replayed += 1
+        if good_size != os.path.getsize(path):
+            os.truncate(path, good_size)
+        return replayed
+
+    def close(self):
+        self._wait_compaction()
+        with self._write_lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    # ============ ЧТЕНИЕ ============
+    def get(self, key):
+        record = self._data.get(key)
+        if record is None and self.archive is not None:
+            record = self.archive.get(key)
+        return record
+
+    def __contains__(self, key):
+        return key in self._data or (self.archive is not None and key in self.archive)
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        return list(self._data.items())
+
+    def to_dict(self):
+        return dict(self._data)
+
+    def history(self):
+        """(id, запись) всех записей — из памяти, затем заархивированные"""
+        yield from self.items()
+        if self.archive is not None:
+            data = self._data
+            for (_, key), record in self.archive.scan():
+                if key not in data:
+                    yield key, record
+
+    def page(self, after=None, limit=100, from_time=None, to_time=None, filters=None):
+        """
+        До limit пар (id, запись) по возрастанию (время создания, id):
+        строго после курсора after = (время, id), в диапазоне
+        from_time..to_time, с record[поле] == значение для filters.
+        Возвращает (пары, курсор последней пары или None, если страница
+        неполная и дальше ничего нет).
+        """
+        filters = list((filters or {}).items())
+        found = []
+        for position, record in self._positions(after, from_time, to_time, self._candidates(filters)):
+            if all(record.get(field) == value for field, value in filters):
+                found.append((position[1], record))
+                if len(found) == limit:
+                    return found, position
+        return found, None
+
+    def _candidates(self, filters):
+        """id из самого узкого индекса по filters или None — идти по _by_time"""
+        best = None
+        for field, value in filters:
+            ids = self._indexed(field, value)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        if best is None or len(best) * INDEX_FILTER_RATIO > len(self._data):
+            return None
+        return best
+
+    def _indexed(self, field, value):
+        """id записей с record[field] == value по вторичному индексу (None — индекса нет)"""
+        return None
+
+    def _positions(self, after=None, from_time=None, to_time=None, ids=None):
+        """((время, id), запись) по возрастанию — из памяти (только ids, если заданы) и архива"""
+        hot = self._hot_positions(after, from_time, to_time, ids)
+        if self.archive is None or not self.archive.segments():
+            return hot
+        data = self._data
+        cold = ((position, record) for position, record in self.archive.scan(after, from_time, to_time)
+                if position[1] not in data)
+        return heapq.merge(hot, cold, key=_time)
+
+    def _hot_positions(self, after, from_time, to_time, ids=None):
+        data = self._data
+        if ids is None:
+            index = self._by_time
+        else:
+            index = sorted((self._record_time(record), key)
+                           for key, record in ((key, data.get(key)) for key in list(ids)) if record is not None)
+        lo = 0
+        if after is not None:
+            lo = bisect_right(index, tuple(after))
+        if from_time is not None:
+            lo = max(lo, bisect_left(index, from_time, key=_time))
+        for i in range(lo, len(index)):
+            position = index[i]
+            if to_time is not None and position[0] > to_time:
+                break
+            record = data.get(position[1])
+            if record is None:
+                # Перенесена в архив после того, как мы взяли индекс
+                record = self.get(position[1])
+            yield position, record
+
+    # ============ ИНДЕКСЫ ============
+    def _record_time(self, record):
+        return record.get(self.time_field) or 0
+
+    def _rebuild_indexes(self):
+        """Построение вторичных индексов по self._data после загрузки"""
+        if self.time_field:
+            self._by_time = sorted((self._record_time(record), key) for key, record in self._data.items())
+
+    def _index(self, key, old, new):
+        """Обновление вторичных индексов при замене old -> new (под _write_lock)"""
+        if self.time_field and old is None:
+            # Время создания не меняется — индексируем один раз
+            entry = (self._record_time(new), key)
+            if not self._by_time or entry >= self._by_time[-1]:
+                self._by_time.append(entry)
+            else:
+                index = list(self._by_time)
+                insort(index, entry)
+                self._by_time = index
+
+    def _unindex(self, key, old):
+        """Удаление из вторичных индексов при переносе в архив (_by_time — в evict)"""
+
+    # ============ ЗАПИСЬ ============
+    def put(self, key, record):
+        """
+        Сохранение новой версии записи: одна строка в журнал.
+        После put() record принадлежит хранилищу и не должен изменяться.
+        """
+        # Поле "tx" — исторический формат журнала транзакций
+        line = json.dumps({"id": key, "tx": record},
+                          ensure_ascii=False, separators=(',', ':'))
+        with self._write_lock:
+            started = time.perf_counter()
+            self._log.write(line + '\n')
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._write_seconds.observe(time.perf_counter() - started)
+            self._index(key, self._data.get(key), record)
+            self._data[key] = record
+            self._log_records += 1
+            if self._log_records >= max(self.snapshot_min, len(self._data)) and not self._compacting:
+                self._rotate()
+
+    def archivable(self, record, cutoff):
+        """Можно ли перенести запись в архив (завершена и не менялась с cutoff, мс)"""
+        return False
+
+    def evict(self, records):
+        """
+        Убирает из памяти записи, уже записанные в архив: только те пары
+        (id, запись), что не менялись с момента чтения. Журнал получает
+        строки удаления, снимок без них пишет фоновая компакция.
+        Возвращает число убранных записей.
+        """
+        with self._write_lock:
+            removed = [key for key, record in records if self._data.get(key) is record]
+            if not removed:
+                return 0
+            self._log.write(''.join(json.dumps({"id": key, "tx": None}, ensure_ascii=False) + '\n'
+                                    for key in removed))
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            gone = set(removed)
+            if self.time_field:
+                self._by_time = [position for position in self._by_time if position[1] not in gone]
+            for key in removed:
+                self._unindex(key, self._data.pop(key))
+            if not self._compacting:
+                self._rotate()
+        return len(removed)
+
+    def compact(self):
+        """Компакция с ожиданием снимка (бенчмарк, тесты)"""
+        self._wait_compaction()
+        with self._write_lock:
+            if not self._compacting:
+                self._rotate()
+        self._wait_compaction()
+
+    def _rotate(self):
+        """
+        Начало компакции (под _write_lock): журнал откладывается, новые
+        строки пишутся в пустой, снимок копии словаря пишет фоновый поток
+        """
+        self._log.close()
+        os.replace(self.log_path, self.old_log_path)
+        self._log = open(self.log_path, 'w', encoding='utf-8')
+        self._log_records = 0
+        self._compacting = True
+        # Записи после put() не изменяются — достаточно поверхностной копии
+        self._compactor = Thread(target=self._compact, args=(dict(self._data),),
+                                 name=f"{self.name.lower()}-compact", daemon=True)
+        self._compactor.start()
+
+    def _compact(self, data):
+        """Снимок на момент _rotate(), затем удаление отложенного журнала"""
+        started = time.perf_counter()
+        try:
+            self._write_snapshot(data)
+            os.remove(self.old_log_path)
+        except Exception:
+            # Отложенный журнал остаётся, новые не откладываются — load() доведёт компакцию
+            log.exception("💥 %s compaction failed", self.name)
+            return
+        self._compact_seconds.observe(time.perf_counter() - started)
+        self._compacting = False
+
+    def _write_snapshot(self, data):
+        """Атомарная запись снимка: временный файл, fsync, rename"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _wait_compaction(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+
+class TransactionStore(JournalStore):
+    """
+    Хранилище транзакций Payme (PROCESSED_FILE).
+
+    Вторичный индекс _pending: account_key -> множество id транзакций
+    в state 1. Поддерживается в put(), проверка ACCOUNT_PENDING — O(1).
+    Индекс по времени (_by_time) отсортирован по create_time,
+    GetStatement берёт диапазон бинарным поиском за O(log n + окно).
+    """
+
+    name = "Transactions"
+    time_field = "create_time"
+
+    def __init__(self, path, snapshot_min=SNAPSHOT_MIN_RECORDS, fsync=False, archive=None):
+        super().__init__(path, snapshot_min, fsync, archive)
+        self._pending = {}
+
+    def pending_for_account(self, account):
+        """id транзакций в state 1 для данного account"""
+        return self._pending.get(account_key(account), ())
+
+    def pending_ids(self):
+        """id всех транзакций в state 1 (по индексу, без прохода по истории)"""
+        return [tid for ids in list(self._pending.values()) for tid in list(ids)]
+
+    def state(self, transaction_id):
+        """state транзакции (None — нет такой); он же версия записи, см. ResultCache"""
+        record = self.get(transaction_id)
+        return record.get('state') if record is not None else None
+
+    def range_by_create_time(self, from_time, to_time):
+        """(id, запись) с from_time <= create_time <= to_time по возрастанию"""
+        return [(position[1], record) for position, record in self._positions(None, from_time, to_time)]
+
+    def _indexed(self, field, value):
+        if field == 'state' and value == 1:
+            return self.pending_ids()
+        return None
+
+    def archivable(self, record, cutoff):
+        # Оплату могут отменить и позже — возврат заслонит архивную версию
+        return record.get('state') in (2, -1, -2) and max(
+            record.get('create_time') or 0, record.get('perform_time') or 0, record.get('cancel_time') or 0) < cutoff
+
+    def _rebuild_indexes(self):
+        super()._rebuild_indexes()
+        self._pending = {}
+        for transaction_id, record in self._data.items():
+            self._index_pending(transaction_id, None, record)
+
+    def _index(self, transaction_id, old, new):
+        super()._index(transaction_id, old, new)
+        self._index_pending(transaction_id, old, new)
+
+    def _unindex(self, transaction_id, old):
+        self._index_pending(transaction_id, old, None)
+
+    def _index_pending(self, transaction_id, old, new):
+        if old is not None and old.get('state') == 1:
+            key = account_key(old.get('account'))
+            ids = self._pending.get(key)
+            if ids is not None:
+                ids.discard(transaction_id)
+                if not ids:
+                    del self._pending[key]
+        if new is not None and new.get('state') == 1:
+            self._pending.setdefault(account_key(new.get('account')), set()).add(transaction_id)
+
+
+class OrderStore(JournalStore):
+    """
+    Хранилище заказов автоматов (ORDERS_FILE).
+
+    id заказа упорядочены по времени и уникальны без координации между
+    процессами и автоматами (см. new_id). Вторичные индексы:
+    device_id -> id заказов и status -> id заказов, а также по
+    created_at для постраничного чтения.
+    """
+
+    name = "Orders"
+    time_field = "created_at"
+
+    def __init__(self, path, snapshot_min=SNAPSHOT_MIN_RECORDS, fsync=False, archive=None):
+        super().__init__(path, snapshot_min, fsync, archive)
+        self._by_device = {}
+        self._by_status = {}
+        self._order_ids = OrderIds()
+
+    def new_id(self, prefix="parfum"):
+        """Уникальный сортируемый id заказа (см. OrderIds)"""
+        return self._order_ids.new(prefix)
+
+    def ids_by_device(self, device_id):
+        return self._by_device.get(device_id, ())
+
+    def ids_by_status(self, status):
+        return self._by_status.get(status, ())
+
+    def _indexed(self, field, value):
+        if field == 'device_id':
+            return self._by_device.get(value, ())
+        if field == 'status':
+            return self._by_status.get(value, ())
+        return None
+
+    def archivable(self, record, cutoff):
+        return record.get('status') != 'pending' and (record.get('created_at') or 0) < cutoff
+
+    def _rebuild_indexes(self):
+        super()._rebuild_indexes()
+        self._by_device = {}
+        self._by_status = {}
+        for order_id, order in self._data.items():
+            self._index_fields(order_id, None, order)
+
+    def _index(self, order_id, old, new):
+        super()._index(order_id, old, new)
+        self._index_fields(order_id, old, new)
+
+    def _unindex(self, order_id, old):
+        self._index_fields(order_id, old, None)
+
+    def _index_fields(self, order_id, old, new):
+        for index, field in ((self._by_device, 'device_id'), (self._by_status, 'status')):
+            if old is not None:
+                if new is not None and old.get(field) == new.get(field):
+                    continue
+                ids = index.get(old.get(field))
+                if ids is not None:
+                    ids.discard(order_id)
+                    if not ids:
+                        del index[old.get(field)]
+            if new is not None:
+                index.setdefault(new.get(field), set()).add(order_id)
@@ -0,0 +1,635 @@
+import array
+import fcntl
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import time
+from collections import deque
+from threading import Condition, Thread
+
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy summarize считает циклом по строкам — медленнее, но верно
+    np = None
+
+from metrics import registry
+
+log = logging.getLogger("telemetry")
+
+TELEMETRY_EVENTS = registry.counter(
+    "telemetry_events", "Telemetry events by outcome", ["result"])
+TELEMETRY_FLUSH_SECONDS = registry.histogram(
+    "telemetry_flush_seconds", "Telemetry chunk write time")
+
+# Колонки сегмента: имя и тип элемента array
+COLUMNS = (("time", "q"), ("device", "I"), ("type", "H"), ("slot", "h"), ("value", "i"))
+ROW_BYTES = sum(array.array(typecode).itemsize for _, typecode in COLUMNS)
+
+# Заголовок блока: magic, число строк, min и max времени (мс)
+CHUNK_HEADER = struct.Struct("<4sIqq")
+CHUNK_MAGIC = b"TLM1"
+
+# Сколько строк в сегменте до перехода к следующему файлу
+SEGMENT_ROWS = 1 << 20
+
+# Блок пишется, когда набралось CHUNK_ROWS событий или прошло FLUSH_INTERVAL (сек)
+CHUNK_ROWS = 8192
+FLUSH_INTERVAL = 0.5
+
+# Сколько необработанных пачек держать в очереди
+QUEUE_MAX = 10000
+
+# Строковые поля событий, хранимые кодами из словаря
+STRING_KINDS = ("device", "type")
+MAX_STRING = 64
+
+# Каталоги завершившихся процессов сливаются в SHARED_DIR; проверка —
+# при старте и раз в COMPACT_INTERVAL (сек)
+SHARED_DIR = "shared"
+COMPACT_INTERVAL = 600
+
+# flock: DIR_LOCK держит живой процесс-владелец каталога, COMPACT_LOCK —
+# читатели (общая) и слияние (исключительная). COMPACT_INTENT — какой
+# каталог сливается и с какого места в SHARED_DIR (откат после аварии)
+DIR_LOCK = ".lock"
+COMPACT_LOCK = ".compact.lock"
+COMPACT_INTENT = "compact.json"
+MERGED_PREFIX = ".merged-"
+
+# Типы колонок для чтения через NumPy (little-endian, как на диске)
+NUMPY_TYPES = {"q": "<i8", "I": "<u4", "H": "<u2", "h": "<i2", "i": "<i4"}
+# Группировка через bincount, пока пространство ключей не больше
+# DENSE_RATIO x строк (как в analytics)
+DENSE_RATIO = 4
+
+
+def new_columns():
+    return [array.array(typecode) for _, typecode in COLUMNS]
+
+
+def read_chunks(path):
+    """(offset, строк, min, max времени) полных блоков; второй результат — размер без оборванного хвоста"""
+    chunks = []
+    good_size = 0
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                break
+            magic, rows, t_min, t_max = CHUNK_HEADER.unpack(header)
+            end = good_size + CHUNK_HEADER.size + rows * ROW_BYTES
+            if magic != CHUNK_MAGIC or end > size:
+                break
+            chunks.append((good_size, rows, t_min, t_max))
+            good_size = end
+            f.seek(end)
+    return chunks, good_size
+
+
+def split_columns(raw, rows):
+    """Колонки array из байтов блока"""
+    columns = []
+    start = 0
+    for _, typecode in COLUMNS:
+        column = array.array(typecode)
+        size = rows * column.itemsize
+        column.frombytes(raw[start:start + size])
+        if sys.byteorder != "little":
+            column.byteswap()
+        columns.append(column)
+        start += size
+    return columns
+
+
+def read_strings(path):
+    """Словари kind -> [значение по коду] и размер файла без оборванной строки"""
+    strings = {kind: [] for kind in STRING_KINDS}
+    good_size = 0
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                kind, value = json.loads(line)
+                strings[kind].append(value)
+                good_size += len(line)
+    return strings, good_size
+
+
+class SegmentWriter:
+    """
+    Append-only колоночное хранилище событий одного процесса.
+
+    Каталог с сегментами seg-NNNNNN.col. Сегмент — последовательность
+    блоков: заголовок CHUNK_HEADER и колонки COLUMNS подряд, каждая —
+    массив фиксированного типа (little-endian). device_id и тип события
+    заменены кодами из strings.log; словарь дописывается раньше блока,
+    который ссылается на новые коды. Оборванный хвост после аварии
+    отбрасывается при открытии.
+    """
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self.rows = 0
+        self._codes = {}
+        self._strings = None
+        self._segment = None
+        self._segment_index = 0
+        self._segment_rows = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        strings_path = os.path.join(self.directory, "strings.log")
+        strings, good_size = read_strings(strings_path)
+        if os.path.exists(strings_path) and good_size != os.path.getsize(strings_path):
+            os.truncate(strings_path, good_size)
+        self._codes = {kind: {value: code for code, value in enumerate(values)}
+                       for kind, values in strings.items()}
+        self._strings = open(strings_path, 'a', encoding='utf-8')
+
+        segments = segment_paths(self.directory)
+        if segments:
+            path = segments[-1]
+            self._segment_index = int(os.path.basename(path)[4:10])
+            chunks, good_size = read_chunks(path)
+            if good_size != os.path.getsize(path):
+                log.warning("⚠️ Отброшен незавершённый блок телеметрии: %s", path)
+                os.truncate(path, good_size)
+            self._segment_rows = sum(rows for _, rows, _, _ in chunks)
+            self._segment = open(path, 'ab')
+        else:
+            self._roll()
+        return self
+
+    def close(self):
+        for f in (self._segment, self._strings):
+            if f:
+                f.close()
+
+    def code(self, kind, value):
+        """Код строки; новая строка сразу дописывается в словарь"""
+        codes = self._codes[kind]
+        code = codes.get(value)
+        if code is None:
+            if not isinstance(value, str) or len(value) > MAX_STRING:
+                raise ValueError(f"Invalid {kind}: {value!r}")
+            code = codes[value] = len(codes)
+            self._strings.write(json.dumps([kind, value], ensure_ascii=False) + '\n')
+        return code
+
+    def append(self, columns):
+        """Один блок из колонок одинаковой длины"""
+        rows = len(columns[0])
+        if not rows:
+            return
+        if self._segment_rows >= SEGMENT_ROWS:
+            self._roll()
+        self._strings.flush()
+        times = columns[0]
+        parts = [CHUNK_HEADER.pack(CHUNK_MAGIC, rows, min(times), max(times))]
+        for column in columns:
+            if sys.byteorder != "little":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        self._segment.write(b''.join(parts))
+        self._segment.flush()
+        if self.fsync:
+            os.fsync(self._strings.fileno())
+            os.fsync(self._segment.fileno())
+        self._segment_rows += rows
+        self.rows += rows
+
+    def position(self):
+        """(номер сегмента, размер) — куда ляжет следующий блок"""
+        return self._segment_index, self._segment.tell()
+
+    def _roll(self):
+        if self._segment:
+            self._segment.close()
+        self._segment_index += 1
+        path = os.path.join(self.directory, f"seg-{self._segment_index:06d}.col")
+        self._segment = open(path, 'ab')
+        self._segment_rows = 0
+
+
+def segment_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith("seg-") and name.endswith(".col"))
+
+
+def _open_lock(path):
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+
+def _segments(root, from_time=None, to_time=None):
+    """
+    По сегментам всех процессов: (словари kind -> [значение по коду],
+    [(строк, байты колонок)] блоков, пересекающих from_time..to_time).
+    Блоки вне диапазона пропускаются по заголовку без чтения колонок.
+    Слияние (compact) на время чтения не начинается.
+    """
+    if not os.path.isdir(root):
+        return
+    guard = _open_lock(os.path.join(root, COMPACT_LOCK))
+    try:
+        fcntl.flock(guard, fcntl.LOCK_SH)
+        for name in sorted(os.listdir(root)):
+            directory = os.path.join(root, name)
+            if name.startswith(".") or not os.path.isdir(directory):
+                continue
+            # Сначала блоки, потом словарь: словарь дописывается раньше
+            # блока, так что в нём есть все коды прочитанных блоков
+            segments = [(path, read_chunks(path)[0]) for path in segment_paths(directory)]
+            strings, _ = read_strings(os.path.join(directory, "strings.log"))
+            for path, chunks in segments:
+                found = []
+                with open(path, 'rb') as f:
+                    for offset, rows, t_min, t_max in chunks:
+                        if (from_time is not None and t_max < from_time) or (to_time is not None and t_min > to_time):
+                            continue
+                        f.seek(offset + CHUNK_HEADER.size)
+                        found.append((rows, f.read(rows * ROW_BYTES)))
+                if found:
+                    yield strings, found
+    finally:
+        os.close(guard)
+
+
+def scan(root, from_time=None, to_time=None):
+    """Блоки всех процессов, пересекающие from_time..to_time: (колонки, словари kind -> [значение по коду])"""
+    for strings, chunks in _segments(root, from_time, to_time):
+        for rows, raw in chunks:
+            yield split_columns(raw, rows), strings
+
+
+def summarize(root, from_time=None, to_time=None, device_id=None):
+    """Число событий, сумма value и последнее время по (device_id, тип, slot)"""
+    totals = {}
+    aggregate = _aggregate_numpy if np is not None else _aggregate_loop
+    for strings, chunks in _segments(root, from_time, to_time):
+        device = None
+        if device_id is not None:
+            if device_id not in strings["device"]:
+                continue
+            device = strings["device"].index(device_id)
+        for (device_code, kind, slot), count, value_sum, last in aggregate(chunks, from_time, to_time, device):
+            key = (strings["device"][device_code], strings["type"][kind], slot)
+            entry = totals.get(key)
+            if entry is None:
+                totals[key] = [count, value_sum, last]
+            else:
+                entry[0] += count
+                entry[1] += value_sum
+                entry[2] = max(entry[2], last)
+    return [
+        {"device_id": device, "type": kind, "slot": slot, "count": count, "value_sum": value_sum, "last_time": last}
+        for (device, kind, slot), (count, value_sum, last) in sorted(totals.items())
+    ]
+
+
+def _aggregate_loop(chunks, from_time, to_time, device):
+    totals = {}
+    for rows, raw in chunks:
+        for t, event_device, kind, slot, value in zip(*split_columns(raw, rows)):
+            if (from_time is not None and t < from_time) or (to_time is not None and t > to_time):
+                continue
+            if device is not None and event_device != device:
+                continue
+            key = (event_device, kind, slot)
+            entry = totals.get(key)
+            if entry is None:
+                totals[key] = [1, value, t]
+            else:
+                entry[0] += 1
+                entry[1] += value
+                if t > entry[2]:
+                    entry[2] = t
+    return [(key, count, value_sum, last) for key, (count, value_sum, last) in totals.items()]
+
+
+def _aggregate_numpy(chunks, from_time, to_time, device):
+    """
+    Группировка колонок сегмента: ключ — смешанная система счисления по
+    (device, тип, slot), суммы — bincount и ufunc.at без сортировки;
+    разреженные ключи нумеруются через np.unique
+    """
+    parts = [[] for _ in COLUMNS]
+    for rows, raw in chunks:
+        offset = 0
+        for part, (_, typecode) in zip(parts, COLUMNS):
+            part.append(np.frombuffer(raw, dtype=NUMPY_TYPES[typecode], count=rows, offset=offset))
+            offset += rows * np.dtype(NUMPY_TYPES[typecode]).itemsize
+    times, devices, types, slots, values = (np.concatenate(part) for part in parts)
+
+    conditions = []
+    if from_time is not None:
+        conditions.append(times >= from_time)
+    if to_time is not None:
+        conditions.append(times <= to_time)
+    if device is not None:
+        conditions.append(devices == device)
+    if conditions:
+        rows = np.flatnonzero(np.logical_and.reduce(conditions))
+        times, devices, types, slots, values = (column.take(rows) for column in (times, devices, types, slots, values))
+    if not len(times):
+        return []
+
+    key = np.zeros(len(times), dtype=np.int64)
+    bases = []
+    space = 1
+    for column in (devices, types, slots):
+        low = int(column.min())
+        radix = int(column.max()) - low + 1
+        key *= radix
+        key += column
+        key -= low
+        bases.append((low, radix))
+        space *= radix
+    if space > DENSE_RATIO * len(key) + 1024:
+        groups, key = np.unique(key, return_inverse=True)
+        space = len(groups)
+    else:
+        groups = None
+
+    counts = np.bincount(key, minlength=space)
+    sums = np.zeros(space, dtype=np.int64)
+    np.add.at(sums, key, values)
+    lasts = np.full(space, np.iinfo(np.int64).min)
+    np.maximum.at(lasts, key, times)
+    present = np.flatnonzero(counts)
+
+    rest = groups[present] if groups is not None else present
+    fields = []
+    for low, radix in reversed(bases):
+        fields.append((rest % radix + low).tolist())
+        rest = rest // radix
+    device_codes, kinds, slot_values = reversed(fields)
+    return [
+        ((device_code, kind, slot), count, value_sum, last)
+        for device_code, kind, slot, count, value_sum, last in zip(
+            device_codes, kinds, slot_values,
+            counts[present].tolist(), sums[present].tolist(), lasts[present].tolist())
+    ]
+
+
+def claim_directory(root, directory):
+    """
+    Каталог сегментов процесса: flock на DIR_LOCK держится до конца
+    процесса (снимает ОС), по нему compact() отличает живых. Создание
+    и захват — под COMPACT_LOCK, чтобы слияние не забрало пустой каталог.
+    """
+    os.makedirs(root, exist_ok=True)
+    guard = _open_lock(os.path.join(root, COMPACT_LOCK))
+    try:
+        fcntl.flock(guard, fcntl.LOCK_SH)
+        os.makedirs(directory, exist_ok=True)
+        fd = _open_lock(os.path.join(directory, DIR_LOCK))
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+    finally:
+        os.close(guard)
+
+
+def compact(root):
+    """
+    Сливает каталоги w<pid> завершившихся процессов в root/SHARED_DIR:
+    коды строк переводятся в общий словарь, мелкие блоки собираются в
+    блоки по CHUNK_ROWS. Пропускается, пока идёт чтение или слияние в
+    другом процессе. Возвращает число слитых каталогов.
+    """
+    if not os.path.isdir(root):
+        return 0
+    guard = _open_lock(os.path.join(root, COMPACT_LOCK))
+    try:
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return 0
+        shared = os.path.join(root, SHARED_DIR)
+        os.makedirs(shared, exist_ok=True)
+        _recover(root, shared)
+        merged = 0
+        for name in sorted(os.listdir(root)):
+            directory = os.path.join(root, name)
+            if not name.startswith("w") or not os.path.isdir(directory):
+                continue
+            owner = _open_lock(os.path.join(directory, DIR_LOCK))
+            try:
+                try:
+                    fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Процесс жив (или это наш каталог)
+                    continue
+                _merge(root, directory, shared)
+                merged += 1
+            finally:
+                os.close(owner)
+        return merged
+    finally:
+        os.close(guard)
+
+
+def _recover(root, shared):
+    """Откат недоделанного слияния: хвост SHARED_DIR после отметки — повтор того, что ещё лежит в источнике"""
+    intent_path = os.path.join(shared, COMPACT_INTENT)
+    if os.path.exists(intent_path):
+        with open(intent_path) as f:
+            intent = json.load(f)
+        if os.path.isdir(os.path.join(root, intent["source"])):
+            log.warning("⚠️ Откат незавершённого слияния телеметрии: %s", intent["source"])
+            for path in segment_paths(shared):
+                index = int(os.path.basename(path)[4:10])
+                if index > intent["segment"]:
+                    os.remove(path)
+                elif index == intent["segment"]:
+                    os.truncate(path, intent["size"])
+        os.remove(intent_path)
+    for name in os.listdir(root):
+        if name.startswith(MERGED_PREFIX):
+            shutil.rmtree(os.path.join(root, name))
+
+
+def _merge(root, directory, shared):
+    segments = [(path, read_chunks(path)[0]) for path in segment_paths(directory)]
+    strings, _ = read_strings(os.path.join(directory, "strings.log"))
+    writer = SegmentWriter(shared, fsync=True).open()
+    try:
+        segment, size = writer.position()
+        intent_path = os.path.join(shared, COMPACT_INTENT)
+        with open(intent_path + ".tmp", 'w') as f:
+            json.dump({"source": os.path.basename(directory), "segment": segment, "size": size}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(intent_path + ".tmp", intent_path)
+
+        device_codes = [writer.code("device", value) for value in strings["device"]]
+        type_codes = [writer.code("type", value) for value in strings["type"]]
+        columns = new_columns()
+        rows = 0
+        for path, chunks in segments:
+            with open(path, 'rb') as f:
+                for offset, chunk_rows, _, _ in chunks:
+                    f.seek(offset + CHUNK_HEADER.size)
+                    times, devices, types, slots, values = split_columns(f.read(chunk_rows * ROW_BYTES), chunk_rows)
+                    columns[0].extend(times)
+                    columns[1].extend(array.array("I", map(device_codes.__getitem__, devices)))
+                    columns[2].extend(array.array("H", map(type_codes.__getitem__, types)))
+                    columns[3].extend(slots)
+                    columns[4].extend(values)
+                    rows += chunk_rows
+                    if len(columns[0]) >= CHUNK_ROWS:
+                        writer.append(columns)
+                        columns = new_columns()
+        writer.append(columns)
+    finally:
+        writer.close()
+
+    # Источник убирается переименованием (атомарно), затем отметка и файлы
+    trash = os.path.join(root, MERGED_PREFIX + os.path.basename(directory))
+    os.rename(directory, trash)
+    os.remove(intent_path)
+    shutil.rmtree(trash)
+    log.info("🗜️ Telemetry %s merged into %s: %d event(s)", os.path.basename(directory), SHARED_DIR, rows)
+
+
+class TelemetryIngest:
+    """
+    Приём пачек событий от автоматов (MQTT telemetry/... и POST /api/telemetry).
+
+    submit() только кладёт сырые байты в очередь — в сетевом потоке paho
+    и в потоке запроса нет ни разбора JSON, ни записи на диск. Фоновый
+    поток разбирает пачки в колонки и пишет их блоками по CHUNK_ROWS
+    (или раз в FLUSH_INTERVAL) в SegmentWriter своего процесса:
+    root/w<pid>, так что воркеры gunicorn не делят файлы. Каталоги
+    завершившихся процессов тот же поток сливает в root/shared (compact).
+
+    Пачка: {"device_id": ..., "m": millis() при отправке,
+    "e": [[millis(), тип, slot, value], ...]}. Время события на сервере —
+    время приёма минус (m - millis()), часы автомату не нужны; вместо
+    времени приёма можно передать "t" (мс Unix при отправке). Тело POST —
+    пачка или список пачек.
+    """
+
+    def __init__(self, root, queue_max=QUEUE_MAX, fsync=False):
+        self.root = root
+        self.queue_max = queue_max
+        self.fsync = fsync
+        self.writer = None
+        self._dir_lock = None
+        self._queue = deque()
+        self._cond = Condition()
+        self._worker = None
+        self._stored = TELEMETRY_EVENTS.labels("stored")
+        self._invalid = TELEMETRY_EVENTS.labels("invalid")
+        self._dropped = TELEMETRY_EVENTS.labels("dropped")
+
+    def submit(self, payload, device_id=None):
+        """Пачка в очередь; False — очередь переполнена, пачка отброшена"""
+        with self._cond:
+            if len(self._queue) >= self.queue_max:
+                self._dropped.inc()
+                return False
+            self._queue.append((payload, device_id, int(time.time() * 1000)))
+            self._cond.notify()
+        return True
+
+    def start(self):
+        if self._worker is None:
+            directory = os.path.join(self.root, f"w{os.getpid()}")
+            self._dir_lock = claim_directory(self.root, directory)
+            self.writer = SegmentWriter(directory, self.fsync).open()
+            self._worker = Thread(target=self._run, name="telemetry-ingest", daemon=True)
+            self._worker.start()
+        return self
+
+    def status(self):
+        with self._cond:
+            return {"queue_depth": len(self._queue), "stored": self.writer.rows if self.writer else 0}
+
+    def _run(self):
+        columns = new_columns()
+        flushed_at = time.monotonic()
+        compacted_at = None
+        while True:
+            if compacted_at is None or time.monotonic() - compacted_at >= COMPACT_INTERVAL:
+                compacted_at = time.monotonic()
+                try:
+                    compact(self.root)
+                except Exception:
+                    log.exception("💥 Telemetry compaction failed")
+
+            with self._cond:
+                if not self._queue:
+                    self._cond.wait(timeout=FLUSH_INTERVAL)
+                items = list(self._queue)
+                self._queue.clear()
+
+            for payload, device_id, received_ms in items:
+                self._decode(payload, device_id, received_ms, columns)
+
+            rows = len(columns[0])
+            if rows and (rows >= CHUNK_ROWS or time.monotonic() - flushed_at >= FLUSH_INTERVAL):
+                try:
+                    with TELEMETRY_FLUSH_SECONDS.time():
+                        self.writer.append(columns)
+                    self._stored.inc(rows)
+                except Exception:
+                    log.exception("💥 Telemetry write failed, %d event(s) lost", rows)
+                columns = new_columns()
+                flushed_at = time.monotonic()
+            elif not rows:
+                flushed_at = time.monotonic()
+
+    def _decode(self, payload, device_id, received_ms, columns):
+        try:
+            batches = json.loads(payload)
+        except ValueError:
+            self._invalid.inc()
+            return
+        if isinstance(batches, dict):
+            batches = [batches]
+        if not isinstance(batches, list):
+            self._invalid.inc()
+            return
+        for batch in batches:
+            self._decode_batch(batch, device_id, received_ms, columns)
+
+    def _decode_batch(self, batch, device_id, received_ms, columns):
+        times, devices, types, slots, values = columns
+        code = self.writer.code
+        try:
+            device = code("device", batch.get("device_id") or device_id or "")
+            events = batch["e"]
+            sent = batch.get("m")
+            base = batch.get("t") or received_ms
+        except (AttributeError, KeyError, TypeError, ValueError):
+            self._invalid.inc()
+            return
+
+        invalid = 0
+        for event in events if isinstance(events, list) else ():
+            rows = len(times)
+            try:
+                ms = event[0]
+                times.append(int(base - (sent - ms)) if sent is not None else int(ms))
+                kind = code("type", event[1])
+                slot = event[2] if len(event) > 2 else 0
+                value = event[3] if len(event) > 3 else 0
+                devices.append(device)
+                types.append(kind)
+                slots.append(slot)
+                values.append(value)
+            except (IndexError, KeyError, OverflowError, TypeError, ValueError):
+                # Колонки должны остаться одной длины
+                for column in columns:
+                    del column[rows:]
+                invalid += 1
+        if invalid:
+            self._invalid.inc(invalid)
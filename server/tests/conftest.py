@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# Модули сервера импортируются как соседние (как их запускает app.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """
+    Модуль app с приложением на временных файлах: настройки — глобальные
+    имена модуля, поэтому приложение одно на всю сессию тестов
+    """
+    workdir = tmp_path_factory.mktemp("payme")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import app as module
+    module.create_app(dict(
+        PROCESSED_FILE=str(workdir / "processed.json"),
+        PROCESSED_SNAPSHOT_MIN=50,
+        ORDERS_FILE=str(workdir / "orders.json"),
+        OUTBOX_FILE=str(workdir / "outbox.log"),
+        PRICES_FILE=str(workdir / "prices.json"),
+        TELEMETRY_DIR=str(workdir / "telemetry"),
+        ARCHIVE_DIR=str(workdir / "archive"),
+        ENV_FILE=str(workdir / ".env"),
+        DEBUG_ALLOW_ANY=True,
+        MESSAGE_BUS="local",
+        LOG_LEVEL="WARNING",
+    ))
+    module.start_background()
+    yield module
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
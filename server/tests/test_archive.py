@@ -0,0 +1,78 @@
+"""
+Архив завершённых записей: сегменты пишутся и сливаются попарно,
+новая версия заслоняет старую; GetStatement и возврат оплаты читают
+архивные транзакции так же, как из памяти.
+"""
+import math
+import time
+
+from analytics import SalesRollup
+from archive import Archive, Archiver
+from store import TransactionStore
+
+
+def test_segments_merge_and_newest_version_wins(tmp_path):
+    archive = Archive(str(tmp_path / "archive")).load()
+    for batch in range(40):
+        archive.add([(batch * 10 + i, f"r{batch}-{i}", {"n": batch, "i": i}) for i in range(5)])
+    # Возврат: запись r0-0 с тем же временем, новая версия
+    archive.add([(0, "r0-0", {"n": 0, "i": 0, "state": -2})])
+
+    assert len(list(archive.scan())) == 200
+    assert archive.segments() <= math.ceil(math.log2(201)) + 1
+    assert archive.get("r0-0")["state"] == -2
+    assert archive.get("r7-3") == {"n": 7, "i": 3}
+    assert archive.get("missing") is None
+    assert [key for (_, key), _ in archive.scan(from_time=100, to_time=112)] == \
+        ["r10-0", "r10-1", "r10-2", "r10-3", "r10-4", "r11-0", "r11-1", "r11-2"]
+    assert [key for (_, key), _ in archive.scan(after=(394, "r39-4"))] == []
+
+    reopened = Archive(str(tmp_path / "archive")).load()
+    assert list(reopened.scan()) == list(archive.scan())
+    assert reopened.get("r0-0")["state"] == -2
+    archive.close()
+    reopened.close()
+
+
+def rpc(client, method, **params):
+    return client.post("/payme", json={"id": 3, "method": method, "params": params}).get_json()
+
+
+def test_statement_and_refund_read_archive(server, client, tmp_path, monkeypatch):
+    # Отдельное хранилище: архивирование не трогает транзакции других тестов
+    store = TransactionStore(str(tmp_path / "processed.json"),
+                             archive=Archive(str(tmp_path / "archive")).load()).load()
+    monkeypatch.setattr(server, "transactions", store)
+    monkeypatch.setattr(server, "sales", SalesRollup(server.parfum_of))
+
+    ids = [f"arc-t{i}" for i in range(6)]
+    for i, transaction_id in enumerate(ids):
+        rpc(client, "CreateTransaction", id=transaction_id, time=0, amount=500000, account={"a": f"arc{i}"})
+        if i % 3 == 2:
+            rpc(client, "CancelTransaction", id=transaction_id, reason=3)
+        else:
+            rpc(client, "PerformTransaction", id=transaction_id)
+
+    statement = rpc(client, "GetStatement", **{"from": 0, "to": 2 ** 53})["result"]
+    checks = [rpc(client, "CheckTransaction", id=transaction_id)["result"] for transaction_id in ids]
+    moved = Archiver([store], max_age_ms=1).run_once(now_ms=int(time.time() * 1000) + 1000, min_records=0)
+    assert moved == {store.name: 6} and len(store) == 0
+
+    assert rpc(client, "GetStatement", **{"from": 0, "to": 2 ** 53})["result"] == statement
+    assert [rpc(client, "CheckTransaction", id=transaction_id)["result"] for transaction_id in ids] == checks
+
+    # Возврат архивной оплаты: новая версия в памяти заслоняет архивную
+    refund = rpc(client, "CancelTransaction", id="arc-t1", reason=5)["result"]
+    assert refund["state"] == -2
+    assert rpc(client, "CheckTransaction", id="arc-t1")["result"]["state"] == -2
+    statement = rpc(client, "GetStatement", **{"from": 0, "to": 2 ** 53})["result"]
+    states = {t["id"]: t["state"] for t in statement["transactions"]}
+    assert states == {"arc-t0": 2, "arc-t1": -2, "arc-t2": -1, "arc-t3": 2, "arc-t4": 2, "arc-t5": -1}
+    assert server.sales.query(group_by=())[0]["refunds"] == 1
+
+    # Повторная отмена отвечает тем же, после перезапуска — тоже
+    assert rpc(client, "CancelTransaction", id="arc-t1", reason=5)["result"] == refund
+    store.close()
+    reopened = TransactionStore(store.path, archive=Archive(str(tmp_path / "archive")).load()).load()
+    assert dict(reopened.history())["arc-t1"]["state"] == -2
+    assert len(dict(reopened.history())) == 6
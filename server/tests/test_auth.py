@@ -0,0 +1,33 @@
+"""
+Ключи Payme: при старте окружение важнее .env, после старта правка
+.env (ротация) применяется поверх окружения.
+"""
+import base64
+import os
+import time
+
+import auth
+from auth import AuthVerifier
+
+
+def header(key):
+    return "Basic " + base64.b64encode(f"Paycom:{key}".encode()).decode()
+
+
+def test_environment_wins_over_stale_env_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "STAT_INTERVAL", 0)
+    env_file = tmp_path / ".env"
+    env_file.write_text("PAYME_KEY=stale\nTEST_MODE=true\n")
+    verifier = AuthVerifier(str(env_file), base={"PAYME_KEY": "deployed", "TEST_MODE": "false"})
+
+    assert verifier.verify(header("deployed"))
+    assert not verifier.verify(header("stale"))
+    assert not verifier.test_mode
+
+    # Ротация: поменяли только ключ — устаревший TEST_MODE из файла не применяется
+    env_file.write_text("PAYME_KEY=rotated,deployed\nTEST_MODE=true\n")
+    later = time.time() + 5
+    os.utime(env_file, (later, later))
+    assert verifier.verify(header("rotated"))
+    assert verifier.verify(header("deployed"))
+    assert not verifier.test_mode
@@ -0,0 +1,51 @@
+"""
+Готовые ответы для повторов Payme: повтор берётся из кэша, смена
+state транзакции делает старый ответ недоступным.
+"""
+from cache import RESULT_CACHE_LOOKUPS, ResultCache
+
+
+def rpc(client, method, **params):
+    return client.post("/payme", json={"id": 7, "method": method, "params": params})
+
+
+def lookups():
+    return RESULT_CACHE_LOOKUPS.labels("hit").value, RESULT_CACHE_LOOKUPS.labels("miss").value
+
+
+def test_lru_evicts_oldest_and_zero_size_disables():
+    cache = ResultCache(maxsize=2)
+    cache.put(("CheckTransaction", "a", 1), {"state": 1})
+    cache.put(("CheckTransaction", "b", 1), {"state": 1})
+    assert cache.get(("CheckTransaction", "a", 1)) == '{"state":1}'
+    cache.put(("CheckTransaction", "c", 1), {"state": 1})
+    assert cache.get(("CheckTransaction", "b", 1)) is None
+    assert cache.get(("CheckTransaction", "a", 1)) is not None
+
+    disabled = ResultCache(maxsize=0)
+    assert disabled.put(("CheckTransaction", "a", 1), {"state": 1}) == '{"state":1}'
+    assert len(disabled) == 0
+
+
+def test_retry_hits_and_state_change_misses(client):
+    account = {"a": "cache"}
+    created = rpc(client, "CreateTransaction", id="cache-t1", time=0, amount=500000, account=account)
+    assert created.get_json()["result"]["state"] == 1
+
+    hits, misses = lookups()
+    retry = rpc(client, "CreateTransaction", id="cache-t1", time=0, amount=500000, account=account)
+    assert retry.data == created.data
+    assert lookups() == (hits + 1, misses)
+
+    first = rpc(client, "CheckTransaction", id="cache-t1")
+    assert first.get_json()["result"]["state"] == 1
+    hits, misses = lookups()
+    assert rpc(client, "CheckTransaction", id="cache-t1").data == first.data
+    assert lookups() == (hits + 1, misses)
+
+    # Perform меняет state: ответ для state 1 больше не совпадает по ключу
+    assert rpc(client, "PerformTransaction", id="cache-t1").get_json()["result"]["state"] == 2
+    hits, misses = lookups()
+    checked = rpc(client, "CheckTransaction", id="cache-t1").get_json()["result"]
+    assert checked["state"] == 2 and checked["perform_time"] > 0
+    assert lookups() == (hits, misses + 1)
@@ -0,0 +1,56 @@
+"""
+Стресс-тест конечного автомата транзакций: потоки одновременно шлют
+Create/Perform/Cancel/Check по общим id транзакций и account. После
+прогона состояния валидны, pending не больше одной на account, журнал
+проигрывается в то же состояние (bench.check_consistency).
+"""
+import random
+import threading
+
+THREADS = 16
+REQUESTS = 150
+TRANSACTION_IDS = 80
+ACCOUNTS = 6
+METHODS = ("CreateTransaction", "PerformTransaction", "CancelTransaction", "CheckTransaction")
+
+
+def test_state_machine_under_concurrency(server):
+    from bench import check_consistency
+
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = server.app.test_client()
+        for _ in range(REQUESTS):
+            params = {
+                "id": f"t{rng.randrange(TRANSACTION_IDS)}",
+                "time": 0,
+                "amount": 500000,
+                "account": {"a": str(rng.randrange(ACCOUNTS))},
+                "reason": 1,
+            }
+            response = client.post("/payme", json={"id": 1, "method": rng.choice(METHODS), "params": params})
+            body = response.get_json()
+            if response.status_code != 200 or body.get("error", {}).get("code") == -32400:
+                errors.append(body)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors[:3]
+    live = server.transactions.to_dict()
+    for tid, tx in live.items():
+        # Отмена после оплаты — только у оплаченной, до оплаты — только у неоплаченной
+        assert (tx["state"] in (2, -2)) == bool(tx.get("perform_time")), (tid, tx)
+    performed = sum(1 for tx in live.values() if tx.get("perform_time"))
+    refunds = sum(1 for tx in live.values() if tx["state"] == -2)
+    # Сводки продаж учитывают каждую оплату и возврат ровно один раз
+    totals = server.sales.query(group_by=()) or [{"sales": 0, "refunds": 0}]
+    assert (totals[0]["sales"], totals[0]["refunds"]) == (performed, refunds)
+    assert check_consistency(server) == len(live)
+    # check_consistency закрывает журнал — открываем снова для остальных тестов
+    server.transactions.load()
@@ -0,0 +1,37 @@
+"""
+Журнал outbox: enqueue() возвращается после fsync, параллельные
+enqueue делят один fsync, неподтверждённое восстанавливается.
+"""
+import os
+import threading
+
+import outbox
+from bus import LocalBus
+from outbox import MqttOutbox
+
+
+def test_enqueue_is_synced_and_restored(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(outbox.os, "fsync", counting_fsync)
+    path = str(tmp_path / "outbox.log")
+    box = MqttOutbox(LocalBus(), path).load()
+
+    threads = [threading.Thread(target=lambda n=n: box.enqueue("payments/m", {"n": n}, key=f"k{n}"))
+               for n in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 1 <= len(synced) <= 32
+    assert box._synced == box._written == 32
+    assert not box.enqueue("payments/m", {"n": 0}, key="k0")
+
+    restored = MqttOutbox(LocalBus(), path).load()
+    assert sorted(restored._messages) == sorted(f"k{n}" for n in range(32))
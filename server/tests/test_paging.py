@@ -0,0 +1,67 @@
+"""
+Постраничная выдача /api/orders: курсор — позиция (время, id), поэтому
+новые записи не сдвигают страницы; испорченный курсор — 400; большие
+страницы сжимаются gzip по Accept-Encoding.
+"""
+import base64
+import gzip
+import json
+
+from paging import encode_cursor
+
+DEVICE = "page-dev"
+
+
+def create_orders(client, count):
+    return [client.post("/api/create-perfume-order",
+                        json={"device_id": DEVICE, "parfum_id": 1, "amount": 5000}).get_json()["order_id"]
+            for _ in range(count)]
+
+
+def walk(client, cursor, limit=10):
+    url = f"/api/orders?device_id={DEVICE}&limit={limit}&fields=order_id,created_at"
+    return client.get(url + (f"&cursor={cursor}" if cursor else "")).get_json()
+
+
+def test_cursor_is_stable_across_inserts(server, client):
+    created = create_orders(client, 25)
+    first = walk(client, None)
+    assert [order["order_id"] for order in first["orders"]] == created[:10]
+
+    # Новые заказы — после курсора, заказ со старым временем — до него
+    created += create_orders(client, 5)
+    server.order_store.put("parfum_old", {"order_id": "parfum_old", "device_id": DEVICE, "status": "expired",
+                                          "created_at": 1})
+    seen = [order["order_id"] for order in first["orders"]]
+    cursor = first["next_cursor"]
+    while cursor:
+        page = walk(client, cursor)
+        seen += [order["order_id"] for order in page["orders"]]
+        cursor = page["next_cursor"]
+    assert seen == created
+
+
+def test_malformed_cursor_is_rejected(client):
+    forged = base64.urlsafe_b64encode(json.dumps(["1", 2]).encode()).decode()
+    for cursor in ("zzz", forged, encode_cursor([True, "x"]), encode_cursor([1])):
+        response = client.get(f"/api/orders?cursor={cursor}")
+        assert response.status_code == 400, cursor
+    assert client.get(f"/api/orders?cursor={encode_cursor([0, ''])}").status_code == 200
+
+
+def test_large_pages_are_gzipped_on_request(client):
+    create_orders(client, 20)
+    url = f"/api/orders?device_id={DEVICE}&limit=20"
+    plain = client.get(url)
+    assert plain.headers.get("Content-Encoding") is None
+    assert "Accept-Encoding" in plain.headers["Vary"]
+
+    packed = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert packed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(packed.data) == plain.data
+    assert len(packed.data) < len(plain.data)
+
+    # Маленькая страница не сжимается
+    small = client.get(f"/api/orders?device_id={DEVICE}&limit=1&fields=order_id",
+                       headers={"Accept-Encoding": "gzip"})
+    assert small.headers.get("Content-Encoding") is None
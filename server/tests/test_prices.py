@@ -0,0 +1,58 @@
+"""
+Каталог цен: группы и автоматы накладываются на базу по слотам,
+правка пересчитывает только затронутые представления, GET /api/prices
+отвечает 304 на совпавший ETag.
+"""
+import json
+
+from prices import PriceCatalog
+
+BASE = {"prices": [5000, 6000, 7000, 8000], "names": ["A", "B", "C", "D"]}
+
+
+def test_group_and_device_views_overlay_base(tmp_path):
+    catalog = PriceCatalog(str(tmp_path / "prices.json"), default=BASE)
+    _, devices = catalog.update({
+        "groups": {"airport": {"prices": [None, 9000]}},
+        "devices": {"m1": {"group": "airport"}, "m2": {"group": "airport", "prices": [None, None, None, 9900]}},
+    })
+    assert devices == ["m1", "m2"]
+
+    base, _, base_etag = catalog.view()
+    assert base["prices"] == BASE["prices"] and base["shared"]
+    assert catalog.view("m1")[0]["prices"] == [5000, 9000, 7000, 8000]
+    assert catalog.view("m2")[0]["prices"] == [5000, 9000, 7000, 9900]
+    assert catalog.view("unknown")[2] == base_etag
+
+    # Правка группы меняет её автоматы, база та же
+    _, devices = catalog.update({"groups": {"airport": {"prices": [None, 9500]}}})
+    assert devices == ["m1", "m2"]
+    assert catalog.view("m2")[0]["prices"] == [5000, 9500, 7000, 9900]
+    assert catalog.view()[0]["prices"] == BASE["prices"]
+
+    # Автомат убран из каталога — снова база; файл переживает перечитывание
+    _, devices = catalog.update({"devices": {"m2": None}})
+    assert devices == ["m2"]
+    assert catalog.view("m2")[0]["prices"] == BASE["prices"]
+    reloaded = PriceCatalog(str(tmp_path / "prices.json"), default=BASE)
+    assert reloaded.view("m1")[0]["prices"] == [5000, 9500, 7000, 8000]
+
+
+def test_etag_and_device_push(server, client):
+    response = client.post("/api/prices", json={"devices": {"etag-dev": {"prices": [None, 4242]}}})
+    assert response.get_json()["success"]
+
+    first = client.get("/api/prices?device_id=etag-dev")
+    assert first.status_code == 200 and first.get_json()["prices"][1] == 4242
+    etag = first.headers["ETag"]
+    cached = client.get("/api/prices?device_id=etag-dev", headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and not cached.data
+    assert client.get("/api/prices", headers={"If-None-Match": etag}).status_code == 200
+
+    client.post("/api/prices", json={"devices": {"etag-dev": {"prices": [None, 4343]}}})
+    changed = client.get("/api/prices?device_id=etag-dev", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+    retained = server.message_bus.retained[f"config/{server.MERCHANT_ID}/etag-dev"]
+    assert json.loads(retained)["prices"][1] == 4343
+    assert client.post("/api/prices", json={"devices": {"etag-dev": [1]}}).status_code == 400
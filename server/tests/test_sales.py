@@ -0,0 +1,62 @@
+"""
+Сводки продаж не ломают платежи: parfum_id проверяется при создании
+заказа, сбой сводок не мешает Perform и старту сервера.
+"""
+import json
+
+from analytics import SalesRollup
+
+
+def rpc(client, method, **params):
+    return client.post("/payme", json={"id": 1, "method": method, "params": params}).get_json()
+
+
+def confirmed(server, order_id):
+    payloads = [json.loads(payload) for _, payload, _ in server.message_bus.messages]
+    return [payload for payload in payloads
+            if payload.get("order_id") == order_id and payload.get("status") == "confirmed"]
+
+
+def test_order_rejects_parfum_id_outside_slots(client):
+    for parfum_id in (2 ** 40, 0, 5, True, "1", 1.5):
+        response = client.post("/api/create-perfume-order",
+                               json={"device_id": "sales-dev", "parfum_id": parfum_id, "amount": 5000})
+        assert response.status_code == 400, parfum_id
+    for amount in (2 ** 70, 0, "5000"):
+        response = client.post("/api/create-perfume-order",
+                               json={"device_id": "sales-dev", "parfum_id": 1, "amount": amount})
+        assert response.status_code == 400, amount
+
+
+def test_perform_survives_rollup_failure(server, client, monkeypatch):
+    order_id = client.post("/api/create-perfume-order",
+                           json={"device_id": "sales-dev", "parfum_id": 2, "amount": 5000}).get_json()["order_id"]
+    account = {"order_id": order_id}
+    assert rpc(client, "CreateTransaction", id="sales-t1", time=0, amount=500000, account=account)["result"]["state"] == 1
+
+    def broken(record, previous=None):
+        raise OverflowError("rollup is broken")
+
+    monkeypatch.setattr(server.sales, "record", broken)
+    assert rpc(client, "PerformTransaction", id="sales-t1")["result"]["state"] == 2
+    assert server.order_store.get(order_id)["status"] == "paid"
+    assert confirmed(server, order_id)
+
+
+class History:
+    def __init__(self, records):
+        self.records = records
+
+    def history(self):
+        return iter(self.records.items())
+
+
+def test_load_skips_broken_records():
+    records = {
+        "ok": {"state": 2, "perform_time": 1, "device_id": "d", "parfum_id": 3, "amount_tiyin": 500000},
+        "bad": {"state": 2, "perform_time": 1, "device_id": "d", "parfum_id": 2 ** 70, "amount_tiyin": 1},
+    }
+    rollup = SalesRollup(lambda record: record["parfum_id"]).load(History(records))
+    assert rollup.query(group_by=("parfum_id",)) == [
+        {"parfum_id": 3, "sales": 1, "cancelled": 0, "refunds": 0, "revenue_tiyin": 500000, "revenue": 5000.0}
+    ]
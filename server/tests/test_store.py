@@ -0,0 +1,47 @@
+"""
+Компакция JournalStore в фоне: запись не ждёт снимка, журнал,
+отложенный незаконченной компакцией, проигрывается при старте.
+"""
+import os
+
+from store import TransactionStore
+
+
+def transaction(i, state=1):
+    return {"state": state, "create_time": 1000 + i, "account": {"order_id": f"o{i}"}, "amount_tiyin": 500000}
+
+
+def test_background_compaction_keeps_every_write(tmp_path):
+    store = TransactionStore(str(tmp_path / "processed.json"), snapshot_min=20).load()
+    for state in (1, 2, -2):
+        for i in range(100):
+            store.put(f"t{i}", transaction(i, state))
+    store.compact()
+    assert not os.path.exists(store.old_log_path)
+    expected = store.to_dict()
+    store.close()
+    assert TransactionStore(store.path).load().to_dict() == expected
+
+
+def test_load_finishes_interrupted_compaction(tmp_path, monkeypatch):
+    store = TransactionStore(str(tmp_path / "processed.json"), snapshot_min=20).load()
+
+    def crash(data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_write_snapshot", crash)
+    for i in range(50):
+        store.put(f"t{i}", transaction(i))
+    store._wait_compaction()
+    # Снимок не записан: отложенный журнал на месте, новые строки — в текущем
+    assert os.path.exists(store.old_log_path)
+    for i in range(50):
+        store.put(f"t{i}", transaction(i, 2))
+    expected = store.to_dict()
+    store.close()
+
+    reloaded = TransactionStore(store.path).load()
+    assert reloaded.to_dict() == expected
+    assert not os.path.exists(reloaded.old_log_path)
+    reloaded.close()
+    assert TransactionStore(store.path).load().to_dict() == expected
@@ -0,0 +1,94 @@
+"""
+Сегменты телеметрии: каталоги завершившихся процессов сливаются в
+shared без потерь и повторов, живой каталог не трогается, оборванный
+блок и недоделанное слияние восстанавливаются.
+"""
+import json
+import os
+
+import pytest
+
+import telemetry
+from telemetry import SegmentWriter, claim_directory, compact, new_columns, summarize
+
+
+def write_events(directory, device, count, start=1000, chunk=3):
+    """Каталог процесса без flock — как после его завершения"""
+    writer = SegmentWriter(directory).open()
+    for first in range(0, count, chunk):
+        columns = new_columns()
+        for i in range(first, min(first + chunk, count)):
+            row = (start + i, writer.code("device", device), writer.code("type", "dose"), i % 4, 10)
+            for column, value in zip(columns, row):
+                column.append(value)
+        writer.append(columns)
+    writer.close()
+
+
+def counts(root):
+    return {(e["device_id"], e["slot"]): e["count"] for e in summarize(root)}
+
+
+def test_dead_directories_merge_and_live_one_stays(tmp_path):
+    root = str(tmp_path / "telemetry")
+    write_events(os.path.join(root, "w101"), "m1", 20)
+    write_events(os.path.join(root, "w102"), "m2", 7, start=5000)
+    live = os.path.join(root, "w103")
+    lock = claim_directory(root, live)
+    try:
+        write_events(live, "m1", 5, start=9000)
+        before = counts(root)
+        assert sum(before.values()) == 32
+
+        assert compact(root) == 2
+        assert sorted(os.listdir(root)) == [".compact.lock", "shared", "w103"]
+        assert counts(root) == before
+        assert summarize(root, 5000, 5003) == [
+            {"device_id": "m2", "type": "dose", "slot": slot, "count": 1, "value_sum": 10, "last_time": 5000 + slot}
+            for slot in range(4)]
+
+        # Второй проход ничего не добавляет
+        assert compact(root) == 0
+        assert counts(root) == before
+    finally:
+        os.close(lock)
+
+    assert compact(root) == 1
+    assert counts(root) == before
+
+
+def test_worker_exit_mid_chunk_keeps_complete_chunks(tmp_path):
+    root = str(tmp_path / "telemetry")
+    directory = os.path.join(root, "w201")
+    write_events(directory, "m1", 9)
+    with open(telemetry.segment_paths(directory)[-1], "ab") as f:
+        f.write(telemetry.CHUNK_HEADER.pack(telemetry.CHUNK_MAGIC, 100, 0, 0) + b"\x00" * 17)
+
+    assert compact(root) == 1
+    assert counts(root) == {("m1", slot): count for slot, count in ((0, 3), (1, 2), (2, 2), (3, 2))}
+
+
+def test_interrupted_merge_is_rolled_back_and_repeated(tmp_path, monkeypatch):
+    root = str(tmp_path / "telemetry")
+    write_events(os.path.join(root, "w301"), "m1", 10)
+    assert compact(root) == 1
+    write_events(os.path.join(root, "w302"), "m2", 6, start=2000)
+    expected = {("m1", slot): count for slot, count in ((0, 3), (1, 3), (2, 2), (3, 2))}
+    expected.update({("m2", slot): count for slot, count in ((0, 2), (1, 2), (2, 1), (3, 1))})
+
+    # Слияние падает после записи в shared, до удаления источника
+    def crash(*args):
+        raise OSError("crash")
+
+    monkeypatch.setattr(telemetry.os, "rename", crash)
+    with pytest.raises(OSError):
+        compact(root)
+    monkeypatch.undo()
+    shared = os.path.join(root, "shared")
+    assert os.path.exists(os.path.join(shared, telemetry.COMPACT_INTENT))
+    with open(os.path.join(shared, telemetry.COMPACT_INTENT)) as f:
+        assert json.load(f)["source"] == "w302"
+
+    assert compact(root) == 1
+    assert counts(root) == expected
+    assert sorted(os.listdir(root)) == [".compact.lock", "shared"]
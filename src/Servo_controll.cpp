@@ -3,6 +3,7 @@
 void servo_c1 () {
     if (button1_count.isSingle() && counts > 0) {
         counts--;
+        telemetryEvent("dose", 1, counts);
         servo1.write(90);
         delay(300);
         servo1.write(0);
@@ -11,6 +12,7 @@ void servo_c1 () {
 void servo_c2 () {
     if (button2_count.isSingle() && counts > 0) {
         counts--;
+        telemetryEvent("dose", 2, counts);
         servo1.write(90);
         delay(300);
         servo1.write(0);
@@ -19,6 +21,7 @@ void servo_c2 () {
 void servo_c3 () {
     if (button3_count.isSingle() && counts > 0) {
         counts--;
+        telemetryEvent("dose", 3, counts);
         servo1.write(90);
         delay(300);
         servo1.write(0);
@@ -27,6 +30,7 @@ void servo_c3 () {
 void servo_c4 () {
     if (button4_count.isSingle() && counts > 0) {
         counts--;
+        telemetryEvent("dose", 4, counts);
         servo1.write(90);
         delay(300);
         servo1.write(0);
@@ -5,6 +5,7 @@ void buttons_control() {
     if (orderPending) {
         if (button_cancel.isSingle()) {
             Serial.println("🔘 Cancel pressed");
+            telemetryEvent("cancel", parfum_num);
             cancelOrder();
         }
         return;
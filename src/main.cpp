@@ -16,6 +16,10 @@ const char* ssid = WIFI_SSID;
 const char* password = WIFI_PASSWORD;
 const char* mqtt_server = MQTT_SERVER;
 const char* mqtt_topic = MQTT_TOPIC;
+const char* mqtt_device_topic = MQTT_DEVICE_TOPIC;
+const char* mqtt_config_topic = MQTT_CONFIG_TOPIC;
+const char* mqtt_device_config_topic = MQTT_DEVICE_CONFIG_TOPIC;
+const char* mqtt_telemetry_topic = MQTT_TELEMETRY_TOPIC;
 
 // Кнопки
 GButton button1(22);
@@ -55,6 +59,7 @@ int dolce_gabbana4 = 8000;
 
 // Для pollPrices
 unsigned long lastPoll = 0;
+bool pricesPushed = false;
 const char* NAME_TOM = "Tom Ford";
 const char* NAME_LANVIN = "Lanvin";
 const char* NAME_DIOR = "Dior";
@@ -119,6 +124,7 @@ void setup() {
 void loop() {
     // MQTT
     mqtt_loop();
+    telemetryLoop();
     // LVGL
     static uint32_t last_tick = 0;
     uint32_t now = millis();
@@ -145,6 +151,7 @@ void loop() {
         if (wait_sec_var == 0) {
         wait_flag1 = true;
         wait_flag = false;
+        telemetryEvent("timeout", parfum_num);
         cancelOrder();
         lv_scr_load(ui_Screen1);
         wait_sec_var = 9000;
@@ -154,13 +161,14 @@ void loop() {
         wait_flag = false;
         wait_sec_var = 9000;
         payment_time = millis();
-        generateQrToImage(qr_url1);
+        extendOrder();   // иначе сервер истечёт заказ по первому окну
+        renderQrBits();  // QR того же заказа уже в qr_bits
         lv_scr_load(ui_Screen2);
 
   }
     }
-    // Обновляем цены каждые 30 секунд
-    if (millis() - lastPoll > 30000) {
+    // Запасной опрос цен (основной путь — retained MQTT config)
+    if (millis() - lastPoll > (pricesPushed ? PRICE_POLL_FALLBACK : PRICE_POLL_INTERVAL)) {
         pollPrices();
         lastPoll = millis();
     }
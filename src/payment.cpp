@@ -1,10 +1,31 @@
 #include <Globals.h>
 #include <qrcode.h>
 #include <WiFiClientSecure.h>
+#include <mbedtls/base64.h>
 // ==================== QR БУФЕР ====================
 
 static uint8_t* qr_buffer = nullptr;
 
+// Упакованная QR-матрица: 1 бит на модуль, строки выровнены по байту
+// (тот же формат, что поле "qr" в ответе /create-perfume-order)
+static uint8_t qr_bits[QR_BITS_MAX];
+static int qr_bits_size = 0;
+static int qr_bits_row_bytes = 0;
+
+// Заказ, QR которого уже нарисован из ответа сервера
+static String renderedOrderId;
+
+// Последний созданный заказ: "confirmed"/"cancelled" другого заказа
+// (просроченного, отменённого по таймауту транзакции) его не трогают
+static String currentOrderId;
+
+// Автомат получил собственный каталог: общий config/ его не перезаписывает
+static bool deviceCatalog = false;
+
+// Последняя подтверждённая транзакция: сервер доставляет с QoS 1,
+// повтор одного и того же "confirmed" не должен выдать дозы дважды
+static String lastConfirmedTx;
+
 // ==================== ЗАГРУЗКА/СОХРАНЕНИЕ ЦЕН ====================
 void loadFromPrefs() {
     prefs.begin("parfum", true);
@@ -51,12 +72,25 @@ void pollPrices() {
     WiFiClientSecure client;
     client.setInsecure();
     
+    // ETag последнего полученного каталога: без изменений сервер ответит 304
+    static String pricesEtag;
+    const char* headerKeys[] = {"ETag"};
+    
     HTTPClient http;
-    String url = String(SERVER_URL) + "/prices";
+    String url = String(SERVER_URL) + "/prices?device_id=" + DEVICE_ID;
     http.begin(client, url);
+    http.collectHeaders(headerKeys, 1);
+    if (pricesEtag.length() > 0) {
+        http.addHeader("If-None-Match", pricesEtag);
+    }
     
     int code = http.GET();
     
+    if (code == HTTP_CODE_NOT_MODIFIED) {
+        http.end();
+        return;
+    }
+    
     if (code != HTTP_CODE_OK) {
         Serial.printf("❌ GET /api/prices failed, code=%d\n", code);
         http.end();
@@ -64,6 +98,7 @@ void pollPrices() {
     }
 
     String payload = http.getString();
+    String etag = http.header("ETag");
     http.end();
 
     JsonDocument doc;
@@ -73,7 +108,14 @@ void pollPrices() {
         Serial.println(err.c_str());
         return;
     }
+    pricesEtag = etag;
+
+    deviceCatalog = !doc["shared"].as<bool>();
+    applyPrices(doc);
+}
 
+// Применение каталога цен (из HTTP-ответа или retained MQTT config)
+void applyPrices(JsonDocument &doc) {
     JsonArray jnames = doc["names"].as<JsonArray>();
     JsonArray jprices = doc["prices"].as<JsonArray>();
 
@@ -160,6 +202,12 @@ void setup_wifi() {
     }
 }
 
+// Сообщение без order_id (тестовые endpoint'ы, старые QR) относится к текущему заказу
+static bool isCurrentOrder(JsonDocument &doc) {
+    String orderId = doc["order_id"] | "";
+    return orderId.length() == 0 || orderId == currentOrderId;
+}
+
 // ==================== MQTT Callback ====================
 void mqtt_callback(char* topic, byte* payload, unsigned int length) {
     Serial.println("\n📩 MQTT Message received!");
@@ -180,6 +228,25 @@ void mqtt_callback(char* topic, byte* payload, unsigned int length) {
         return;
     }
     
+    // === CONFIG — новые цены (retained, приходит сразу после подписки) ===
+    // Каталог автомата важнее общего; "shared": true — автомат снова на общем
+    if (strcmp(topic, mqtt_device_config_topic) == 0) {
+        Serial.println("🏷️ Device prices pushed via MQTT");
+        deviceCatalog = !doc["shared"].as<bool>();
+        pricesPushed = true;
+        applyPrices(doc);
+        return;
+    }
+    if (strcmp(topic, mqtt_config_topic) == 0) {
+        pricesPushed = true;
+        if (deviceCatalog) {
+            return;
+        }
+        Serial.println("🏷️ Prices pushed via MQTT");
+        applyPrices(doc);
+        return;
+    }
+    
     String status = doc["status"].as<String>();
     
     // === CREATED — показываем QR ===
@@ -193,8 +260,14 @@ void mqtt_callback(char* topic, byte* payload, unsigned int length) {
         Serial.println("💰 Amount: " + String(amount));
         
         // Генерируем QR и показываем на Screen2
+        // (если сервер уже прислал готовую матрицу — QR на экране)
         isDone = false;
-        generateQrToImage(qr_url);
+        if (currentOrderId.length() == 0) {
+            currentOrderId = doc["order_id"].as<String>();
+        }
+        if (doc["order_id"].as<String>() != renderedOrderId) {
+            generateQrToImage(qr_url);
+        }
         lv_scr_load(ui_Screen2);
         
         orderPending = true;
@@ -202,7 +275,18 @@ void mqtt_callback(char* topic, byte* payload, unsigned int length) {
     
     // === CONFIRMED — оплата успешна ===
     else if (status == "confirmed") {
+        if (!isCurrentOrder(doc)) {
+            Serial.println("↩️ Confirmation for another order ignored");
+            return;
+        }
         int amount = doc["amount"].as<int>();
+        String txId = doc["transaction_id"].as<String>();
+        
+        if (txId.length() > 0 && txId == lastConfirmedTx) {
+            Serial.println("↩️ Duplicate confirmation ignored: " + txId);
+            return;
+        }
+        lastConfirmedTx = txId;
         
         Serial.println("✅ Payment confirmed: " + String(amount) + " sum");
         
@@ -217,6 +301,10 @@ void mqtt_callback(char* topic, byte* payload, unsigned int length) {
     
     // === CANCELLED — отмена ===
     else if (status == "cancelled") {
+        if (!orderPending || !isCurrentOrder(doc)) {
+            Serial.println("↩️ Cancellation for another order ignored");
+            return;
+        }
         Serial.println("❌ Order cancelled");
         
         clearQrImage();
@@ -241,14 +329,27 @@ void mqtt_reconnect() {
             error_mode = false;
             lv_scr_load(ui_Screen1);
             Serial.println(" connected!");
+            telemetryEvent("mqtt_connect", 0);
+            // Пока отключены, push мог потеряться: опрашиваем часто до retained config
+            pricesPushed = false;
             client.subscribe(mqtt_topic);
+            client.subscribe(mqtt_device_topic);
+            client.subscribe(mqtt_config_topic);
+            client.subscribe(mqtt_device_config_topic);
             Serial.print("📡 Subscribed to: ");
-            Serial.println(mqtt_topic);
+            Serial.print(mqtt_topic);
+            Serial.print(", ");
+            Serial.print(mqtt_device_topic);
+            Serial.print(", ");
+            Serial.print(mqtt_config_topic);
+            Serial.print(", ");
+            Serial.println(mqtt_device_config_topic);
         } else {
             error_mode = true;
             lv_scr_load(ui_Screen3);
             Serial.print(" failed, rc=");
             Serial.println(client.state());
+            telemetryEvent("mqtt_fail", 0, client.state());
         }
         
         lastAttempt = millis();
@@ -274,19 +375,54 @@ void mqtt_loop() {
 // ==================== Генерация QR в ui_Image10 ====================
 void generateQrToImage(String url) {
     Serial.println("📱 Generating QR: " + url);
-    static lv_img_dsc_t qr_img_dsc;
     // Создаём QR код
     QRCode qrcode;
-    uint8_t qrcodeData[qrcode_getBufferSize(6)];
-    qrcode_initText(&qrcode, qrcodeData, 6, ECC_MEDIUM, url.c_str());
+    uint8_t qrcodeData[qrcode_getBufferSize(QR_VERSION)];
+    qrcode_initText(&qrcode, qrcodeData, QR_VERSION, ECC_MEDIUM, url.c_str());
+    
+    // Упаковываем модули в qr_bits и рисуем общим кодом
+    qr_bits_size = qrcode.size;
+    qr_bits_row_bytes = (qrcode.size + 7) / 8;
+    memset(qr_bits, 0, sizeof(qr_bits));
+    for (uint8_t y = 0; y < qrcode.size; y++) {
+        for (uint8_t x = 0; x < qrcode.size; x++) {
+            if (qrcode_getModule(&qrcode, x, y)) {
+                qr_bits[y * qr_bits_row_bytes + (x >> 3)] |= 0x80 >> (x & 7);
+            }
+        }
+    }
+    renderQrBits();
+}
+
+// ==================== Готовая QR-матрица от сервера ====================
+bool showQrBitmap(const char* bitsBase64, int size, int rowBytes) {
+    size_t decoded = 0;
+    if (size <= 0 || rowBytes != (size + 7) / 8 || size * rowBytes > QR_BITS_MAX) {
+        return false;
+    }
+    if (mbedtls_base64_decode(qr_bits, sizeof(qr_bits), &decoded,
+                              (const unsigned char*)bitsBase64, strlen(bitsBase64)) != 0
+        || decoded != (size_t)(size * rowBytes)) {
+        Serial.println("❌ Bad QR bitmap from server");
+        return false;
+    }
+    qr_bits_size = size;
+    qr_bits_row_bytes = rowBytes;
+    renderQrBits();
+    return true;
+}
+
+// ==================== Отрисовка qr_bits в RGB565 ====================
+void renderQrBits() {
+    static lv_img_dsc_t qr_img_dsc;
     
     // Размеры области
     int imgWidth = 172;
     int imgHeight = 192;
     
     // Размер модуля QR
-    int moduleSize = min(imgWidth, imgHeight) / qrcode.size;
-    int qrPixelSize = qrcode.size * moduleSize;
+    int moduleSize = min(imgWidth, imgHeight) / qr_bits_size;
+    int qrPixelSize = qr_bits_size * moduleSize;
     
     // Центрирование
     int offsetX = (imgWidth - qrPixelSize) / 2;
@@ -317,9 +453,9 @@ void generateQrToImage(String url) {
     }
     
     // Рисуем QR код (чёрные модули)
-    for (uint8_t y = 0; y < qrcode.size; y++) {
-        for (uint8_t x = 0; x < qrcode.size; x++) {
-            if (qrcode_getModule(&qrcode, x, y)) {
+    for (int y = 0; y < qr_bits_size; y++) {
+        for (int x = 0; x < qr_bits_size; x++) {
+            if (qr_bits[y * qr_bits_row_bytes + (x >> 3)] & (0x80 >> (x & 7))) {
                 int startX = offsetX + x * moduleSize;
                 int startY = offsetY + y * moduleSize;
                 
@@ -381,6 +517,7 @@ void createOrder(int parfumId, int price) {
     doc["device_id"] = DEVICE_ID;
     doc["parfum_id"] = parfumId;
     doc["amount"] = price;
+    doc["qr_bitmap"] = true;  // сервер вернёт готовую QR-матрицу
     
     String jsonStr;
     serializeJson(doc, jsonStr);
@@ -392,6 +529,20 @@ void createOrder(int parfumId, int price) {
         Serial.println("✅ Server response: " + response);
         orderPending = true;
         payment_time = millis();
+        
+        // Рисуем QR сразу из ответа, не дожидаясь MQTT "created"
+        JsonDocument resp;
+        bool parsed = !deserializeJson(resp, response);
+        currentOrderId = parsed ? resp["order_id"] | "" : "";
+        if (parsed && resp["qr"].is<JsonObject>()) {
+            JsonObject qr = resp["qr"];
+            if (showQrBitmap(qr["bits"] | "", qr["size"] | 0, qr["row_bytes"] | 0)) {
+                renderedOrderId = resp["order_id"].as<String>();
+                qr_url1 = resp["qr_url"].as<String>();
+                isDone = false;
+                lv_scr_load(ui_Screen2);
+            }
+        }
     } else {
         Serial.printf("❌ HTTP Error: %d\n", httpCode);
     }
@@ -399,6 +550,33 @@ void createOrder(int parfumId, int price) {
     http.end();
 }
 
+// ==================== Продление заказа ====================
+// QR показан снова (кнопка во время обратного отсчёта): сервер
+// откладывает истечение заказа на ORDER_TTL_SEC от этого момента
+void extendOrder() {
+    if (WiFi.status() != WL_CONNECTED || currentOrderId.length() == 0) {
+        return;
+    }
+    
+    WiFiClientSecure client;
+    client.setInsecure();
+    
+    HTTPClient http;
+    http.begin(client, String(SERVER_URL) + "/extend-perfume-order");
+    http.addHeader("Content-Type", "application/json");
+    
+    JsonDocument doc;
+    doc["order_id"] = currentOrderId;
+    String jsonStr;
+    serializeJson(doc, jsonStr);
+    
+    int httpCode = http.POST(jsonStr);
+    if (httpCode != 200) {
+        Serial.printf("❌ Extend order failed, code=%d\n", httpCode);
+    }
+    http.end();
+}
+
 // ==================== Отмена заказа ====================
 void cancelOrder() {
     Serial.println("🚫 Order cancelled");
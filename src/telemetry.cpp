@@ -0,0 +1,61 @@
+#include <Globals.h>
+
+// ==================== ТЕЛЕМЕТРИЯ ====================
+// События копятся в кольцевом буфере и уходят одной пачкой в
+// telemetry/.../DEVICE_ID: {"m": millis(), "e": [[millis(), тип, slot, value], ...]}.
+// Сервер сам переводит millis() в своё время, NTP не нужен.
+// Без связи старые события перезаписываются новыми.
+
+struct TelemetryEvent {
+    uint32_t ms;
+    const char* type;
+    int16_t slot;
+    int32_t value;
+};
+
+static TelemetryEvent events[TELEMETRY_MAX];
+static int eventsHead = 0;
+static int eventsCount = 0;
+static unsigned long lastFlush = 0;
+
+void telemetryEvent(const char* type, int slot, long value) {
+    int index = (eventsHead + eventsCount) % TELEMETRY_MAX;
+    if (eventsCount == TELEMETRY_MAX) {
+        eventsHead = (eventsHead + 1) % TELEMETRY_MAX;
+    } else {
+        eventsCount++;
+    }
+    events[index] = {millis(), type, (int16_t)slot, (int32_t)value};
+}
+
+void telemetryFlush() {
+    if (eventsCount == 0 || !client.connected()) return;
+
+    JsonDocument doc;
+    doc["m"] = millis();
+    JsonArray list = doc["e"].to<JsonArray>();
+    for (int i = 0; i < eventsCount; i++) {
+        const TelemetryEvent &event = events[(eventsHead + i) % TELEMETRY_MAX];
+        JsonArray item = list.add<JsonArray>();
+        item.add(event.ms);
+        item.add(event.type);
+        item.add(event.slot);
+        item.add(event.value);
+    }
+
+    static char buffer[1024];
+    size_t length = serializeJson(doc, buffer, sizeof(buffer));
+    if (client.publish(mqtt_telemetry_topic, (const uint8_t*)buffer, length)) {
+        eventsHead = 0;
+        eventsCount = 0;
+    } else {
+        Serial.println("❌ Telemetry publish failed");
+    }
+}
+
+void telemetryLoop() {
+    if (eventsCount == TELEMETRY_MAX || (eventsCount > 0 && millis() - lastFlush > TELEMETRY_INTERVAL)) {
+        telemetryFlush();
+        lastFlush = millis();
+    }
+}